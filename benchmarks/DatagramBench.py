@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Benchmark parsing of SSDP datagrams.
+
+This compares the lazy header index of SSDPdatagram with the former
+implementation that parsed all header lines into the instance dictionary on
+construction. It reports parse time and allocated bytes per object.
+
+Usage: python3 -m benchmarks.DatagramBench [-n COUNT]
+"""
+
+import re
+import argparse
+import tracemalloc
+from time import time, perf_counter
+
+from muca.upnp.Common import SSDPdatagram
+from tests.CommonTest import SDATAGRAM1, SDATAGRAM2, SDATAGRAM3, \
+                             LDATAGRAM1, LDATAGRAM2, LDATAGRAM3, \
+                             SADDR1, SADDR2, SADDR3, LADDR1, LADDR2, LADDR3
+
+
+class LegacySSDPdatagram:
+    """The former SSDPdatagram that parses every header on construction."""
+    timestamp = 0
+    ipaddr = ''
+    port = '0'
+    method = ''
+    request = 0
+    _raw_data = None
+
+    def __init__(self, addr=('', 0), raw_data=None):
+        """Parse all header lines into properties."""
+        self.timestamp = time()
+        self._raw_data = raw_data
+        self.ipaddr = addr[0]
+        self.port = '' if addr[1] == 0 else str(addr[1])
+        if raw_data is None:
+            return
+        lines = self.data.splitlines()
+        parts = lines[0].partition(' * HTTP')
+        if parts[1] != '':
+            self.method = parts[0]
+        for line in enumerate(lines, 1):
+            parts = line[1].partition(':')
+            if parts[1] != '':
+                propname = parts[0].lower().strip()
+                propname = re.sub(r"([^a-z0-9_])", r"_", propname)
+                propname = re.sub(r"(^[0-9_])", r"x\1", propname)
+                setattr(self, propname, parts[2].strip())
+        if hasattr(self, 'usn'):
+            self.uuid = self.usn.partition('uuid:')[2].partition('::')[0]
+
+    @property
+    def data(self):
+        """This returns the decoded raw data as string."""
+        if self._raw_data is None:
+            return
+        return self._raw_data.decode()
+
+
+SAMPLES = (
+    (SADDR1, SDATAGRAM1), (SADDR2, SDATAGRAM2), (SADDR3, SDATAGRAM3),
+    (LADDR1, LDATAGRAM1), (LADDR2, LDATAGRAM2), (LADDR3, LDATAGRAM3))
+
+
+def parse_time(cls, count, access=None):
+    """This returns the parse time per datagram in microseconds.
+
+    If access is given, this property is read from every datagram.
+    """
+    samples = SAMPLES * (count // len(SAMPLES) + 1)
+    samples = samples[:count]
+    start = perf_counter()
+    if access is None:
+        for addr, data in samples:
+            cls(addr, data)
+    else:
+        for addr, data in samples:
+            getattr(cls(addr, data), access, None)
+    return (perf_counter() - start) / count * 1e6
+
+
+def object_size(cls, count):
+    """This returns the allocated bytes per datagram object.
+
+    The raw datagrams are already allocated so they are not counted.
+    """
+    samples = SAMPLES * (count // len(SAMPLES) + 1)
+    samples = samples[:count]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [cls(addr, data) for addr, data in samples]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / count
+
+
+def main():
+    """This is the entry point of the benchmark and the command line parser"""
+    parser = argparse.ArgumentParser(
+        description='Benchmark parsing of SSDP datagrams')
+    parser.add_argument("-n", "--count", type=int, default=100000,
+                        help="number of datagrams to parse")
+    args = parser.parse_args()
+
+    print('{:<20} {:>12} {:>12} {:>12}'.format(
+        'class', 'parse us', 'parse+usn us', 'bytes/obj'))
+    for cls in (LegacySSDPdatagram, SSDPdatagram):
+        print('{:<20} {:>12.3f} {:>12.3f} {:>12.1f}'.format(
+            cls.__name__, parse_time(cls, args.count),
+            parse_time(cls, args.count, 'usn'),
+            object_size(cls, min(args.count, 10000))))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Startup time of the muca program with its subcommands.
+
+Every command is started in a new interpreter with 'python3 -X importtime -m
+muca COMMAND --version', that ends after parsing the arguments. The import
+time of the interpreter itself is measured with an empty program and
+subtracted, the rest is the time to import the modules of the command. Python
+writes the import times of every module to stderr:
+
+    import time: self [us] | cumulative | imported package
+    import time:       335 |        335 |   _io
+    import time:       812 |       4102 | argparse
+
+The best of the repeats is compared with a fixed budget for every command:
+
+    python3 -m benchmarks.Startup -r 5 -o startup.json
+
+It exits with status 1 if a command imports longer than its budget. The
+budgets are for a desktop machine, they can be scaled for slower machines
+with --scale.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from time import time, perf_counter
+
+from muca.Common import build
+
+# command -> import time budget (in ms), 'muca' is the program without a
+# command.
+BUDGETS = {
+    'muca': 8.0,
+    'search': 30.0,
+    'listen': 35.0,
+    'daemon': 35.0,
+    'monitor': 30.0,
+}
+
+
+def parse_importtime(text):
+    """Parse the output of -X importtime.
+
+    Returns: dictionary with the cumulative import time (in us) of every top
+             level import
+    """
+    _imports = {}
+    for _line in text.splitlines():
+        if not _line.startswith('import time:'):
+            continue
+        _, _cumulative, _name = _line[12:].split('|')
+        # Imports within an import are indented.
+        if _name.startswith('  ') or not _cumulative.strip().isdigit():
+            continue
+        _name = _name.strip()
+        _imports[_name] = _imports.get(_name, 0) + int(_cumulative)
+    return _imports
+
+
+def _environment():
+    """This returns the environment for the measured interpreters.
+
+    Byte code is written so the measurement does not include compiling.
+    """
+    _env = dict(os.environ)
+    _env.pop('PYTHONDONTWRITEBYTECODE', None)
+    _root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    _env['PYTHONPATH'] = os.pathsep.join(
+        [_root] + ([_env['PYTHONPATH']] if _env.get('PYTHONPATH') else []))
+    return _env
+
+
+def _importtime(args, env):
+    """Run an interpreter with -X importtime.
+
+    Returns: tuple (top level imports from parse_importtime(), wall time in
+             seconds)
+    """
+    _start = perf_counter()
+    _process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    _seconds = perf_counter() - _start
+    return parse_importtime(_process.stderr.decode(errors='replace')), \
+        _seconds
+
+
+def measure(command, repeat=5, env=None):
+    """Measure the startup of a command.
+
+    Returns: dictionary with the import time (in ms) of the modules of the
+             command, the wall time (in ms) and the heaviest imports
+    """
+    if env is None:
+        env = _environment()
+    _args = ['-m', 'muca'] + ([] if command == 'muca' else [command]) + \
+        ['--version']
+    # The first run writes the byte code.
+    _importtime(_args, env)
+    _best = None
+    for _ in range(repeat):
+        _base, _ = _importtime(['-c', 'pass'], env)
+        _imports, _seconds = _importtime(_args, env)
+        # Imports of the interpreter startup are not counted.
+        _own = {_name: _us for _name, _us in _imports.items()
+                if _name not in _base}
+        _result = {
+            'import_ms': sum(_own.values()) / 1000,
+            'wall_ms': _seconds * 1000,
+            'heaviest': sorted(_own.items(), key=lambda _item: -_item[1])[:5]}
+        if _best is None or _result['import_ms'] < _best['import_ms']:
+            _best = _result
+    return _best
+
+
+def run(commands=None, repeat=5, scale=1.0):
+    """Measure the commands and compare them with their budgets.
+
+    Returns: dictionary with meta data and the results of every command
+    """
+    _env = _environment()
+    _results = {}
+    for _command in (BUDGETS if commands is None else commands):
+        _result = measure(_command, repeat, _env)
+        _result['budget_ms'] = BUDGETS.get(_command, 0.0) * scale
+        _result['over_budget'] = _result['import_ms'] > _result['budget_ms']
+        _results[_command] = _result
+    return {
+        'meta': {
+            'build': build(),
+            'python': sys.version.split()[0],
+            'timestamp': time(),
+            'repeat': repeat,
+            'scale': scale},
+        'results': _results}
+
+
+def main():
+    """This is the entry point of the benchmark and the command line parser"""
+    parser = argparse.ArgumentParser(
+        description='Import time of the muca commands against a budget')
+    parser.add_argument("-c", "--command", action="append",
+                        choices=list(BUDGETS), help="measure only this "
+                        "command, 'muca' is the program without a command, "
+                        "may be repeated")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="number of repeats, the best is used")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="factor for the budgets of slower machines")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the results as JSON to the file")
+    args = parser.parse_args()
+
+    _results = run(args.command or None, args.repeat, args.scale)
+    if args.output:
+        with open(args.output, 'w') as _file:
+            json.dump(_results, _file, indent=2)
+    _over = False
+    for _command, _result in _results['results'].items():
+        print('{:<8} {:>8.1f} ms imports {:>8.1f} ms wall  budget {:.1f}'
+              ' ms{}'.format(_command, _result['import_ms'],
+                             _result['wall_ms'], _result['budget_ms'],
+                             '  OVER BUDGET' if _result['over_budget'] else
+                             ''))
+        if _result['over_budget']:
+            _over = True
+            for _name, _us in _result['heaviest']:
+                print('    {:<32} {:>8.1f} ms'.format(_name, _us / 1000))
+    if _over:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the hot paths of searching and listening.
+
+No network is used. Synthetic datagrams are build from the header shapes of
+the test pattern with different addresses and unique identifiers. Measured
+are:
+    parse           SSDPdatagram construction
+    fdevice_short   formating of a device line
+    fdevice_verbose formating of a device with the whole datagram
+    template        formating with a compiled output template
+    dedupe          unique responses with MsearchDevice.get()
+    listen_get      receiving and formating with Listen.get()
+    listen_metrics  the same with metrics enabled
+    filter          raw check of a filter expression that drops the datagrams
+    listen_pipeline receiving with ListenPipeline, parsing and formating in
+                    a worker process for every CPU
+
+Results are written as JSON. Two result files can be compared to catch a
+regression before a release:
+
+    python3 -m benchmarks.Suite run -n 100000 -o new.json
+    python3 -m benchmarks.Suite compare base.json new.json --threshold 10
+
+compare exits with status 1 if a benchmark is slower than the threshold.
+"""
+
+import sys
+import json
+import socket
+import platform
+import argparse
+from unittest import mock
+from time import time, perf_counter
+
+from muca.Common import build
+from muca.Metrics import Metrics
+from muca.upnp.Common import SSDPdatagram
+from muca.upnp.Filter import Filter
+from muca.upnp.Template import Template
+from muca.upnp.Search import MsearchDevice
+from muca.upnp.Listen import Listen, ListenPipeline
+from tests.CommonTest import SDATAGRAM1, SDATAGRAM2, SDATAGRAM3, \
+                             LDATAGRAM1, LDATAGRAM2, LDATAGRAM3
+
+SHAPES = (SDATAGRAM1, SDATAGRAM2, SDATAGRAM3,
+          LDATAGRAM1, LDATAGRAM2, LDATAGRAM3)
+# Not more distinct datagrams are hold in memory, they are repeated.
+POOLSIZE = 10000
+
+
+def synthetic(count, devices=1000):
+    """This returns a pool of synthetic datagrams.
+
+    Arguments: count = number of datagrams
+               devices = number of different devices
+    Returns: list of tuples (address, raw datagram) with not more than
+             POOLSIZE entries
+    """
+    _pool = []
+    for i in range(min(count, POOLSIZE)):
+        _device = i % devices
+        _shape = SHAPES[i % len(SHAPES)]
+        _uuid = '{:08x}-0000-1000-8000-{:012x}'.format(_device, _device)
+        _data = _shape.replace(
+            b'uuid:' + _shape.partition(b'uuid:')[2][:36],
+            b'uuid:' + _uuid.encode())
+        _addr = ('10.{}.{}.{}'.format(_device >> 16 & 255, _device >> 8 & 255,
+                                      _device & 255), 1900 + i % 64)
+        _pool.append((_addr, _data))
+    return _pool
+
+
+def _repeat(pool, count):
+    """This returns count entries from the pool, repeated as needed."""
+    return (pool * (count // len(pool) + 1))[:count]
+
+
+def bench_parse(pool, count):
+    """Construct SSDPdatagram objects."""
+    _items = _repeat(pool, count)
+    _start = perf_counter()
+    for _addr, _data in _items:
+        SSDPdatagram(_addr, _data)
+    return perf_counter() - _start
+
+
+def bench_filter(pool, count):
+    """Drop datagrams with the raw check of a filter expression."""
+    _items = _repeat(pool, count)
+    _prematch = Filter('method == NOTIFY and nts and ip in 192.168.0.0/16'
+                       ).prematch
+    _start = perf_counter()
+    for _addr, _data in _items:
+        _prematch(_addr, _data)
+    return perf_counter() - _start
+
+
+def _fdevice(pool, count, verbose):
+    """Format datagrams to device lines.
+
+    Every datagram is formated once like on receiving, so nothing is taken
+    from the caches of a former call.
+    """
+    _items = [SSDPdatagram(_addr, _data) for _addr, _data in
+              _repeat(pool, count)]
+    _base_time = time() - 1
+    _start = perf_counter()
+    for _o_datagram in _items:
+        _o_datagram.fdevice(base_time=_base_time, verbose=verbose)
+    return perf_counter() - _start
+
+
+def bench_fdevice_short(pool, count):
+    """Format datagrams to short device lines."""
+    return _fdevice(pool, count, False)
+
+
+def bench_fdevice_verbose(pool, count):
+    """Format datagrams to verbose device lines."""
+    return _fdevice(pool, count, True)
+
+
+def bench_template(pool, count):
+    """Format datagrams with an output template."""
+    _items = [SSDPdatagram(_addr, _data) for _addr, _data in
+              _repeat(pool, count)]
+    _template = Template('{rel:9.4f} {addr} {uuid} {nt}')
+    _base_time = time() - 1
+    _start = perf_counter()
+    for _o_datagram in _items:
+        _template(_o_datagram, _base_time)
+    return perf_counter() - _start
+
+
+class _PoolSocket:
+    """Stands in for a network socket and returns datagrams from a pool."""
+
+    def __init__(self, items, end):
+        self._next = iter(items).__next__
+        self._end = end
+
+    def recvmsg(self, bufsize, ancbufsize=0):  # pylint: disable=W0613
+        """Return the next datagram and raise end if there is no more."""
+        try:
+            _data, _addr = self._next()
+        except StopIteration:
+            raise self._end   # pylint: disable=raise-missing-from
+        return _data, [], 0, _addr
+
+    def setsockopt(self, *args):
+        """Options are not needed."""
+
+    def bind(self, addr):
+        """There is no network."""
+
+    def close(self):
+        """There is nothing to close."""
+
+    def settimeout(self, timeout):
+        """Timeouts are not needed."""
+
+    def sendto(self, data, addr):
+        """Requests are not send."""
+
+
+def bench_dedupe(pool, count):
+    """Get unique responses from a search with many repeated devices."""
+    _items = [(_data, _addr) for _addr, _data in _repeat(pool, count)]
+    with mock.patch('muca.upnp.Search.socket.socket',
+                    return_value=_PoolSocket(_items, socket.timeout())):
+        _o_search = MsearchDevice()
+    _o_search.request(retries=1)
+    _start = perf_counter()
+    while _o_search.get() is not None:
+        pass
+    return perf_counter() - _start
+
+
+def _listen_get(pool, count, metrics):
+    """Receive and format datagrams with Listen."""
+    _items = [(_data, _addr) for _addr, _data in _repeat(pool, count)]
+    with mock.patch('muca.upnp.Listen.socket.socket',
+                    return_value=mock.Mock()):
+        _o_listen = Listen(metrics=metrics)
+        _o_listen.open()
+    _o_listen._sock = _PoolSocket(  # pylint: disable=protected-access
+        _items, KeyboardInterrupt())
+    _start = perf_counter()
+    while _o_listen.get() is not None:
+        pass
+    return perf_counter() - _start
+
+
+def bench_listen_get(pool, count):
+    """Receive and format datagrams with Listen."""
+    return _listen_get(pool, count, None)
+
+
+def bench_listen_metrics(pool, count):
+    """Receive and format datagrams with Listen and metrics."""
+    return _listen_get(pool, count, Metrics())
+
+
+def bench_listen_pipeline(pool, count):
+    """Receive datagrams and format them in worker processes.
+
+    The time includes forking the workers.
+    """
+    _items = [(_data, _addr) for _addr, _data in _repeat(pool, count)]
+    _start = perf_counter()
+    with mock.patch('muca.upnp.Listen.socket.socket',
+                    return_value=_PoolSocket(_items, KeyboardInterrupt())):
+        _o_listen = ListenPipeline()
+        _o_listen.open()
+    while _o_listen.get() is not None:
+        pass
+    return perf_counter() - _start
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'filter': bench_filter,
+    'fdevice_short': bench_fdevice_short,
+    'fdevice_verbose': bench_fdevice_verbose,
+    'template': bench_template,
+    'dedupe': bench_dedupe,
+    'listen_get': bench_listen_get,
+    'listen_metrics': bench_listen_metrics,
+    'listen_pipeline': bench_listen_pipeline,
+}
+
+
+def run(count=100000, repeat=3, names=None):
+    """Run the benchmarks and return the results as dictionary.
+
+    The best time of the repeats is used for every benchmark.
+    """
+    _pool = synthetic(count)
+    _results = {}
+    for _name, _bench in BENCHMARKS.items():
+        if names and _name not in names:
+            continue
+        _seconds = min(_bench(_pool, count) for _ in range(repeat))
+        _results[_name] = {
+            'count': count,
+            'seconds': _seconds,
+            'ns_per_op': _seconds / count * 1e9,
+            'ops_per_sec': count / _seconds if _seconds else 0.0}
+    return {
+        'meta': {
+            'build': build(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'timestamp': time(),
+            'count': count,
+            'repeat': repeat},
+        'results': _results}
+
+
+def compare(base, new, threshold=10.0):
+    """Compare two benchmark results.
+
+    Arguments: base, new = results from run()
+               threshold = allowed slowdown in percent
+    Returns: list of tuples (name, base ns/op, new ns/op, change in percent,
+             regression) for benchmarks in both results
+    """
+    _rows = []
+    for _name, _result in new['results'].items():
+        if _name not in base['results']:
+            continue
+        _base = base['results'][_name]['ns_per_op']
+        _new = _result['ns_per_op']
+        _change = (_new - _base) / _base * 100 if _base else 0.0
+        _rows.append((_name, _base, _new, _change, _change > threshold))
+    return _rows
+
+
+def main():
+    """This is the entry point of the benchmarks and the command line parser"""
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks for parse, dedupe and format hot paths')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_run = subparsers.add_parser('run', help='run the benchmarks')
+    parser_run.add_argument("-n", "--count", type=int, default=100000,
+                            help="number of datagrams for every benchmark")
+    parser_run.add_argument("-r", "--repeat", type=int, default=3,
+                            help="number of repeats, the best is used")
+    parser_run.add_argument("-b", "--bench", action="append",
+                            choices=sorted(BENCHMARKS),
+                            help="run only this benchmark, may be repeated")
+    parser_run.add_argument("-o", "--output", metavar="FILE",
+                            help="write the results as JSON to the file "
+                            "instead of stdout")
+    parser_compare = subparsers.add_parser(
+        'compare', help='compare two result files')
+    parser_compare.add_argument("base", help="JSON results to compare with")
+    parser_compare.add_argument("new", help="new JSON results")
+    parser_compare.add_argument("-t", "--threshold", type=float, default=10.0,
+                                help="allowed slowdown in percent")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        _results = run(args.count, args.repeat, args.bench)
+        if args.output:
+            with open(args.output, 'w') as _file:
+                json.dump(_results, _file, indent=2)
+        else:
+            json.dump(_results, sys.stdout, indent=2)
+            print()
+        for _name, _result in _results['results'].items():
+            print('{:<16} {:>12.1f} ns/op {:>12.0f} ops/s'.format(
+                _name, _result['ns_per_op'], _result['ops_per_sec']),
+                  file=sys.stderr)
+    else:
+        with open(args.base) as _file:
+            _base = json.load(_file)
+        with open(args.new) as _file:
+            _new = json.load(_file)
+        _regression = False
+        for _name, _base_ns, _new_ns, _change, _slower in compare(
+                _base, _new, args.threshold):
+            _regression = _regression or _slower
+            print('{:<16} {:>12.1f} {:>12.1f} ns/op {:>+8.1f}% {}'.format(
+                _name, _base_ns, _new_ns, _change,
+                'REGRESSION' if _slower else ''))
+        if _regression:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,60 @@
+"""Program with subcommands for all tools, start it with 'python3 -m muca'.
+
+    muca search ...     search for UPnP devices, like upnpsearch
+    muca listen ...     listen to UPnP datagrams, like upnplisten
+    muca daemon ...     run or query the device daemon, like mucad
+    muca monitor ...    monitor multicast groups, like mcastmon
+
+The module of a subcommand is imported only when the subcommand runs. This
+module imports nothing else, so the program starts fast when it is called
+often from scripts. benchmarks.Startup checks the import time.
+"""
+
+import sys
+
+# subcommand -> (module with a main(argv, prog) function, description)
+COMMANDS = {
+    'search': ('muca.upnp.Search', 'search for UPnP devices'),
+    'listen': ('muca.upnp.Listen', 'passive listen to UPnP datagrams'),
+    'daemon': ('muca.upnp.Daemon', 'keep the state of UPnP devices for local'
+               ' clients'),
+    'monitor': ('muca.Monitor', 'throughput and loss of multicast groups'),
+}
+
+
+def usage(prog='muca'):
+    """This returns the help text of the program."""
+    _lines = ['usage: {} [-h] [-V] COMMAND ...'.format(prog), '',
+              'commands:']
+    _lines.extend('  {:<10}{}'.format(_command, _description)
+                  for _command, (_, _description) in COMMANDS.items())
+    _lines.extend(['', "'{} COMMAND -h' shows the options of a command."
+                   .format(prog)])
+    return '\n'.join(_lines)
+
+
+def main(argv=None, prog='muca'):
+    """This is the entry point of the program and the subcommand dispatcher
+
+    Arguments: argv = command line arguments, default are the arguments of
+               the program
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage(prog))
+        return
+    if argv[0] in ('-V', '--version'):
+        # pylint: disable=import-outside-toplevel
+        from muca.Common import build
+        print("Build", build())
+        return
+    if argv[0] not in COMMANDS:
+        print(usage(prog).partition('\n')[0], file=sys.stderr)
+        print("{}: error: unknown command '{}'".format(prog, argv[0]),
+              file=sys.stderr)
+        raise SystemExit(2)
+    _module = __import__(COMMANDS[argv[0]][0], fromlist=['main'])
+    _module.main(argv[1:], prog='{} {}'.format(prog, argv[0]))
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
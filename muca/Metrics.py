@@ -0,0 +1,184 @@
+"""Counters and latency histograms for the hot paths.
+
+A Metrics object is given to the objects that should be measured. Without it
+the hot paths only check for None. The values are available as dictionary,
+as summary for printing and in the Prometheus text format, that can be
+written periodically to a file for the textfile collector of the node
+exporter.
+
+reference for the export format:
+[Prometheus text format](https://prometheus.io/docs/instrumenting/exposition_formats/)
+"""
+
+import os
+import threading
+from bisect import bisect_left
+
+
+class Histogram:
+    """Histogram of latencies in seconds with fixed buckets."""
+    # Upper bounds of the buckets (in sec).
+    BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+               1e-3, 1e-2, 1e-1)
+
+    def __init__(self):
+        """Setup empty buckets."""
+        # The last bucket counts values above all bounds.
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Count a value."""
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values of another histogram with the same buckets."""
+        self.counts = [_count + _other for _count, _other
+                       in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        if other.max > self.max:
+            self.max = other.max
+
+    def stats(self):
+        """This returns the histogram as dictionary."""
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'buckets': dict(zip(self.BUCKETS + (float('inf'),),
+                                self.counts))}
+
+
+class Metrics:
+    """Counters and histograms with names.
+
+    Counters and histograms are created on first use. Names are without
+    prefix and unit suffix, for example 'datagrams_received' or 'parse'.
+    Histograms measure seconds.
+    """
+
+    def __init__(self, prefix='muca'):
+        """Setup empty metrics.
+
+        Arguments: prefix = prefix of the names in the Prometheus export
+        """
+        self._prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._export = None
+
+    def count(self, name, value=1):
+        """Increment a counter."""
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """Add a latency to a histogram."""
+        _histogram = self._histograms.get(name)
+        if _histogram is None:
+            _histogram = self._histograms[name] = Histogram()
+        _histogram.observe(seconds)
+
+    def merge(self, other):
+        """Add the counters and histograms of another Metrics object, for
+        example from a worker process."""
+        for _name, _value in other._counters.items():
+            self.count(_name, _value)
+        for _name, _other in other._histograms.items():
+            _histogram = self._histograms.get(_name)
+            if _histogram is None:
+                _histogram = self._histograms[_name] = Histogram()
+            _histogram.merge(_other)
+
+    def counter(self, name):
+        """This returns the value of a counter."""
+        return self._counters.get(name, 0)
+
+    def histogram(self, name):
+        """This returns a histogram or None if it has no values."""
+        return self._histograms.get(name)
+
+    def stats(self):
+        """This returns all counters and histograms as dictionary."""
+        return {
+            'counters': dict(self._counters),
+            'histograms': {_name: _histogram.stats() for _name, _histogram
+                           in list(self._histograms.items())}}
+
+    def fstats(self):
+        """This returns a summary formated for printing."""
+        _lines = ['{}: {}'.format(_name, _value)
+                  for _name, _value in sorted(self._counters.items())]
+        for _name, _histogram in sorted(self._histograms.items()):
+            _stats = _histogram.stats()
+            _lines.append('{}: count {} mean {:.1f}us max {:.1f}us'.format(
+                _name, _stats['count'], _stats['mean'] * 1e6,
+                _stats['max'] * 1e6))
+        return '\n'.join(_lines)
+
+    def prometheus(self):
+        """This returns all metrics in the Prometheus text format."""
+        _lines = []
+        for _name, _value in sorted(list(self._counters.items())):
+            _name = '{}_{}_total'.format(self._prefix, _name)
+            _lines.append('# TYPE {} counter'.format(_name))
+            _lines.append('{} {}'.format(_name, _value))
+        for _name, _histogram in sorted(list(self._histograms.items())):
+            _name = '{}_{}_seconds'.format(self._prefix, _name)
+            _counts = list(_histogram.counts)
+            _lines.append('# TYPE {} histogram'.format(_name))
+            _cumulative = 0
+            for _bound, _count in zip(_histogram.BUCKETS, _counts):
+                _cumulative += _count
+                _lines.append('{}_bucket{{le="{}"}} {}'.format(
+                    _name, _bound, _cumulative))
+            _lines.append('{}_bucket{{le="+Inf"}} {}'.format(
+                _name, sum(_counts)))
+            _lines.append('{}_sum {}'.format(_name, _histogram.sum))
+            _lines.append('{}_count {}'.format(_name, sum(_counts)))
+        return '\n'.join(_lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """Write the Prometheus text format to a file.
+
+        The file is replaced atomically, so a collector never reads a
+        partly written file.
+        """
+        _tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(_tmpname, 'w') as _file:
+            _file.write(self.prometheus())
+        os.replace(_tmpname, filename)
+
+    def start_export(self, filename, interval=10):
+        """Write the Prometheus text format periodically to a file.
+
+        The file is written by a background thread every interval (in sec).
+        """
+        self.stop_export()
+        _stop = threading.Event()
+
+        def _export():
+            while not _stop.wait(interval):
+                self.write_prometheus(filename)
+        self._export = (_stop, threading.Thread(target=_export, daemon=True),
+                        filename)
+        self._export[1].start()
+
+    def stop_export(self):
+        """Stop the periodic export and write the file a last time."""
+        if self._export is None:
+            return
+        _stop, _thread, _filename = self._export
+        self._export = None
+        _stop.set()
+        _thread.join()
+        self.write_prometheus(_filename)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
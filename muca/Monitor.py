@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""Monitor many multicast groups, for example IPTV streams.
+
+Every group is received and counted without looking into the payload. For
+every group the packet rate and bitrate since the last report, the gaps and
+the jitter of the arrival times and the datagrams dropped by the kernel are
+reported:
+
+    mcastmon 239.1.1.1:5000 239.1.1.2:5000 --interval 5
+
+A gap is a pause between two packets longer than --gap. The jitter is
+estimated like the interarrival jitter of RTP (RFC 3550) but without sender
+timestamps, from the difference of two successive intervals. It is small
+for streams with a constant packet rate.
+
+With --analyze the payload is checked as MPEG transport stream, see
+muca.Mpegts: continuity counter errors, the ratio of null packets, the
+maximal PCR interval and the PCR jitter are reported additionally.
+"""
+
+import sys
+import json
+import socket
+import argparse
+from time import time_ns, monotonic
+
+from muca.Common import build
+from muca.upnp.Common import Mcast, ANCBUFSIZE
+
+
+def parse_group(text):
+    """Parse a multicast group with port, for example '239.1.1.1:5000'.
+
+    Returns: tuple (group, port)
+    Raises: ValueError if it is not an IPv4 multicast group with port
+    """
+    _group, _, _port = text.rpartition(':')
+    try:
+        _octets = socket.inet_aton(_group)
+    except OSError:
+        raise ValueError('invalid group "{}"'.format(text)) from None
+    if not _group or not 224 <= _octets[0] <= 239:
+        raise ValueError('no multicast group "{}"'.format(text))
+    if not _port.isdigit() or not 0 < int(_port) < 65536:
+        raise ValueError('invalid port in "{}"'.format(text))
+    return _group, int(_port)
+
+
+class GroupStats:
+    """Counters of the packets received from one multicast group.
+
+    Times are kernel receive times in nanoseconds.
+    """
+    __slots__ = ('group', 'port', 'packets', 'bytes', 'dropped', 'truncated',
+                 'gaps', 'max_gap', 'jitter', 'analyzer', '_gap', '_last',
+                 '_interval', '_mark')
+
+    def __init__(self, group, port, gap):
+        """Setup zero counters.
+
+        Arguments: gap = pause between two packets (in sec) counted as gap
+        """
+        self.group = group
+        self.port = port
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.gaps = 0
+        self.max_gap = 0
+        self.jitter = 0.0
+        # muca.Mpegts.TsAnalyzer of the payload or None
+        self.analyzer = None
+        self._gap = int(gap * 1e9)
+        self._last = 0
+        self._interval = 0
+        # (time, packets, bytes) of the last report
+        self._mark = (0, 0, 0)
+
+    def observe(self, size, rxtime):
+        """Count a packet of size bytes received at rxtime."""
+        self.packets += 1
+        self.bytes += size
+        _last = self._last
+        self._last = rxtime
+        if not _last:
+            return
+        _interval = rxtime - _last
+        if _interval > self.max_gap:
+            self.max_gap = _interval
+        if _interval > self._gap:
+            self.gaps += 1
+        if self._interval:
+            self.jitter += (abs(_interval - self._interval) - self.jitter) / 16
+        self._interval = _interval
+
+    def mark(self, now):
+        """Start the measuring of the rates at now."""
+        self._mark = (now, self.packets, self.bytes)
+
+    def rates(self, now):
+        """This returns the packet rate (per sec) and bitrate (bit per sec)
+        since the last call and starts a new measuring."""
+        _then, _packets, _bytes = self._mark
+        self._mark = (now, self.packets, self.bytes)
+        _seconds = (now - _then) / 1e9
+        if _seconds <= 0:
+            return 0.0, 0.0
+        return (self.packets - _packets) / _seconds, \
+            (self.bytes - _bytes) * 8 / _seconds
+
+    def stats(self):
+        """This returns the counters as dictionary, times in seconds.
+
+        With an analyzer its counters are added.
+        """
+        _stats = {
+            'group': '{}:{}'.format(self.group, self.port),
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'dropped': self.dropped,
+            'truncated': self.truncated,
+            'gaps': self.gaps,
+            'max_gap': self.max_gap / 1e9,
+            'jitter': self.jitter / 1e9}
+        if self.analyzer is not None:
+            _stats.update(self.analyzer.stats())
+        return _stats
+
+
+class Monitor(Mcast):
+    """Receive many multicast groups and count their packets.
+
+    Every (group, port) has its own socket bound to the group, so the kernel
+    delivers only this group to it and counts its drops. All sockets are
+    non-blocking and serviced by one selector, that is epoll on Linux. A
+    readable socket is drained into a preallocated ring of receive buffers
+    with recvmsg_into(), so a burst needs one wakeup and no allocations. The
+    size and the kernel receive time of a packet are counted. With analyze
+    the whole batch is given to the TsAnalyzer of the group.
+    """
+    # Maximal size of a datagram. IPTV has up to 7 MPEG-TS packets of 188
+    # bytes in a datagram.
+    RECVBUF = 2048
+    # Maximal number of datagrams received from one socket per wakeup, so a
+    # busy group cannot starve the others.
+    DRAIN = 64
+    # Pause between two packets (in sec) that is counted as gap.
+    GAP = 0.1
+
+    _groups = ()
+    _socks = ()
+    _ring = None
+    _slots = None
+
+    def __init__(self, groups, rcvbuf=None, gap=None, metrics=None,
+                 analyze=False):
+        """Setup the groups to receive.
+
+        Arguments: groups = list of tuples (group, port)
+                   rcvbuf = size of the kernel receive buffer of every
+                   socket, see Mcast.RCVBUF
+                   gap = see GAP
+                   metrics = muca.Metrics.Metrics or None
+                   analyze = check the payload as MPEG transport stream
+        """
+        if rcvbuf is not None:
+            self.RCVBUF = rcvbuf
+        _gap = self.GAP if gap is None else gap
+        self._groups = [GroupStats(_group, _port, _gap)
+                        for _group, _port in groups]
+        self._metrics = metrics
+        if analyze:
+            # pylint: disable=import-outside-toplevel
+            from muca.Mpegts import TsAnalyzer
+            for _stats in self._groups:
+                _stats.analyzer = TsAnalyzer()
+
+    def open(self):
+        """Open a socket for every group and join to it."""
+        self._selector = None
+        self._socks = []
+        self._ring = bytearray(self.RECVBUF * self.DRAIN)
+        _ring = memoryview(self._ring)
+        # Every slot is a list with one buffer for recvmsg_into().
+        self._slots = [[_ring[i:i+self.RECVBUF]] for i in
+                       range(0, self.RECVBUF * self.DRAIN, self.RECVBUF)]
+        for _stats in self._groups:
+            _sock = self._open4(_stats.group, _stats.port)
+            _sock.setblocking(False)
+            self._socks.append(_sock)
+            self._register(_sock, _stats)
+        _now = time_ns()
+        for _stats in self._groups:
+            _stats.mark(_now)
+
+    def close(self):
+        """Close the sockets and the selector."""
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        for _sock in self._socks:
+            _sock.close()
+        self._socks = []
+
+    def poll(self, timeout=None):
+        """Receive the datagrams queued on the next readable socket.
+
+        Returns: number of received datagrams, 0 if no socket is readable
+                 within the timeout (in sec)
+        """
+        try:
+            _key = self._select(timeout)
+        except socket.timeout:
+            return 0
+        _sock = _key.fileobj
+        _stats = _key.data
+        _recv = _sock.recvmsg_into
+        _analyzer = _stats.analyzer
+        # offset in the ring, size and receive time of every datagram
+        _starts = []
+        _sizes = []
+        _rxtimes = []
+        _count = 0
+        _bytes = 0
+        for _index, _slot in enumerate(self._slots):
+            try:
+                _nbytes, _ancdata, _flags, _ = _recv(_slot, ANCBUFSIZE)
+            except BlockingIOError:
+                break
+            _rxtime = None
+            if _ancdata:
+                _dropped = self.dropped
+                _rxtime = self._ancillary(_sock, _ancdata)
+                _stats.dropped += self.dropped - _dropped
+            if _flags & socket.MSG_TRUNC:
+                # Streams are not logged for every truncated datagram.
+                _stats.truncated += 1
+                self.truncated += 1
+                continue
+            if _rxtime is None:
+                _rxtime = time_ns()
+            _stats.observe(_nbytes, _rxtime)
+            _count += 1
+            _bytes += _nbytes
+            if _analyzer is not None:
+                _starts.append(_index * self.RECVBUF)
+                _sizes.append(_nbytes)
+                _rxtimes.append(_rxtime)
+        if _starts:
+            _analyzer.analyze(self._ring, _starts, _sizes, _rxtimes)
+        if self._metrics is not None and _count:
+            self._metrics.count('datagrams_received', _count)
+            self._metrics.count('bytes_received', _bytes)
+        return _count
+
+    def run(self, seconds):
+        """Receive from all groups for some seconds."""
+        _end = monotonic() + seconds
+        _tout = seconds
+        while _tout > 0:
+            self.poll(_tout)
+            _tout = _end - monotonic()
+
+    def stats(self):
+        """This returns the counters of all groups as list of dictionaries."""
+        return [_stats.stats() for _stats in self._groups]
+
+    def report(self, now=None):
+        """This returns the counters of all groups with the rates since the
+        last report as list of dictionaries."""
+        if now is None:
+            now = time_ns()
+        _report = []
+        for _stats in self._groups:
+            _record = _stats.stats()
+            _record['rate'], _record['bitrate'] = _stats.rates(now)
+            _report.append(_record)
+        return _report
+
+    def freport(self, now=None):
+        """This returns the report formated for printing.
+
+        The columns of the analysis follow if the payload is analyzed.
+        """
+        _analyzed = any(_stats.analyzer is not None for _stats in self._groups)
+        _lines = ['{:<21} {:>8} {:>9} {:>6} {:>9} {:>8} {:>8}'.format(
+            'group', 'pkt/s', 'Mbit/s', 'gaps', 'max gap', 'jitter',
+            'dropped')]
+        if _analyzed:
+            _lines[0] += ' {:>7} {:>6} {:>9} {:>8} {:>8}'.format(
+                'cc err', 'null', 'max pcr', 'pcr jit', 'rtp lost')
+        for _record in self.report(now):
+            _line = '{:<21} {:>8.1f} {:>9.3f} {:>6} {:>7.1f}ms {:>6.2f}ms ' \
+                '{:>8}'.format(_record['group'], _record['rate'],
+                               _record['bitrate'] / 1e6, _record['gaps'],
+                               _record['max_gap'] * 1e3,
+                               _record['jitter'] * 1e3,
+                               _record['dropped'] + _record['truncated'])
+            if 'cc_errors' in _record:
+                _line += ' {:>7} {:>5.1f}% {:>7.1f}ms {:>6.2f}ms {:>8}'.format(
+                    _record['cc_errors'], _record['null_ratio'] * 100,
+                    _record['pcr_max_interval'] * 1e3,
+                    _record['pcr_max_jitter'] * 1e3, _record['rtp_lost'])
+            _lines.append(_line)
+        return '\n'.join(_lines) + '\n'
+
+
+def main(argv=None, prog=None):
+    """This is the entry point of the program and the command line parser
+
+    Arguments: argv = command line arguments, default are the arguments of
+               the program
+               prog = name of the program in the help text
+    """
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Monitor the throughput and loss of multicast groups, '
+        'stop with <ctrl>+C')
+    parser.add_argument("groups", nargs="*", metavar="GROUP:PORT",
+                        help="IPv4 multicast group with port, for example "
+                        "239.1.1.1:5000")
+    parser.add_argument("-V", "--version", action="store_true",
+                        help="show program version")
+    parser.add_argument("-i", "--interval", type=float, default=1,
+                        metavar="SEC", help="interval of the reports "
+                        "(default: 1)")
+    parser.add_argument("-f", "--format", choices=('text', 'ndjson'),
+                        default='text', help="output format of the reports "
+                        "(default: text)")
+    parser.add_argument("-a", "--analyze", action="store_true",
+                        help="check the payload as MPEG transport stream in "
+                        "UDP or RTP: continuity counters, null packets and "
+                        "PCR intervals, vectorized if NumPy is installed")
+    parser.add_argument("--gap", type=float, default=Monitor.GAP,
+                        metavar="SEC", help="pause between two packets "
+                        "counted as gap (default: {})".format(Monitor.GAP))
+    parser.add_argument("--rcvbuf", type=int, metavar="BYTES",
+                        help="size of the kernel receive buffer of every "
+                        "group, a larger buffer drops less packets on bursts")
+    args = parser.parse_args(argv)
+    if args.version:
+        print("Build", build())
+        return
+    if not args.groups:
+        parser.error("no group given")
+    _groups = []
+    for _text in args.groups:
+        try:
+            _groups.append(parse_group(_text))
+        except ValueError as err:
+            parser.error(str(err))
+
+    o_monitor = Monitor(_groups, rcvbuf=args.rcvbuf, gap=args.gap,
+                        analyze=args.analyze)
+    try:
+        o_monitor.open()
+    except OSError as err:
+        raise SystemExit("ERROR: {}".format(err))
+    try:
+        while True:
+            o_monitor.run(args.interval)
+            if args.format == 'ndjson':
+                for _record in o_monitor.report():
+                    print(json.dumps(_record, separators=(',', ':')),
+                          flush=True)
+            else:
+                print(o_monitor.freport(), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        o_monitor.close()
+    for _record in o_monitor.stats():
+        print('{group} packets: {packets} gaps: {gaps} dropped: {dropped} '
+              'truncated: {truncated}'.format(**_record) + (
+                  ' sync errors: {sync_errors} cc errors: {cc_errors} '
+                  'pcr late: {pcr_late} rtp lost: {rtp_lost}'.format(
+                      **_record) if 'cc_errors' in _record else ''),
+              file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,313 @@
+"""Analysis of MPEG transport streams in multicast datagrams, for example IPTV.
+
+A datagram has up to seven TS packets of 188 bytes, directly in UDP or after
+a RTP header. For every batch of datagrams of a stream the analyzer checks:
+sync        every TS packet starts with 0x47 and a datagram has only whole
+            packets
+continuity  the continuity counter of every PID increments with every packet
+            with payload. A repeated counter is a duplicate packet and no
+            error. The discontinuity indicator resets the check.
+null        ratio of null packets (PID 0x1FFF), the stuffing of a constant
+            bitrate
+PCR         interval between the program clock references of a PID, ISO/IEC
+            13818-1 requires at most 100 ms, DVB recommends 40 ms, and the
+            jitter between the PCR interval and the interval of the receive
+            times
+RTP         datagrams lost by the sequence numbers
+
+With NumPy the receive buffer is viewed as array without copying. Only the
+header bytes of the TS packets of a whole batch are gathered and checked by
+vectorized operations. Without NumPy the packets are checked one by one,
+that is enough for a few streams on a desktop.
+
+references:
+ISO/IEC 13818-1 Generic coding of moving pictures, Systems
+[ETSI TR 101 290](https://www.etsi.org/deliver/etsi_tr/101200_101299/101290/)
+[RFC 3550 RTP](https://www.rfc-editor.org/rfc/rfc3550)
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SYNC = 0x47
+PACKET = 188
+NULL_PID = 0x1fff
+# The program clock reference has a 33 bit base of 90 kHz and a 9 bit
+# extension to 27 MHz.
+_PCR_WRAP = (1 << 33) * 300
+_PCR_CLOCK = 27000000
+
+
+def payload_offset(data, size):
+    """This returns the offset of the TS packets in a datagram.
+
+    Arguments: data = buffer with the datagram
+               size = length of the datagram
+    Returns: tuple (offset, RTP sequence number or None without RTP header)
+    """
+    if size < 12 or data[0] == SYNC or data[0] & 0xc0 != 0x80:
+        return 0, None
+    _offset = 12 + 4 * (data[0] & 0x0f)
+    # header extension
+    if data[0] & 0x10 and size >= _offset + 4:
+        _offset += 4 + 4 * ((data[_offset+2] << 8) | data[_offset+3])
+    return _offset, (data[2] << 8) | data[3]
+
+
+def read_pcr(data, pos):
+    """This returns the program clock reference at pos in 27 MHz ticks."""
+    _base = (data[pos] << 25) | (data[pos+1] << 17) | (data[pos+2] << 9) \
+        | (data[pos+3] << 1) | (data[pos+4] >> 7)
+    return _base * 300 + (((data[pos+4] & 1) << 8) | data[pos+5])
+
+
+class TsAnalyzer:
+    """Continuity and timing analysis of one MPEG transport stream.
+
+    analyze() is called with batches of received datagrams, the counters are
+    available with stats().
+    """
+    # Maximal interval between two PCRs of a PID (in sec), larger intervals
+    # are counted as late.
+    PCR_INTERVAL = 0.04
+
+    def __init__(self, vectorized=None):
+        """Setup zero counters.
+
+        Arguments: vectorized = check with NumPy, default is True if NumPy
+                   is installed
+        Raises: ValueError if vectorized is True without NumPy
+        """
+        if vectorized is None:
+            vectorized = numpy is not None
+        elif vectorized and numpy is None:
+            raise ValueError('vectorized analysis needs NumPy')
+        self.vectorized = vectorized
+        self.datagrams = 0
+        self.packets = 0
+        self.sync_errors = 0
+        self.transport_errors = 0
+        self.cc_errors = 0
+        self.null_packets = 0
+        self.rtp_lost = 0
+        self.pcrs = 0
+        self.pcr_late = 0
+        self.pcr_max_interval = 0.0
+        self.pcr_max_jitter = 0.0
+        self._pcr_intervals = 0
+        self._pcr_jitter = 0.0
+        self._rtp_seq = None
+        # pid -> (last PCR, its receive time)
+        self._last_pcr = {}
+        if vectorized:
+            # last continuity counter of every PID, -1 if not seen
+            self._last_cc = numpy.full(NULL_PID + 1, -1, numpy.int16)
+            self._pids = numpy.zeros(NULL_PID + 1, bool)
+        else:
+            self._last_cc = {}
+            self._pids = set()
+
+    def analyze(self, buffer, starts, sizes, rxtimes):
+        """Analyze a batch of datagrams.
+
+        Arguments: buffer = receive buffer with the datagrams
+                   starts = offsets of the datagrams in the buffer
+                   sizes = lengths of the datagrams
+                   rxtimes = receive times of the datagrams in nanoseconds
+        """
+        self.datagrams += len(sizes)
+        if self.vectorized:
+            self._analyze_arrays(buffer, starts, sizes, rxtimes)
+            return
+        _view = memoryview(buffer)
+        # (offset of the first TS packet, number of packets, receive time)
+        _batch = []
+        for _start, _size, _rxtime in zip(starts, sizes, rxtimes):
+            _offset, _seq = payload_offset(_view[_start:_start+_size], _size)
+            if _seq is not None:
+                self._rtp(_seq)
+            _count, _rest = divmod(_size - _offset, PACKET)
+            if _rest:
+                self.sync_errors += 1
+            if _count > 0:
+                _batch.append((_start + _offset, _count, _rxtime))
+        self._analyze_packets(_view, _batch)
+
+    def _rtp(self, seq):
+        """Count the datagrams lost before a RTP sequence number.
+
+        Reordered and duplicate datagrams are not counted.
+        """
+        if self._rtp_seq is not None:
+            _lost = (seq - self._rtp_seq - 1) & 0xffff
+            if _lost < 0x8000:
+                self.rtp_lost += _lost
+        self._rtp_seq = seq
+
+    def _pcr(self, pid, pcr, rxtime, discontinuity):
+        """Check the interval and jitter of a PCR."""
+        self.pcrs += 1
+        _last = self._last_pcr.get(pid)
+        self._last_pcr[pid] = (pcr, rxtime)
+        if _last is None or discontinuity:
+            return
+        _interval = ((pcr - _last[0]) % _PCR_WRAP) / _PCR_CLOCK
+        if _interval > self.pcr_max_interval:
+            self.pcr_max_interval = _interval
+        if _interval > self.PCR_INTERVAL:
+            self.pcr_late += 1
+        _jitter = abs((rxtime - _last[1]) / 1e9 - _interval)
+        if _jitter > self.pcr_max_jitter:
+            self.pcr_max_jitter = _jitter
+        self._pcr_intervals += 1
+        self._pcr_jitter += _jitter
+
+    def _analyze_packets(self, view, batch):
+        """Check the TS packets one by one."""
+        _last_cc = self._last_cc
+        for _start, _count, _rxtime in batch:
+            for _pos in range(_start, _start + _count * PACKET, PACKET):
+                if view[_pos] != SYNC:
+                    self.sync_errors += 1
+                    continue
+                self.packets += 1
+                _b1 = view[_pos+1]
+                _b3 = view[_pos+3]
+                if _b1 & 0x80:
+                    self.transport_errors += 1
+                _pid = ((_b1 & 0x1f) << 8) | view[_pos+2]
+                self._pids.add(_pid)
+                if _pid == NULL_PID:
+                    self.null_packets += 1
+                    continue
+                _discontinuity = False
+                # adaptation field with flags
+                if _b3 & 0x20 and view[_pos+4] > 0:
+                    _flags = view[_pos+5]
+                    _discontinuity = bool(_flags & 0x80)
+                    if _flags & 0x10 and view[_pos+4] >= 7:
+                        self._pcr(_pid, read_pcr(view, _pos + 6), _rxtime,
+                                  _discontinuity)
+                if _b3 & 0x10:
+                    _cc = _b3 & 0x0f
+                    _prev = _last_cc.get(_pid)
+                    if _prev is not None and not _discontinuity and \
+                            _cc != _prev and _cc != (_prev + 1) & 0x0f:
+                        self.cc_errors += 1
+                    _last_cc[_pid] = _cc
+
+    def _analyze_arrays(self, buffer, starts, sizes, rxtimes):
+        """Check all datagrams and TS packets of a batch with NumPy arrays.
+
+        The datagrams are checked like payload_offset() and _rtp().
+        """
+        np = numpy
+        _view = np.frombuffer(buffer, np.uint8)
+        _bases = np.array(starts, np.int64)
+        _sizes = np.array(sizes, np.int64)
+        _b0 = _view[_bases]
+        _rtp = (_sizes >= 12) & (_b0 != SYNC) & ((_b0 & 0xc0) == 0x80)
+        _offsets = np.where(_rtp, 12 + 4 * (_b0 & 0x0f).astype(np.int64), 0)
+        # Header extensions are rare, they are parsed one by one.
+        for _index in np.flatnonzero(_rtp & ((_b0 & 0x10) != 0)).tolist():
+            _start = starts[_index]
+            _offsets[_index] = payload_offset(
+                memoryview(buffer)[_start:_start+sizes[_index]],
+                sizes[_index])[0]
+        _rtp = _bases[_rtp]
+        if len(_rtp):
+            _seq = (_view[_rtp + 2].astype(np.int32) << 8) | _view[_rtp + 3]
+            _prev = np.empty_like(_seq)
+            _prev[1:] = _seq[:-1]
+            _prev[0] = _seq[0] - 1 if self._rtp_seq is None \
+                else self._rtp_seq
+            _lost = (_seq - _prev - 1) & 0xffff
+            self.rtp_lost += int(_lost[_lost < 0x8000].sum())
+            self._rtp_seq = int(_seq[-1])
+        _counts, _rest = np.divmod(_sizes - _offsets, PACKET)
+        self.sync_errors += int(np.count_nonzero(_rest))
+        _counts = np.maximum(_counts, 0)
+        if not _counts.any():
+            return
+        # offset of every TS packet in the buffer
+        _first = np.repeat(np.cumsum(_counts) - _counts, _counts)
+        _starts = np.repeat(_bases + _offsets, _counts) + \
+            (np.arange(len(_first)) - _first) * PACKET
+        _rxtimes = np.repeat(np.array(rxtimes, np.int64), _counts)
+        _sync = _view[_starts] == SYNC
+        _synced = int(np.count_nonzero(_sync))
+        self.sync_errors += len(_starts) - _synced
+        if _synced < len(_starts):
+            _starts = _starts[_sync]
+            _rxtimes = _rxtimes[_sync]
+        self.packets += _synced
+        _b1 = _view[_starts + 1]
+        _b3 = _view[_starts + 3]
+        self.transport_errors += int(np.count_nonzero(_b1 & 0x80))
+        _pid = ((_b1 & 0x1f).astype(np.int32) << 8) | _view[_starts + 2]
+        self._pids[_pid] = True
+        _null = _pid == NULL_PID
+        self.null_packets += int(np.count_nonzero(_null))
+        # adaptation fields with flags
+        _adaptation = np.flatnonzero(((_b3 & 0x20) != 0) & ~_null)
+        _length = _view[_starts[_adaptation] + 4]
+        _adaptation = _adaptation[_length > 0]
+        _length = _length[_length > 0]
+        _flags = _view[_starts[_adaptation] + 5]
+        _discontinuity = np.zeros(len(_starts), bool)
+        _discontinuity[_adaptation[(_flags & 0x80) != 0]] = True
+        # The packets with payload are ordered by PID, the order within a
+        # PID is kept, so every packet is compared to its predecessor.
+        _payload = np.flatnonzero(((_b3 & 0x10) != 0) & ~_null)
+        if len(_payload):
+            _order = _payload[np.argsort(_pid[_payload], kind='stable')]
+            _pids = _pid[_order]
+            _cc = (_b3[_order] & 0x0f).astype(np.int16)
+            _head = np.empty(len(_pids), bool)
+            _head[0] = True
+            _head[1:] = _pids[1:] != _pids[:-1]
+            _prev = np.empty(len(_pids), np.int16)
+            _prev[1:] = _cc[:-1]
+            _prev[_head] = self._last_cc[_pids[_head]]
+            _errors = (_prev >= 0) & (_cc != _prev) & \
+                (_cc != ((_prev + 1) & 0x0f)) & ~_discontinuity[_order]
+            self.cc_errors += int(np.count_nonzero(_errors))
+            _tail = np.empty(len(_pids), bool)
+            _tail[-1] = True
+            _tail[:-1] = _head[1:]
+            self._last_cc[_pids[_tail]] = _cc[_tail]
+        # There are only a few PCRs in a batch, they are checked in order.
+        _pcr = _adaptation[((_flags & 0x10) != 0) & (_length >= 7)]
+        if len(_pcr):
+            _bytes = _view[_starts[_pcr][:, None] + np.arange(6, 12)] \
+                .astype(np.int64)
+            _values = ((_bytes[:, 0] << 25) | (_bytes[:, 1] << 17)
+                       | (_bytes[:, 2] << 9) | (_bytes[:, 3] << 1)
+                       | (_bytes[:, 4] >> 7)) * 300 \
+                + (((_bytes[:, 4] & 1) << 8) | _bytes[:, 5])
+            for _index, _value in zip(_pcr.tolist(), _values.tolist()):
+                self._pcr(int(_pid[_index]), _value, int(_rxtimes[_index]),
+                          bool(_discontinuity[_index]))
+
+    def stats(self):
+        """This returns the counters as dictionary, times in seconds."""
+        return {
+            'ts_packets': self.packets,
+            'sync_errors': self.sync_errors,
+            'transport_errors': self.transport_errors,
+            'cc_errors': self.cc_errors,
+            'null_ratio': self.null_packets / self.packets
+                          if self.packets else 0.0,
+            'pids': int(numpy.count_nonzero(self._pids)) if self.vectorized
+                    else len(self._pids),
+            'rtp_lost': self.rtp_lost,
+            'pcrs': self.pcrs,
+            'pcr_late': self.pcr_late,
+            'pcr_max_interval': self.pcr_max_interval,
+            'pcr_max_jitter': self.pcr_max_jitter,
+            'pcr_mean_jitter': self._pcr_jitter / self._pcr_intervals
+                               if self._pcr_intervals else 0.0}
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,250 @@
+"""Read UDP datagrams from capture files in pcap or pcapng format.
+
+The capture file is memory-mapped and its records are decoded one by one, so
+the memory needed does not depend on the size of the file. No libpcap is
+needed.
+
+references for the file formats:
+[pcap](https://www.tcpdump.org/manpages/pcap-savefile.5.html)
+[pcapng](https://www.ietf.org/archive/id/draft-ietf-opsawg-pcapng-02.html)
+"""
+
+import mmap
+import socket
+import struct
+
+# link layer header types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+# DLT_RAW is 12 or 14 on some platforms
+_LINKTYPES_RAW = (12, 14, LINKTYPE_RAW)
+
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+_ETHERTYPES_VLAN = (0x8100, 0x88a8, 0x9100)
+_IPPROTO_UDP = 17
+
+_PCAP_MAGIC_USEC = 0xa1b2c3d4
+_PCAP_MAGIC_NSEC = 0xa1b23c4d
+_PCAPNG_SHB = 0x0a0d0d0a
+_PCAPNG_IDB = 0x00000001
+_PCAPNG_PB = 0x00000002
+_PCAPNG_SPB = 0x00000003
+_PCAPNG_EPB = 0x00000006
+_PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+_PCAPNG_OPT_IF_TSRESOL = 9
+
+
+def _ip_payload(linktype, frame):
+    """This returns the network layer packet of a captured frame.
+
+    Returns: tuple with (ethertype, offset of the packet in frame) or None if
+    the link type is not supported
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        _offset = 12
+        _ethertype = frame[12] << 8 | frame[13]
+        while _ethertype in _ETHERTYPES_VLAN and len(frame) >= _offset + 6:
+            _offset += 4
+            _ethertype = frame[_offset] << 8 | frame[_offset+1]
+        return _ethertype, _offset + 2
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        return frame[14] << 8 | frame[15], 16
+    if linktype == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20:
+            return None
+        return frame[0] << 8 | frame[1], 20
+    if linktype in _LINKTYPES_RAW:
+        if not frame:
+            return None
+        _version = frame[0] >> 4
+        return (_ETHERTYPE_IPV4 if _version == 4 else
+                _ETHERTYPE_IPV6 if _version == 6 else 0), 0
+    if linktype == LINKTYPE_NULL:
+        if len(frame) < 4:
+            return None
+        # The address family is in host byte order of the capturing machine.
+        _family = frame[0] if frame[0] != 0 else frame[3]
+        return (_ETHERTYPE_IPV4 if _family == 2 else
+                _ETHERTYPE_IPV6 if _family in (10, 24, 28, 30) else 0), 4
+    return None
+
+
+def udp_datagram(linktype, frame):
+    """This decodes a captured frame with an UDP datagram.
+
+    Fragmented IP packets and IPv6 extension headers are not supported.
+    Returns: tuple with (source address, destination address, payload) or
+    None if the frame does not contain an UDP datagram. The addresses are
+    tuples of (ip address, port).
+    """
+    _ip = _ip_payload(linktype, frame)
+    if _ip is None:
+        return None
+    _ethertype, _offset = _ip
+    if _ethertype == _ETHERTYPE_IPV4:
+        if len(frame) < _offset + 20:
+            return None
+        _ihl = (frame[_offset] & 0x0f) * 4
+        # skip invalid header lengths and truncated frames
+        if _ihl < 20 or len(frame) < _offset + _ihl + 8:
+            return None
+        # skip fragments, flag MF or fragment offset set
+        if frame[_offset+9] != _IPPROTO_UDP or \
+                (frame[_offset+6] & 0x3f) or frame[_offset+7]:
+            return None
+        _src = socket.inet_ntop(socket.AF_INET,
+                                frame[_offset+12:_offset+16])
+        _dst = socket.inet_ntop(socket.AF_INET,
+                                frame[_offset+16:_offset+20])
+        _offset += _ihl
+    elif _ethertype == _ETHERTYPE_IPV6:
+        if len(frame) < _offset + 40 or frame[_offset+6] != _IPPROTO_UDP:
+            return None
+        _src = socket.inet_ntop(socket.AF_INET6,
+                                frame[_offset+8:_offset+24])
+        _dst = socket.inet_ntop(socket.AF_INET6,
+                                frame[_offset+24:_offset+40])
+        _offset += 40
+    else:
+        return None
+    if len(frame) < _offset + 8:
+        return None
+    _sport, _dport, _length = struct.unpack_from('!HHH', frame, _offset)
+    return ((_src, _sport), (_dst, _dport),
+            frame[_offset+8:_offset+max(_length, 8)])
+
+
+def _pcap_frames(buf):
+    """This returns (linktype, timestamp, frame) for all records of a pcap."""
+    _magic = struct.unpack_from('<I', buf)[0]
+    _order = '<'
+    if _magic not in (_PCAP_MAGIC_USEC, _PCAP_MAGIC_NSEC):
+        _order = '>'
+        _magic = struct.unpack_from('>I', buf)[0]
+    _scale = 1e-9 if _magic == _PCAP_MAGIC_NSEC else 1e-6
+    _linktype = struct.unpack_from(_order + 'I', buf, 20)[0] & 0xffff
+    _record = struct.Struct(_order + 'IIII')
+    _size = len(buf)
+    _offset = 24
+    while _offset + 16 <= _size:
+        _sec, _frac, _incl_len, _ = _record.unpack_from(buf, _offset)
+        _offset += 16
+        if _offset + _incl_len > _size:
+            # truncated capture file
+            return
+        yield (_linktype, _sec + _frac * _scale,
+               buf[_offset:_offset+_incl_len])
+        _offset += _incl_len
+
+
+def _pcapng_frames(buf):
+    """This returns (linktype, timestamp, frame) for all packets of a pcapng.
+
+    A pcapng file may have more than one section with different byte order
+    and more than one interface with different link types and timestamp
+    resolution.
+    """
+    _size = len(buf)
+    _offset = 0
+    _order = '<'
+    _interfaces = []
+    while _offset + 12 <= _size:
+        _type = struct.unpack_from('<I', buf, _offset)[0]
+        if _type == _PCAPNG_SHB:
+            _order = '<' if struct.unpack_from(
+                '<I', buf, _offset + 8)[0] == _PCAPNG_BYTE_ORDER_MAGIC \
+                else '>'
+            _interfaces = []
+        else:
+            _type = struct.unpack_from(_order + 'I', buf, _offset)[0]
+        _length = struct.unpack_from(_order + 'I', buf, _offset + 4)[0]
+        if _length < 12 or _offset + _length > _size:
+            # truncated or corrupted capture file
+            return
+        _body = _offset + 8
+        _end = _offset + _length - 4
+        if _type == _PCAPNG_IDB:
+            _linktype = struct.unpack_from(_order + 'H', buf, _body)[0]
+            _interfaces.append((_linktype,
+                                _pcapng_tsresol(buf, _order, _body + 8, _end)))
+        elif _type == _PCAPNG_EPB or _type == _PCAPNG_PB:
+            if _type == _PCAPNG_EPB:
+                _ifid, _ts_high, _ts_low, _caplen, _ = struct.unpack_from(
+                    _order + 'IIIII', buf, _body)
+            else:
+                _ifid, _, _ts_high, _ts_low, _caplen, _ = struct.unpack_from(
+                    _order + 'HHIIII', buf, _body)
+            if _ifid < len(_interfaces):
+                _linktype, _tsresol = _interfaces[_ifid]
+                yield (_linktype, ((_ts_high << 32) | _ts_low) * _tsresol,
+                       buf[_body+20:_body+20+_caplen])
+        elif _type == _PCAPNG_SPB:
+            if _interfaces:
+                _caplen = min(struct.unpack_from(_order + 'I', buf, _body)[0],
+                              _end - _body - 4)
+                # A simple packet block has no timestamp.
+                yield _interfaces[0][0], 0.0, buf[_body+4:_body+4+_caplen]
+        _offset += _length
+
+
+def _pcapng_tsresol(buf, order, offset, end):
+    """This returns the timestamp resolution from options of an IDB."""
+    while offset + 4 <= end:
+        _code, _length = struct.unpack_from(order + 'HH', buf, offset)
+        if _code == 0:
+            break
+        if _code == _PCAPNG_OPT_IF_TSRESOL and _length >= 1:
+            _value = buf[offset+4]
+            if _value & 0x80:
+                return 2.0 ** -(_value & 0x7f)
+            return 10.0 ** -_value
+        offset += 4 + (_length + 3) // 4 * 4
+    return 1e-6
+
+
+def udp_datagrams(filename, ports=None):
+    """Read all UDP datagrams from a pcap or pcapng capture file.
+
+    This is a generator. The file is memory-mapped while it is read.
+    Arguments: filename = path of the capture file
+               ports = collection of UDP ports, only datagrams from or to one
+               of them are returned. Default are all datagrams.
+    Returns: tuples with (timestamp, source address, destination address,
+             payload) for every UDP datagram
+    Raises: ValueError if it is not a capture file
+    """
+    with open(filename, 'rb') as _file:
+        try:
+            _mm = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError('empty capture file: ' + str(filename)) from None
+    with _mm:
+        if len(_mm) < 24:
+            raise ValueError('not a capture file: ' + str(filename))
+        _magic = struct.unpack_from('<I', _mm)[0]
+        if _magic == _PCAPNG_SHB:
+            _frames = _pcapng_frames(_mm)
+        elif _magic in (_PCAP_MAGIC_USEC, _PCAP_MAGIC_NSEC) or \
+                struct.unpack_from('>I', _mm)[0] in (_PCAP_MAGIC_USEC,
+                                                     _PCAP_MAGIC_NSEC):
+            _frames = _pcap_frames(_mm)
+        else:
+            raise ValueError('not a capture file: ' + str(filename))
+        for _linktype, _timestamp, _frame in _frames:
+            _datagram = udp_datagram(_linktype, _frame)
+            if _datagram is None:
+                continue
+            if ports is not None and _datagram[0][1] not in ports and \
+                    _datagram[1][1] not in ports:
+                continue
+            yield (_timestamp,) + _datagram
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
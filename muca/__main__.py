@@ -0,0 +1,4 @@
+"""Start the program with subcommands: python3 -m muca"""
+import muca.Main
+
+muca.Main.main()
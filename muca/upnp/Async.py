@@ -0,0 +1,307 @@
+"""Module to search and listen for UPnP devices with asyncio.
+
+The classes of this module do not own a polling loop. They are driven by the
+running asyncio event loop and are used as asynchronous iterators, so one
+process can search, listen and do its own work on a single event loop:
+
+    async with AsyncListen() as o_listen:
+        async for o_datagram in o_listen:
+            print(o_datagram.fdevice(), end='')
+"""
+
+import asyncio
+from time import time
+
+from muca.upnp.Common import SSDPdatagram, DeviceTable, interfaces6
+from muca.upnp.Search import Msearch
+from muca.upnp.Listen import Listen
+
+
+class SSDPprotocol(asyncio.DatagramProtocol):
+    """Datagram protocol that hands received data to a callback."""
+
+    def __init__(self, received, lost):
+        """Setup the callbacks for received datagrams and a lost connection."""
+        self._received = received
+        self._lost = lost
+
+    def datagram_received(self, data, addr):
+        """Called by the event loop for every received datagram."""
+        self._received(data, addr)
+
+    def connection_lost(self, exc):
+        """Called by the event loop when the transport is closed."""
+        self._lost()
+
+
+class AsyncMcast:
+    """Common asynchronous iterator over received SSDP datagrams.
+
+    Every socket gets its own transport. Received datagrams are put into a
+    queue. A None in the queue terminates the iteration, it is put when all
+    transports have been closed.
+    """
+    # Transport of the first socket, used to send requests.
+    _transport = None
+    _transports = ()
+    _queue = None
+    _finished = False
+    _timer = None
+
+    async def _connect(self, *socks):
+        """Connect the sockets to the running event loop."""
+        if self._transport is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._finished = False
+        _loop = asyncio.get_running_loop()
+        self._transports = []
+        for _sock in socks:
+            _transport, _ = await _loop.create_datagram_endpoint(
+                lambda: SSDPprotocol(self._received, self._lost), sock=_sock)
+            self._transports.append(_transport)
+        self._transport = self._transports[0]
+
+    def _sockets(self):
+        """This returns the sockets to connect, the IPv6 socket is the last
+        one."""
+        # With only IPv6 scopes both attributes are the same socket.
+        _socks = [self._sock]
+        if self._sock6 is not None and self._sock6 is not self._sock:
+            _socks.append(self._sock6)
+        return _socks
+
+    def _register(self, sock, data=''):
+        """The sockets are serviced by the event loop, not by a selector."""
+
+    def _received(self, data, addr):
+        """Put a received datagram into the queue."""
+        self._queue.put_nowait(SSDPdatagram(addr, data))
+
+    def _lost(self):
+        """Terminate the iteration when the last transport has been
+        closed."""
+        self._transports.pop()
+        if self._transports:
+            return
+        self._transport = None
+        if self._queue is not None:
+            self._queue.put_nowait(None)
+
+    def close(self):
+        """Cancel a pending timer, close the transports and terminate the
+        iteration."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _transport in tuple(self._transports):
+            _transport.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._queue is None or self._finished:
+            raise StopAsyncIteration
+        _o_datagram = await self._queue.get()
+        if _o_datagram is None:
+            self._finished = True
+            raise StopAsyncIteration
+        return _o_datagram
+
+
+class AsyncListen(AsyncMcast, Listen):
+    """Passive listen for notifies from devices on the running event loop.
+
+    The multicast groups of the scopes are joined the same way as with Listen
+    and the StormFilter, the filter and the tables are applied the same way.
+    Iteration returns SSDPdatagram objects until close() is called. With a
+    ChangeTable a timer returns the expired devices at their expiry time.
+    """
+
+    async def open(self):   # pylint: disable=invalid-overridden-method
+        """Open the connections, join the multicast groups and start
+        receiving."""
+        if self._transport is not None:
+            return
+        Listen.open(self)
+        await self._connect(*self._sockets())
+
+    def _received(self, data, addr):
+        """Put a received datagram into the queue and update the devices."""
+        if self._prematch is not None and not self._prematch(addr, data):
+            return
+        if self._storm is not None and \
+                not self._storm.accept(addr[0], data, time()):
+            return
+        _o_datagram = self._parse(addr, data)
+        if self._postmatch is not None and not self._postmatch(_o_datagram):
+            return
+        if self._devices is not None:
+            self._devices.update(_o_datagram)
+        if self._changes is None:
+            self._queue.put_nowait(_o_datagram)
+            return
+        for _o_change in self._changes.update(_o_datagram):
+            self._queue.put_nowait(_o_change)
+        self._schedule()
+
+    def _schedule(self):
+        """Start the timer for the next expiry time of the ChangeTable."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        _wakeup = self._changes.wakeup()
+        if _wakeup is not None:
+            self._timer = asyncio.get_running_loop().call_later(
+                max(_wakeup - time(), 0), self._expired)
+
+    def _expired(self):
+        """Called by the timer to put the expired devices into the queue."""
+        self._timer = None
+        for _o_change in self._changes.expire(time()):
+            self._queue.put_nowait(_o_change)
+        self._schedule()
+
+
+class AsyncMsearch(AsyncMcast, Msearch):
+    """Active search for devices on the running event loop.
+
+    Like MsearchDevice, requests are send more than one time and only the
+    first response of a device is reported. The response window of every
+    request and the retries are timers on the event loop. Iteration returns
+    SSDPdatagram objects with the number of the request. At the end of a
+    request window a datagram without data is returned, with the number of
+    the next request or 0 after the last one. Responses are recorded in a
+    DeviceTable that may be shared with other objects.
+
+    The request is send to the group of every scope like with Msearch. The
+    sockets are opened by the constructor, so a closed AsyncMsearch cannot
+    be used again.
+    """
+    # Added to the response time for the delay on the network (in sec).
+    NETDELAY = 1
+
+    _timestamp_first_request = 0
+    _devices = None
+    _count = -1
+    _retry = 0
+    # Transport of the IPv6 socket or None.
+    _transport6 = None
+    _closed = False
+
+    def __init__(self, devices=None, scopes=None):
+        """Setup the table of devices and open the sockets.
+
+        Arguments: devices = DeviceTable or None for an own one
+                   scopes = keys of Mcast.SCOPES, see Msearch
+        Raises: ValueError if a scope is unknown
+        """
+        super().__init__(scopes)
+        self._devices = DeviceTable() if devices is None else devices
+
+    async def open(self):   # pylint: disable=invalid-overridden-method
+        """Connect the sockets to the running event loop.
+
+        Raises: ValueError if the search has been closed
+        """
+        if self._closed:
+            raise ValueError('search has been closed')
+        if self._transport is not None:
+            return
+        await self._connect(*self._sockets())
+        if self._sock6 is not None:
+            self._transport6 = self._transports[-1]
+
+    def close(self):
+        """Stop the search and close the sockets for good."""
+        if self._transport is None:
+            # The sockets have never been connected to a transport.
+            self._close_sockets()
+        super().close()
+        self._transport6 = None
+        self._closed = True
+
+    async def request(self, retries=3, ssdp_response_time=2):
+        """Send a request for upnp root devices.
+
+        Arguments: retries = number of requests to send
+                   ssdp_response_time = MX value for the devices (in sec)
+        Returns: None
+        Raises: ValueError if the search has been closed
+        """
+        await self.open()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._queue = asyncio.Queue()
+        self._finished = False
+        if retries <= 0:
+            self._count = -1
+            self._queue.put_nowait(None)
+            return
+        self._timestamp_first_request = time()
+        self._count = retries
+        self._retry = 0
+        self._response_time = ssdp_response_time
+        self._send_request()
+
+    def _send_request(self):
+        """Send the request to every scope and start the timer for its
+        response window."""
+        self._retry += 1
+        self._timestamp_request = time()
+        for _scope in self._scopes:
+            self._send(self._message(_scope), _scope)
+        self._timer = asyncio.get_running_loop().call_later(
+            self._response_time + self.NETDELAY, self._expired)
+
+    def _send(self, msg, scope='ipv4'):
+        """Send a datagram to the upnp multicast group of a scope.
+
+        Like Msearch._send() but with the transports. Errors of a transport
+        are given to the protocol, so an interface without IPv6 or multicast
+        does not stop the request.
+        """
+        if scope == 'ipv4':
+            self._transport.sendto(msg, (self._MCAST_GRP, self._MCAST_PORT))
+        elif scope == 'link':
+            for _, _index in interfaces6():
+                self._transport6.sendto(msg, (self.SCOPES[scope][0],
+                                              self._MCAST_PORT, 0, _index))
+        else:
+            self._transport6.sendto(msg, (self.SCOPES[scope][0],
+                                          self._MCAST_PORT))
+
+    def _expired(self):
+        """Called by the timer at the end of a response window."""
+        self._timer = None
+        self._count -= 1
+        _o_dummy_datagram = SSDPdatagram()
+        if self._count > 0:
+            self._send_request()
+            _o_dummy_datagram.request = self._retry
+            self._queue.put_nowait(_o_dummy_datagram)
+        else:
+            self._count = -1
+            self._queue.put_nowait(_o_dummy_datagram)
+            self._queue.put_nowait(None)
+
+    def _received(self, data, addr):
+        """Put the first response of a device into the queue."""
+        if self._count < 0:
+            return
+        _o_datagram = SSDPdatagram(addr, data)
+        _o_former = self._devices.update(_o_datagram)
+        if _o_former is None or \
+                _o_former.timestamp < self._timestamp_first_request:
+            _o_datagram.request = self._retry
+            self._queue.put_nowait(_o_datagram)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,191 @@
+"""Module with a persistent table of devices.
+
+The devices seen by search and listen runs are stored in a SQLite database
+under the user cache directory ~/.cache/muca (or $XDG_CACHE_HOME/muca). A new
+run starts with all devices whose max-age has not passed yet, so it can answer
+immediately without waiting for the multicast response window. More than one
+process may use the same database. If it is locked by another process longer
+than DeviceCache.TIMEOUT, the table is only kept in memory until the lock is
+released and a warning is logged.
+"""
+
+import os
+import sqlite3
+import threading
+from time import time, monotonic
+
+from muca.upnp.Common import SSDPdatagram, DeviceTable, _warning
+
+
+def cache_dir():
+    """This returns the directory for cached data of muca."""
+    _base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(_base, 'muca')
+
+
+class DeviceCache(DeviceTable):
+    """A DeviceTable that is persistent on disk.
+
+    Every update of the table is written to the database. Changes are
+    committed at most every COMMIT_INTERVAL seconds and on close, so a
+    listener with many notifies does not wait for the disk. Changes that
+    are not committed by the next update are committed by a timer thread,
+    so the write lock of the database is never held longer than
+    COMMIT_INTERVAL on a quiet network.
+    """
+    # Time between commits of updates to the database (in sec).
+    COMMIT_INTERVAL = 1.0
+    # Time to wait for the write lock of another process (in sec), longer
+    # than its COMMIT_INTERVAL.
+    TIMEOUT = 2.0
+
+    _db = None
+    _last_commit = 0.0
+    _timer = None
+    # True after a failed write until the next successful commit.
+    _failed = False
+
+    def __init__(self, path=None):
+        """Open the database and load all devices that have not expired.
+
+        Arguments: path = database file, default is devices.sqlite in the
+                   cache directory
+        Raises: sqlite3.Error or OSError if the database cannot be opened
+        """
+        super().__init__()
+        if path is None:
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), 'devices.sqlite')
+        # The timer thread commits with the same connection, all access is
+        # serialized by the lock.
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=self.TIMEOUT,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS devices ('
+            'ipaddr TEXT, uuid TEXT, target TEXT, port TEXT, '
+            'interface TEXT, timestamp REAL, expires REAL, data BLOB, '
+            'PRIMARY KEY (ipaddr, uuid, target))')
+        self._load()
+
+    def _load(self):
+        """Load all devices from the database that have not expired."""
+        _now = time()
+        with self._db:
+            self._db.execute('DELETE FROM devices WHERE expires <= ?',
+                             (_now,))
+        for _ipaddr, _port, _interface, _timestamp, _data in self._db.execute(
+                'SELECT ipaddr, port, interface, timestamp, data '
+                'FROM devices ORDER BY timestamp'):
+            _o_datagram = SSDPdatagram((_ipaddr, int(_port or 0)), _data)
+            _o_datagram.timestamp = _timestamp
+            _o_datagram.interface = _interface
+            super().update(_o_datagram)
+        self._last_commit = monotonic()
+
+    def update(self, o_datagram):
+        """Add or refresh the device of a datagram and store it.
+
+        Returns: the former datagram of the device or None if it is new
+        """
+        _o_former = super().update(o_datagram)
+        if o_datagram.method == 'M-SEARCH':
+            return _o_former
+        _key = self.key(o_datagram)
+        if _key in self:
+            self._execute(
+                'INSERT OR REPLACE INTO devices VALUES (?,?,?,?,?,?,?,?)',
+                _key + (o_datagram.port, o_datagram.interface,
+                        o_datagram.timestamp,
+                        o_datagram.timestamp + self.max_age(o_datagram),
+                        o_datagram._raw_data))  # pylint: disable=W0212
+        else:
+            self._delete(_key)
+        self._commit()
+        return _o_former
+
+    def expire(self, now=None):
+        """Remove all devices whose max-age has passed.
+
+        Returns: list of the datagrams from the removed devices
+        """
+        _expired = super().expire(now)
+        for _o_datagram in _expired:
+            self._delete(self.key(_o_datagram))
+        return _expired
+
+    def remove(self, key):
+        """Remove a device from the table if it exists."""
+        super().remove(key)
+        self._delete(key)
+
+    def _delete(self, key):
+        """Delete a device from the database."""
+        self._execute('DELETE FROM devices WHERE ipaddr = ? AND uuid = ? AND '
+                      'target = ?', key)
+
+    def _execute(self, sql, parameters):
+        """Execute a statement, a failure is logged but not raised."""
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute(sql, parameters)
+            except sqlite3.Error as err:
+                self._failure(err)
+
+    def _commit(self, force=False):
+        """Commit the changes if the commit interval has passed, else start
+        the timer to commit them when it has passed."""
+        with self._lock:
+            if self._db is None:
+                return
+            _now = monotonic()
+            _wait = self._last_commit + self.COMMIT_INTERVAL - _now
+            if not force and _wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(_wait, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._last_commit = _now
+            try:
+                self._db.commit()
+            except sqlite3.Error as err:
+                self._failure(err)
+            else:
+                self._failed = False
+
+    def _flush(self):
+        """Called by the timer to commit the pending changes."""
+        with self._lock:
+            self._timer = None
+            self._commit(force=True)
+
+    def _failure(self, err):
+        """Log the first failure to write the database."""
+        if not self._failed:
+            self._failed = True
+            _warning('device cache not written: %s', err)
+
+    def close(self):
+        """Commit all changes and close the database."""
+        with self._lock:
+            if self._db is not None:
+                self._commit(force=True)
+                self._db.close()
+                self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
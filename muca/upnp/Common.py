@@ -1,8 +1,49 @@
-
 """This are common used definitions and statements for the upnp package."""
 
-import re
-from time import time
+import sys
+import socket
+import struct
+from time import time, time_ns, monotonic_ns, perf_counter
+
+# Modules that are not needed by every program are imported where they are
+# used, so the programs start fast.
+# pylint: disable=import-outside-toplevel
+
+
+def _warning(msg, *args):
+    """Log a warning of the muca.upnp modules.
+
+    logging is imported on the first warning, it is not needed to start.
+    """
+    import logging
+    logging.getLogger(__name__).warning(msg, *args)
+
+
+# Binary record: length of the record without this field, timestamp,
+# request number, port and then the length prefixed fields.
+_RECORD_HEADER = struct.Struct('!IdBH')
+
+# ioctl request to get the IPv4 address of a network interface
+_SIOCGIFADDR = 0x8915
+
+# Linux socket option to get the number of datagrams dropped by the kernel as
+# ancillary data, it is missing in the socket module.
+_SO_RXQ_OVFL = 40
+_DROPCOUNT = struct.Struct('I')
+# Linux socket option to get the kernel receive time of a datagram as
+# ancillary data with a struct timespec, also missing in the socket module.
+_SO_TIMESTAMPNS = 35
+_TIMESPEC = struct.Struct('@ll')
+ANCBUFSIZE = socket.CMSG_SPACE(_DROPCOUNT.size) + \
+    socket.CMSG_SPACE(_TIMESPEC.size)
+
+# Translation table to normalize a header name into a property name. Upper case
+# letters become lower case, every character that is not allowed in a property
+# name becomes an underscore.
+_NAME_TABLE = bytes(
+    c + 32 if 65 <= c <= 90 else
+    c if 48 <= c <= 57 or 97 <= c <= 122 or c == 95 else
+    95 for c in range(256))
 
 
 class SSDPdatagram:
@@ -12,86 +53,676 @@ class SSDPdatagram:
     information. There are also some prepared often used parameter like a
     timestamp when the datagram was fetched, network address from the sending
     host, unique identifier of the device and some more.
-    """
-    timestamp = 0
-    ipaddr = ''
-    port = '0'
-    method = ''
-    request = 0
-    # and additional dynamic created properties from header names in datagram
 
-    _raw_data = None    # raw received datagram
+    Header fields are not parsed on construction. We only build a compact table
+    with the offsets of the header lines in the raw datagram. A header is
+    decoded when its property is accessed, for example the line
+    'SERVER: Linux/3.10.54 UPnP/1.0 Cling/2.0'
+    is available as property: server
+    with value: Linux/3.10.54 UPnP/1.0 Cling/2.0
+    To conform to property names there are taken some replacements on the
+    header name.
+    """
+    __slots__ = ('timestamp', 'rxtime', 'ipaddr', 'port', 'method',
+                 'request', 'interface', 'change', '_raw_data', '_index',
+                 '_cache', '_text')
 
     def __init__(self, addr=('', 0), raw_data=None):
-        """The constructor prepairs raw data representing a SSDP datagram."""
+        """The constructor prepairs raw data representing a SSDP datagram.
+
+        'timestamp' is the wall clock time in seconds since the epoch and
+        'rxtime' the monotonic time in nanoseconds of receiving, see
+        set_rxtime(). Both are set to the current time. 'change' is the
+        state change of the device from a ChangeTable or ''.
+        """
         self.timestamp = time()
+        self.rxtime = monotonic_ns()
         self._raw_data = raw_data
         self.ipaddr = addr[0]
         self.port = '' if addr[1] == 0 else str(addr[1])
-
-        # Here we split the datagram for the network into lines and tranform
-        # its fields into properties, for example this line:
-        # 'SERVER: Linux/3.10.54 UPnP/1.0 Cling/2.0'
-        # gets property: server with value: Linux/3.10.54 UPnP/1.0 Cling/2.0
-        # To conform to property names there has to be taken some replacements.
+        self.method = ''
+        self.request = 0
+        self.interface = ''
+        self.change = ''
+        self._cache = None
+        self._index = None
+        self._text = None
         if raw_data is None:
             return
-        lines = self.data.splitlines()
-        parts = lines[0].partition(' * HTTP')
-        if parts[1] != '':
-            self.method = parts[0]
-        for line in enumerate(lines, 1):
-            parts = line[1].partition(':')
-            if parts[1] != '':
-                propname = parts[0].lower().strip()
-                propname = re.sub(r"([^a-z0-9_])", r"_", propname)
-                propname = re.sub(r"(^[0-9_])", r"x\1", propname)
-                setattr(self, propname, parts[2].strip())
-        if hasattr(self, 'usn'):
-            self.uuid = self.usn.partition('uuid:')[2].partition('::')[0]
+
+        # The index has three offsets for every line with a colon: start of
+        # the line, position of the colon and end of the line.
+        from array import array
+        _find = raw_data.find
+        _len = len(raw_data)
+        _index = array('H' if _len < 65536 else 'L')
+        _start = 0
+        while _start < _len:
+            _end = _find(b'\n', _start)
+            if _end < 0:
+                _end = _len
+            _colon = _find(b':', _start, _end)
+            if _colon >= 0:
+                _index.extend((_start, _colon, _end))
+            _start = _end + 1
+        self._index = _index
+
+        _end = _find(b'\n')
+        _end = _find(b' * HTTP', 0, _len if _end < 0 else _end)
+        if _end >= 0:
+            self.method = raw_data[:_end].decode()
+
+    def set_rxtime(self, realtime_ns):
+        """Set the receive time from a kernel timestamp.
+
+        Arguments: realtime_ns = wall clock time in nanoseconds since the
+                   epoch, it is converted to the monotonic clock
+        """
+        self.timestamp = realtime_ns / 1e9
+        self.rxtime = realtime_ns - time_ns() + monotonic_ns()
+
+    def _header(self, propname):
+        """This returns the decoded value of a header or None if not found.
+
+        If a header is given more than one time then the last one is used.
+        """
+        _index = self._index
+        if _index is None:
+            return None
+        _key = propname.encode()
+        _klen = len(_key)
+        _raw_data = self._raw_data
+        _view = memoryview(_raw_data)
+        for i in range(len(_index) - 3, -1, -3):
+            _name = _raw_data[_index[i]:_index[i+1]].strip()
+            _nlen = len(_name)
+            if _nlen == 0 or (_nlen != _klen and _nlen + 1 != _klen):
+                continue
+            _name = _name.translate(_NAME_TABLE)
+            if _name[0] in b'0123456789_':
+                _name = b'x' + _name
+            if _name == _key:
+                return str(_view[_index[i+1]+1:_index[i+2]], 'utf-8').strip()
+        return None
+
+    def __getattr__(self, name):
+        """This returns the value of a header as property.
+
+        Only called if there is no regular attribute with this name. Not
+        available headers raise AttributeError so hasattr() works as expected.
+        """
+        if name[0] == '_':
+            raise AttributeError(name)
+        _value = self.get(name)
+        if _value is None:
+            raise AttributeError(name)
+        return _value
+
+    def get(self, name, default=None):
+        """This returns the value of a header by its property name.
+
+        Values are cached, also not available headers as None, so the next
+        lookup needs no search.
+        Returns: the value or default if the header is not available
+        """
+        _cache = self._cache
+        if _cache is not None and name in _cache:
+            _value = _cache[name]
+            return default if _value is None else _value
+        if name == 'uuid':
+            _value = self._header('usn')
+            if _value is not None:
+                _value = _value.partition('uuid:')[2].partition('::')[0]
+            else:
+                _value = self._header(name)
+        else:
+            _value = self._header(name)
+        if _cache is None:
+            self._cache = _cache = {}
+        _cache[name] = _value
+        return default if _value is None else _value
+
+    def headers(self):
+        """This returns a dictionary with all headers as property names."""
+        _headers = {}
+        _index = self._index
+        if _index is None:
+            return _headers
+        for i in range(0, len(_index), 3):
+            _name = self._raw_data[_index[i]:_index[i+1]].strip()
+            if _name == b'':
+                continue
+            _name = _name.translate(_NAME_TABLE)
+            if _name[0] in b'0123456789_':
+                _name = b'x' + _name
+            _headers[_name.decode()] = self._raw_data[
+                _index[i+1]+1:_index[i+2]].decode().strip()
+        if 'usn' in _headers:
+            _headers['uuid'] = \
+                _headers['usn'].partition('uuid:')[2].partition('::')[0]
+        return _headers
 
     @property
     def data(self):
-        """This returns the decoded raw data as string so it is printable."""
-        if self._raw_data is None:
-            return
-        return self._raw_data.decode()
+        """This returns the decoded raw data as string so it is printable.
+
+        The raw data is decoded only on the first call.
+        """
+        _text = self._text
+        if _text is None and self._raw_data is not None:
+            self._text = _text = self._raw_data.decode()
+        return _text
+
+    def address(self):
+        """This returns the source address as 'ip:port', IPv6 addresses in
+        brackets, or '' if there is no address."""
+        _ipaddr = self.ipaddr
+        if ':' in _ipaddr:
+            _ipaddr = '[' + _ipaddr + ']'
+        if self.port != '':
+            return _ipaddr + ':' + self.port
+        return _ipaddr
 
     def fdevice(self, base_time=0, verbose=False):
         """This returns a formated device pattern ready for printing."""
         _rel_time = self.timestamp - base_time
         if base_time == 0 or _rel_time <= 0:
-            _rel_time = '0000.0000s'
+            _line = ['0000.0000s ', str(self.request)]
         else:
-            _rel_time = '{:09.4f}s'.format(_rel_time)
-        _ipaddr = ' ' + self.ipaddr if self.ipaddr != '' else ''
-        _port = ':' + self.port if self.port != '' else ''
-
+            _line = ['{:09.4f}s '.format(_rel_time), str(self.request)]
+        if self.change != '':
+            _line.append(' ' + self.change)
+        if not verbose and self.method != '':
+            _line.append(' ' + self.method)
+        if self.ipaddr != '':
+            _line.append(' ' + self.address())
+        elif self.port != '':
+            _line.append(':' + self.port)
+        if self.interface != '':
+            _line.append('@' + self.interface)
+        _line.append('\r\n')
+        if self._raw_data is None:
+            return ''.join(_line)
         if verbose:
-            if self.data is None:
-                return '{} {}{}{}\r\n'.format(
-                    _rel_time, self.request, _ipaddr, _port)
-            else:
-                return '{} {}{}{}\r\n{}'.format(
-                    _rel_time, self.request, _ipaddr, _port, self.data)
+            _line.append(self.data)
+            return ''.join(_line)
+        _uuid = self.get('uuid')
+        if _uuid is not None:
+            _line.insert(-1, ' uuid:' + _uuid)
+        _server = self.get('server')
+        if _server is not None:
+            _line.insert(-1, ' ' + _server)
+        return ''.join(_line)
+
+    def _fields(self, fields):
+        """This returns the available header fields as (name, value)."""
+        if self._raw_data is None:
+            return []
+        _fields = []
+        for _name in fields:
+            _value = self.get(_name)
+            if _value is not None:
+                _fields.append((_name, _value))
+        return _fields
+
+    def fndjson(self, base_time=0, fields=(), raw=False):
+        """This returns the datagram as one line of JSON.
+
+        The record has the parsed fields: timestamp, relative time to
+        base_time, request number, ip address, port, interface, method,
+        change, uuid and the given header fields if they are available. With
+        raw the whole datagram is added.
+        """
+        _record = {'ts': self.timestamp}
+        if base_time != 0:
+            _record['rel'] = round(max(self.timestamp - base_time, 0.0), 6)
+        _record['request'] = self.request
+        if self.ipaddr != '':
+            _record['ip'] = self.ipaddr
+        if self.port != '':
+            _record['port'] = int(self.port)
+        if self.interface != '':
+            _record['interface'] = self.interface
+        if self.method != '':
+            _record['method'] = self.method
+        if self.change != '':
+            _record['change'] = self.change
+        _record.update(self._fields(('uuid',) + tuple(fields)))
+        if raw and self._raw_data is not None:
+            _record['raw'] = self.data
+        import json
+        return json.dumps(_record, separators=(',', ':')) + '\n'
+
+    def fbinary(self, fields=(), raw=False):
+        """This returns the datagram as length prefixed binary record.
+
+        All integers are in network byte order:
+            uint32  length of the following record
+            float64 timestamp
+            uint8   request number
+            uint16  port, 0 if not available
+            uint16 length + ip address, interface, method, uuid
+            uint8   number of header fields
+            uint16 length + name, uint16 length + value for every header
+            field
+            uint32 length + raw datagram, length 0 without raw
+        Strings are UTF-8 encoded. read_records() decodes the records. The
+        strings are parts of one datagram, so they are shorter than 64 KiB.
+        """
+        _fields = self._fields(fields)
+        _uuid = self.get('uuid', '') if self._raw_data is not None \
+            else ''
+        _parts = [b'']
+        for _value in (self.ipaddr, self.interface, self.method, _uuid):
+            _value = _value.encode()
+            _parts.append(struct.pack('!H', len(_value)) + _value)
+        _parts.append(bytes((len(_fields),)))
+        for _name, _value in _fields:
+            _name = _name.encode()
+            _value = _value.encode()
+            _parts.append(struct.pack('!H', len(_name)) + _name
+                          + struct.pack('!H', len(_value)) + _value)
+        _raw_data = self._raw_data if raw and self._raw_data is not None \
+            else b''
+        _parts.append(struct.pack('!I', len(_raw_data)))
+        _parts.append(_raw_data)
+        _length = sum(len(_part) for _part in _parts)
+        _parts[0] = _RECORD_HEADER.pack(
+            _length + _RECORD_HEADER.size - 4, self.timestamp,
+            self.request & 0xff, int(self.port) if self.port != '' else 0)
+        return b''.join(_parts)
+
+
+def read_records(stream):
+    """Read binary records written by SSDPdatagram.fbinary() from a stream.
+
+    This is a generator. It ends at the end of the stream.
+    Returns: a dictionary for every record with the keys ts, request, ip,
+             port, interface, method, uuid, fields (dictionary) and raw
+             (bytes)
+    Raises: ValueError if the stream ends within a record or a record is
+            invalid
+    """
+    while True:
+        _data = stream.read(_RECORD_HEADER.size)
+        if not _data:
+            return
+        if len(_data) < _RECORD_HEADER.size:
+            raise ValueError('truncated binary record')
+        _length, _timestamp, _request, _port = _RECORD_HEADER.unpack(_data)
+        _size = _length - _RECORD_HEADER.size + 4
+        _data = stream.read(_size) if _size > 0 else b''
+        if len(_data) < _size:
+            raise ValueError('truncated binary record')
+        _record = {'ts': _timestamp, 'request': _request, 'port': _port}
+        try:
+            _parse_record(_data, _record)
+        except (IndexError, struct.error, UnicodeDecodeError):
+            raise ValueError('invalid binary record') from None
+        yield _record
+
+
+def _parse_record(data, record):
+    """Add the fields of the data of a binary record to the dictionary."""
+    _offset = 0
+    for _key in ('ip', 'interface', 'method', 'uuid'):
+        _len = struct.unpack_from('!H', data, _offset)[0]
+        record[_key] = data[_offset+2:_offset+2+_len].decode()
+        _offset += 2 + _len
+    _fields = {}
+    _count = data[_offset]
+    _offset += 1
+    for _ in range(_count):
+        _len = struct.unpack_from('!H', data, _offset)[0]
+        _name = data[_offset+2:_offset+2+_len].decode()
+        _offset += 2 + _len
+        _len = struct.unpack_from('!H', data, _offset)[0]
+        _fields[_name] = data[_offset+2:_offset+2+_len].decode()
+        _offset += 2 + _len
+    record['fields'] = _fields
+    _len = struct.unpack_from('!I', data, _offset)[0]
+    if len(data) < _offset + 4 + _len:
+        raise ValueError('invalid binary record')
+    record['raw'] = data[_offset+4:_offset+4+_len]
+
+
+class DeviceTable:
+    """This class is a table of devices seen on the network.
+
+    Entries are keyed by the network address of the device, its unique
+    identifier and the search target or notification type, so lookups are
+    constant-time. A device without unique identifier is keyed by its address
+    and the target alone. Every entry expires after the max-age given in its
+    CACHE-CONTROL header. Expiry times are kept in a heap and entries are
+    removed lazily when the earliest expiry time has passed. A ssdp:byebye
+    notify removes its entry immediately. One table may be shared by search
+    and listen objects.
+    """
+    # Used if a datagram has no valid CACHE-CONTROL: max-age (in sec).
+    DEFAULT_MAX_AGE = 1800
+
+    def __init__(self):
+        """Setup an empty table."""
+        # key -> (expiry time, SSDPdatagram)
+        self._devices = {}
+        # heap with (expiry time, key), may contain outdated entries
+        self._heap = []
+
+    @staticmethod
+    def key(o_datagram):
+        """This returns the key of a datagram for the table."""
+        _target = o_datagram.get('st')
+        if _target is None:
+            _target = o_datagram.get('nt', '')
+        return (o_datagram.ipaddr, o_datagram.get('uuid', ''), _target)
+
+    @classmethod
+    def max_age(cls, o_datagram):
+        """This returns the max-age of a datagram in seconds."""
+        _value = o_datagram.get('cache_control', '')
+        _pos = _value.lower().find('max-age')
+        if _pos >= 0:
+            _value = _value[_pos+7:].lstrip(' =').partition(',')[0].strip()
+            if _value.isdigit():
+                return int(_value)
+        return cls.DEFAULT_MAX_AGE
+
+    def update(self, o_datagram):
+        """Add or refresh the device of a datagram in the table.
+
+        A ssdp:byebye notify removes the device. Search requests are not
+        stored.
+        Returns: the former datagram of the device or None if it is new
+        """
+        self.expire(o_datagram.timestamp)
+        if o_datagram.method == 'M-SEARCH':
+            return None
+        _key = self.key(o_datagram)
+        if o_datagram.get('nts') == 'ssdp:byebye':
+            _entry = self._devices.pop(_key, None)
+            return None if _entry is None else _entry[1]
+        _expires = o_datagram.timestamp + self.max_age(o_datagram)
+        _entry = self._devices.get(_key)
+        self._devices[_key] = (_expires, o_datagram)
+        if _entry is None or _entry[0] != _expires:
+            from heapq import heappush, heapify
+            heappush(self._heap, (_expires, _key))
+            # The heap keeps outdated entries of refreshed devices until they
+            # expire. Rebuild it if they are the majority.
+            if len(self._heap) > 2 * len(self._devices) + 64:
+                self._heap = [(_e[0], _k) for _k, _e
+                              in self._devices.items()]
+                heapify(self._heap)
+        return None if _entry is None else _entry[1]
+
+    def expire(self, now=None):
+        """Remove all devices whose max-age has passed.
+
+        Returns: list of the datagrams from the removed devices
+        """
+        from heapq import heappop
+        if now is None:
+            now = time()
+        _expired = []
+        _heap = self._heap
+        _devices = self._devices
+        while _heap and _heap[0][0] <= now:
+            _expires, _key = heappop(_heap)
+            _entry = _devices.get(_key)
+            if _entry is not None and _entry[0] == _expires:
+                del _devices[_key]
+                _expired.append(_entry[1])
+        return _expired
+
+    def remove(self, key):
+        """Remove a device from the table if it exists."""
+        self._devices.pop(key, None)
+
+    def get(self, key, default=None):
+        """This returns the last datagram of a device."""
+        _entry = self._devices.get(key)
+        return default if _entry is None else _entry[1]
+
+    def __contains__(self, key):
+        return key in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __iter__(self):
+        return (_entry[1] for _entry in self._devices.values())
+
+
+class ChangeTable(DeviceTable):
+    """This class keeps the state of devices and reports only its changes.
+
+    The state is kept for every unique identifier and notification type or
+    search target, independent of the source address. update() and expire()
+    return the datagrams that change the state, with the attribute 'change'
+    set to:
+    new         first datagram of a device
+    byebye      ssdp:byebye notify of a known device
+    changed:... the LOCATION, BOOTID.UPNP.ORG or CONFIGID.UPNP.ORG header has
+                changed on renewal, for example 'changed:location,bootid'
+    expired     the max-age has passed without renewal, it is a copy of the
+                last datagram with the time of expiry as timestamp
+    Renewals without change return nothing, so the output grows with the
+    changes and not with the advertisement rate. Datagrams without unique
+    identifier are not tracked.
+    """
+    # name of the change -> header compared on renewal
+    COMPARED = (('location', 'location'), ('bootid', 'bootid_upnp_org'),
+                ('configid', 'configid_upnp_org'))
+
+    @staticmethod
+    def key(o_datagram):
+        """This returns the key of a datagram for the table."""
+        _target = o_datagram.get('st')
+        if _target is None:
+            _target = o_datagram.get('nt', '')
+        return (o_datagram.get('uuid', ''), _target)
+
+    def update(self, o_datagram):
+        """Add or refresh the device of a datagram in the table.
+
+        Returns: list of the datagrams that change the state, the devices
+                 expired until the datagram first
+        """
+        _changes = self.expire(o_datagram.timestamp)
+        if o_datagram.method == 'M-SEARCH' or o_datagram.get('uuid') is None:
+            return _changes
+        _o_former = super().update(o_datagram)
+        if o_datagram.get('nts') == 'ssdp:byebye':
+            if _o_former is not None:
+                o_datagram.change = 'byebye'
+                _changes.append(o_datagram)
+        elif _o_former is None:
+            o_datagram.change = 'new'
+            _changes.append(o_datagram)
         else:
-            _method = ' ' + self.method if self.method != '' else ''
-            if self.data is None:
-                return '{} {}{}{}{}\r\n'.format(
-                    _rel_time, self.request, _method, _ipaddr, _port)
+            _changed = [_name for _name, _header in self.COMPARED
+                        if o_datagram.get(_header) != _o_former.get(_header)]
+            if _changed:
+                o_datagram.change = 'changed:' + ','.join(_changed)
+                _changes.append(o_datagram)
+        return _changes
+
+    def expire(self, now=None):
+        """Remove all devices whose max-age has passed.
+
+        Returns: list of copies of the datagrams from the removed devices
+        """
+        _expired = []
+        for _o_datagram in super().expire(now):
+            _o_copy = SSDPdatagram(
+                (_o_datagram.ipaddr, int(_o_datagram.port or 0)),
+                _o_datagram._raw_data)  # pylint: disable=protected-access
+            _o_copy.interface = _o_datagram.interface
+            _o_copy.timestamp = _o_datagram.timestamp \
+                + self.max_age(_o_datagram)
+            _o_copy.change = 'expired'
+            _expired.append(_o_copy)
+        return _expired
+
+    def wakeup(self):
+        """This returns the next expiry time or None if the table is empty.
+
+        Outdated entries of refreshed or removed devices are dropped from the
+        heap first.
+        """
+        from heapq import heappop
+        _heap = self._heap
+        _devices = self._devices
+        while _heap:
+            _entry = _devices.get(_heap[0][1])
+            if _entry is not None and _entry[0] == _heap[0][0]:
+                return _heap[0][0]
+            heappop(_heap)
+        return None
+
+
+class StormFilter:
+    """This class suppresses multicast storms before datagrams are parsed.
+
+    Some devices announce every device and service in tight bursts. Two
+    stages are applied to the raw data of a datagram:
+    window  byte-identical datagrams are dropped if the same data has passed
+            within this time (in sec), the data is compared by its hash
+    rate    every source ip address has a token bucket with this rate (in
+            datagrams per sec) and a capacity of burst datagrams, a datagram
+            is dropped if the bucket of its source is empty
+    Suppressed datagrams are counted in total and for every source.
+    """
+
+    def __init__(self, rate=None, burst=None, window=0):
+        """Setup the stages, None or 0 disables a stage.
+
+        Arguments: burst = capacity of the token buckets, default is the
+                   number of datagrams of one second
+        """
+        self._rate = rate
+        self._burst = max(rate or 0, 1) if burst is None else burst
+        self._window = window
+        # hash of data -> time it has passed
+        self._seen = {}
+        # ip address -> [tokens, time of the last update]
+        self._buckets = {}
+        self._purge = 0.0
+        self.passed = 0
+        self.duplicates = 0
+        self.limited = 0
+        # ip address -> number of suppressed datagrams
+        self.sources = {}
+
+    def accept(self, ipaddr, data, now):
+        """This returns True if a datagram passes the filter.
+
+        Arguments: ipaddr = source address of the datagram
+                   data = raw datagram
+                   now = time of receiving (in sec)
+        """
+        if now >= self._purge:
+            self._purge_tables(now)
+        if self._window:
+            _hash = hash(data)
+            _seen = self._seen.get(_hash)
+            if _seen is not None and now - _seen < self._window:
+                self.duplicates += 1
+                self.sources[ipaddr] = self.sources.get(ipaddr, 0) + 1
+                return False
+        if self._rate:
+            _bucket = self._buckets.get(ipaddr)
+            if _bucket is None:
+                _bucket = self._buckets[ipaddr] = [self._burst, now]
             else:
-                _uuid = ' uuid:' + self.uuid if hasattr(self, 'uuid') else ''
-                _server = ' ' + self.server if hasattr(self, 'server') else ''
-                return '{} {}{}{}{}{}{}\r\n'.format(
-                    _rel_time, self.request, _method, _ipaddr, _port, _uuid,
-                    _server)
+                _bucket[0] = min(self._burst, _bucket[0]
+                                 + (now - _bucket[1]) * self._rate)
+                _bucket[1] = now
+            if _bucket[0] < 1:
+                self.limited += 1
+                self.sources[ipaddr] = self.sources.get(ipaddr, 0) + 1
+                return False
+            _bucket[0] -= 1
+        if self._window:
+            self._seen[_hash] = now
+        self.passed += 1
+        return True
+
+    def _purge_tables(self, now):
+        """Remove outdated hashes and full token buckets once a second."""
+        if self._window:
+            self._seen = {_hash: _seen for _hash, _seen in self._seen.items()
+                          if now - _seen < self._window}
+        if self._rate:
+            self._buckets = {
+                _ipaddr: _bucket for _ipaddr, _bucket in self._buckets.items()
+                if _bucket[0] + (now - _bucket[1]) * self._rate < self._burst}
+        self._purge = now + 1
+
+    def stats(self):
+        """This returns the counters as dictionary."""
+        return {
+            'passed': self.passed,
+            'duplicates': self.duplicates,
+            'limited': self.limited,
+            'sources': dict(self.sources)}
+
+    def fstats(self):
+        """This returns the counters formated for printing.
+
+        Only the five sources with the most suppressed datagrams are shown.
+        """
+        _top = sorted(self.sources.items(), key=lambda _item: -_item[1])[:5]
+        return 'passed: {} duplicates: {} limited: {} {}'.format(
+            self.passed, self.duplicates, self.limited, ' '.join(
+                '[{}]: {}'.format(_ipaddr, _count)
+                for _ipaddr, _count in _top)).rstrip()
+
+
+def interfaces():
+    """This returns the local network interfaces with an IPv4 address.
+
+    The loopback interface is not returned.
+    Returns: list of tuples with (interface name, IPv4 address)
+    """
+    import fcntl
+    _interfaces = []
+    _sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, _name in socket.if_nameindex():
+            try:
+                _ifreq = fcntl.ioctl(_sock.fileno(), _SIOCGIFADDR, struct.pack(
+                    '256s', _name.encode()[:15]))
+            except OSError:
+                # interface has no IPv4 address
+                continue
+            _ipaddr = socket.inet_ntoa(_ifreq[20:24])
+            if not _ipaddr.startswith('127.'):
+                _interfaces.append((_name, _ipaddr))
+    finally:
+        _sock.close()
+    return _interfaces
+
+
+def interfaces6():
+    """This returns the local network interfaces for IPv6 multicast.
+
+    The loopback interface is not returned.
+    Returns: list of tuples with (interface name, interface index)
+    """
+    return [(_name, _index) for _index, _name in socket.if_nameindex()
+            if _name != 'lo']
 
 
 class Mcast:
     """Common class for search and listen multicast packages."""
-    # If you increase the size of RECVBUF you have more time between
-    # 'open' the connection and 'get' its data before buffer overflow
+    # Maximal size of a datagram, larger datagrams are truncated and skipped.
     RECVBUF = 4096
+    # Size of the kernel receive buffer of a socket (SO_RCVBUF) in bytes. If
+    # you increase it you have more time between 'open' the connection and
+    # 'get' its data before the kernel drops datagrams. None keeps the system
+    # default.
+    RCVBUF = None
     # Response time, also given to the network devices within the request
     # datagram. Devices on the network must response within this time.
     # _response_time = 0   no data to get
@@ -99,7 +730,262 @@ class Mcast:
     _response_time = 0
     _MCAST_GRP = '239.255.255.250'
     _MCAST_PORT = 1900
+    # Multicast scopes of SSDP: scope -> (group, value of the HOST header)
+    # ipv4  the IPv4 group
+    # link  the IPv6 link-local group, joined on every interface
+    # site  the IPv6 site-local group
+    SCOPES = {
+        'ipv4': ('239.255.255.250', '239.255.255.250:1900'),
+        'link': ('ff02::c', '[FF02::C]:1900'),
+        'site': ('ff05::c', '[FF05::C]:1900'),
+    }
+    # Output formats of the datagrams.
+    # text    lines from SSDPdatagram.fdevice() or TEMPLATE, verbose with the
+    #         datagram
+    # ndjson  one JSON object per line, verbose with the datagram
+    # binary  length prefixed records, verbose with the datagram
+    OUTPUTS = ('text', 'ndjson', 'binary')
+    # Header fields that are written with ndjson and binary output.
+    FIELDS = ('location', 'server', 'cache_control', 'st', 'nt', 'nts',
+              'bootid_upnp_org', 'configid_upnp_org')
+    # muca.upnp.Template.Template for the text output or None for
+    # SSDPdatagram.fdevice()
+    TEMPLATE = None
 
     _sock = None
+    # IPv6 socket or None, it is also _sock without the ipv4 scope.
+    _sock6 = None
+    _scopes = ('ipv4',)
+    # With more than one socket they are serviced by one selector, see
+    # _register().
+    _selector = None
+    _ready = None
+    _verbose = False
+    _output = 'text'
+    # muca.Metrics.Metrics object or None
+    _metrics = None
+    # Number of datagrams dropped by the kernel and truncated datagrams.
+    dropped = 0
+    truncated = 0
+    # socket -> last drop count of the kernel
+    _dropcounts = None
+    # Filter of the received datagrams, see _setup_match().
+    _match = None
+    _prematch = None
+    _postmatch = None
+
+    def _setup_match(self, match):
+        """Set the filter of the received datagrams.
+
+        Arguments: match = callable that gets a SSDPdatagram and returns
+                   False to drop it, for example a muca.upnp.Filter.Filter,
+                   or None
+        The raw check of a Filter is done by _recv() before a datagram is
+        parsed. The receiving methods check the parsed datagram with
+        _postmatch if it is not None.
+        """
+        self._match = match
+        self._prematch = getattr(match, 'prematch', None)
+        self._postmatch = None if getattr(match, 'exact', False) else match
+
+    def _setup_scopes(self, scopes):
+        """Set the multicast scopes.
+
+        Arguments: scopes = iterable with keys of SCOPES or None for ipv4
+        Raises: ValueError if a scope is unknown or there is no scope
+        """
+        if scopes is None:
+            return
+        _scopes = tuple(_scope for _scope in self.SCOPES if _scope in scopes)
+        _unknown = set(scopes).difference(self.SCOPES)
+        if _unknown:
+            raise ValueError('unknown scope: {}'.format(
+                ', '.join(sorted(_unknown))))
+        if not _scopes:
+            raise ValueError('no scope given')
+        self._scopes = _scopes
+
+    def _groups6(self):
+        """This returns the IPv6 groups of the scopes as list of tuples
+        (scope, group)."""
+        return [(_scope, self.SCOPES[_scope][0]) for _scope in self._scopes
+                if _scope != 'ipv4']
+
+    def _register(self, sock, data=''):
+        """Add a socket to the selector of the receiving methods.
+
+        Arguments: data = tag of the socket, for example its interface name
+        selectors is imported on the first socket, it is not needed with one
+        socket.
+        """
+        import selectors
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self._ready = []
+        self._selector.register(sock, selectors.EVENT_READ, data)
+
+    def _select(self, timeout=None):
+        """This returns the selector key of the next readable socket.
+
+        Raises: socket.timeout if no socket is readable within the timeout
+        """
+        if not self._ready:
+            self._ready = [_key for _key, _ in self._selector.select(timeout)]
+            if not self._ready:
+                raise socket.timeout()
+        return self._ready.pop()
+
+    def _close_sockets(self):
+        """Close the sockets and the selector."""
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        for _sock in (self._sock, self._sock6):
+            if _sock is not None:
+                _sock.close()
+
+    def _setup_socket(self, sock):
+        """Set the receive buffer size and enable the drop count and the
+        kernel receive timestamps of a socket.
+        """
+        if self.RCVBUF is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+            _size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            if sys.platform.startswith('linux'):
+                # Linux doubles the size for bookkeeping and reports the
+                # doubled size, but limits it to net.core.rmem_max first.
+                _size //= 2
+            if _size < self.RCVBUF:
+                _warning('receive buffer limited to %d bytes', _size)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_RXQ_OVFL, 1)
+        except OSError:
+            # The drop count is not available on this platform.
+            pass
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMPNS, 1)
+        except OSError:
+            # Datagrams get the time of parsing instead.
+            pass
+
+    def _open4(self, group, port):
+        """Open a connection and join to an IPv4 multicast group.
+
+        Returns: the socket bound to the group
+        """
+        _sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                              socket.IPPROTO_UDP)
+        _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._setup_socket(_sock)
+        # use the group instead of '' to listen only to the group, not all
+        # groups on the port
+        _sock.bind((group, port))
+        mreq = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+        _sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return _sock
+
+    def _recv(self, sock):
+        """Receive the next datagram from a socket.
+
+        Truncated datagrams are logged and counted. Datagrams dropped by the
+        kernel are counted.
+        Returns: tuple (raw datagram, address, kernel receive time in
+                 nanoseconds since the epoch or None) or None if the
+                 datagram is truncated or fails the raw check of the filter
+        Raises: socket.timeout if the socket has a timeout
+        """
+        data, ancdata, flags, addr = sock.recvmsg(self.RECVBUF, ANCBUFSIZE)
+        _rxtime = self._ancillary(sock, ancdata) if ancdata else None
+        if flags & socket.MSG_TRUNC:
+            self._truncate(addr)
+            return None
+        if self._prematch is not None and not self._prematch(addr, data):
+            return None
+        return data, addr, _rxtime
+
+    def _ancillary(self, sock, ancdata):
+        """Evaluate the ancillary data of a received datagram.
+
+        The kernel sends the number of dropped datagrams since the socket has
+        been opened, they are counted.
+        Returns: kernel receive time in nanoseconds since the epoch or None
+        """
+        _rxtime = None
+        for _level, _type, _data in ancdata:
+            if _level != socket.SOL_SOCKET:
+                continue
+            if _type == _SO_TIMESTAMPNS:
+                _sec, _nsec = _TIMESPEC.unpack_from(_data)
+                _rxtime = _sec * 1000000000 + _nsec
+            elif _type == _SO_RXQ_OVFL:
+                _count = _DROPCOUNT.unpack_from(_data)[0]
+                if self._dropcounts is None:
+                    self._dropcounts = {}
+                _delta = (_count - self._dropcounts.get(sock, 0)) & 0xffffffff
+                if _delta:
+                    self._dropcounts[sock] = _count
+                    self.dropped += _delta
+                    if self._metrics is not None:
+                        self._metrics.count('datagrams_dropped', _delta)
+        return _rxtime
+
+    def _truncate(self, addr):
+        """Count and log a truncated datagram."""
+        self.truncated += 1
+        if self._metrics is not None:
+            self._metrics.count('datagrams_truncated')
+        _warning('datagram from %s:%s larger than %d bytes skipped',
+                 addr[0], addr[1], self.RECVBUF)
+
+    def _parse(self, addr, data, rxtime=None):
+        """This returns the SSDPdatagram of received data.
+
+        Arguments: rxtime = kernel receive time from _recv() or None
+        With metrics the received datagrams and bytes are counted and the
+        time to parse is measured.
+        """
+        if self._metrics is None:
+            _o_datagram = SSDPdatagram(addr, data)
+        else:
+            _start = perf_counter()
+            _o_datagram = SSDPdatagram(addr, data)
+            _metrics = self._metrics
+            _metrics.observe('parse', perf_counter() - _start)
+            _metrics.count('datagrams_received')
+            _metrics.count('bytes_received', len(data))
+        if rxtime is not None:
+            _o_datagram.set_rxtime(rxtime)
+        return _o_datagram
+
+    def _format(self, o_datagram, base_time):
+        """This returns a datagram in the selected output format.
+
+        Returns: str for text and ndjson, bytes for binary output
+        """
+        if self._metrics is not None:
+            _start = perf_counter()
+        if self._output == 'text':
+            if self.TEMPLATE is None:
+                _record = o_datagram.fdevice(base_time=base_time,
+                                             verbose=self._verbose)
+            else:
+                _record = self.TEMPLATE(o_datagram, base_time)
+        elif self._output == 'ndjson':
+            _record = o_datagram.fndjson(base_time=base_time,
+                                         fields=self.FIELDS,
+                                         raw=self._verbose)
+        else:
+            _record = o_datagram.fbinary(fields=self.FIELDS,
+                                         raw=self._verbose)
+        if self._metrics is not None:
+            self._metrics.observe('format', perf_counter() - _start)
+        return _record
+
+
+def print_losses(o_mcast):
+    """Print the number of lost datagrams to stderr if there are any."""
+    if o_mcast.dropped or o_mcast.truncated:
+        print("WARNING: datagrams dropped by the kernel: {} truncated: {}"
+              .format(o_mcast.dropped, o_mcast.truncated), file=sys.stderr)
 
 # vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,369 @@
+"""Daemon to share one multicast membership with many local clients.
+
+mucad listens to the upnp multicast groups, searches for devices on start and
+keeps the state of all devices in a DeviceTable. Clients query the state or
+subscribe to the received datagrams over a Unix domain socket, so they get
+results without touching the network.
+
+A client sends one command line:
+    LIST            all devices
+    GET <uuid>      all entries of one device
+    SEARCH          send a search request, responses go to the subscribers
+    SUBSCRIBE       stream every received datagram until the client closes
+The daemon answers with a status line 'OK' or 'ERROR <message>' followed by
+binary records of SSDPdatagram.fbinary() with the raw datagram. The connection
+is closed after the answer, except for SUBSCRIBE.
+"""
+
+import os
+import stat
+import queue
+import signal
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+from muca.Common import build
+from muca.upnp.Common import SSDPdatagram, DeviceTable, Mcast, read_records, \
+                             _warning
+from muca.upnp.Listen import Listen
+from muca.upnp.Search import MsearchDevice, print_it
+
+
+def socket_path():
+    """This returns the default path of the daemon socket."""
+    _base = os.environ.get('XDG_RUNTIME_DIR') or \
+        '/tmp/muca-{}'.format(os.getuid())
+    return os.path.join(_base, 'mucad.sock')
+
+
+def check_directory(path):
+    """Check that only the user has access to the directory of the socket.
+
+    The default directory under /tmp has a predictable name, so another user
+    may have created it before.
+    Raises: PermissionError if the directory is a symbolic link, is owned by
+            another user or its mode is not 0700
+    """
+    _stat = os.lstat(path)
+    if not stat.S_ISDIR(_stat.st_mode):
+        raise PermissionError('socket directory is no directory: ' + path)
+    if _stat.st_uid != os.getuid():
+        raise PermissionError('socket directory owned by another user: '
+                              + path)
+    if stat.S_IMODE(_stat.st_mode) != 0o700:
+        raise PermissionError('socket directory with mode {:o}, not 700: {}'
+                              .format(stat.S_IMODE(_stat.st_mode), path))
+
+
+def _record(o_datagram):
+    """This returns the binary record of a datagram with the raw data or
+    None if it cannot be written."""
+    try:
+        return o_datagram.fbinary(raw=True)
+    except (ValueError, struct.error) as err:
+        _warning('datagram from %s skipped: %s', o_datagram.ipaddr, err)
+        return None
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    """Unix domain socket server with one thread for every client."""
+    daemon_threads = True
+    mucad = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answer the command of a client."""
+
+    def handle(self):
+        _args = self.rfile.readline(256).decode(errors='replace').split()
+        self.server.mucad.command(_args, self.wfile)
+
+
+class Daemon:
+    """Keep the state of devices and answer commands of local clients.
+
+    The daemon is the device table of its Listen and MsearchDevice objects.
+    Every received datagram updates the DeviceTable and is queued for every
+    subscriber. A subscriber that does not read looses datagrams if its queue
+    is full, they are counted in 'dropped'.
+    """
+    # Number of datagrams queued for a subscriber.
+    QUEUESIZE = 1024
+
+    _server = None
+
+    def __init__(self, path=None, scopes=None):
+        """Setup an empty device table.
+
+        Arguments: path = path of the Unix domain socket, default is
+                   socket_path()
+                   scopes = multicast scopes to listen and search, see
+                   Mcast.SCOPES, default is ipv4
+        """
+        self._path = socket_path() if path is None else path
+        self._scopes = scopes
+        self._devices = DeviceTable()
+        self._lock = threading.Lock()
+        self._search_lock = threading.Lock()
+        self._subscribers = []
+        self.dropped = 0
+
+    def update(self, o_datagram):
+        """Update the device state and publish the datagram to subscribers.
+
+        Returns: the former datagram of the device or None if it is new
+        """
+        with self._lock:
+            _o_former = self._devices.update(o_datagram)
+            _record_data = _record(o_datagram) if self._subscribers else None
+            if _record_data is not None:
+                for _queue in self._subscribers:
+                    try:
+                        _queue.put_nowait(_record_data)
+                    except queue.Full:
+                        self.dropped += 1
+        return _o_former
+
+    def open(self):
+        """Open the Unix domain socket and serve clients in the background.
+
+        Raises: OSError if the socket cannot be opened, PermissionError if
+                its directory is not safe, see check_directory()
+        """
+        _directory = os.path.dirname(self._path) or '.'
+        os.makedirs(_directory, mode=0o700, exist_ok=True)
+        check_directory(_directory)
+        # A socket left from a former daemon is replaced.
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+        self._server = _Server(self._path, _Handler)
+        self._server.mucad = self
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        """Stop serving clients and end all subscriptions."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        with self._lock:
+            for _queue in self._subscribers:
+                while not _queue.empty():
+                    _queue.get_nowait()
+                _queue.put_nowait(None)
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def search(self):
+        """Search for devices in a background thread.
+
+        Returns: False if a search is already running
+        """
+        if not self._search_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._search, daemon=True).start()
+        return True
+
+    def _search(self):
+        """Search for devices, the responses update the device table."""
+        try:
+            # The datagrams are not formated, they update the table.
+            for _ in MsearchDevice(devices=self, scopes=self._scopes):
+                pass
+        finally:
+            self._search_lock.release()
+
+    def run(self):
+        """Listen to the multicast groups until KeyboardInterrupt.
+
+        All groups are received by one Listen object in this thread. The
+        datagrams are not formated, they update the device table.
+        """
+        for _ in Listen(devices=self, scopes=self._scopes):
+            pass
+
+    def command(self, args, wfile):
+        """Answer the command of a client.
+
+        Arguments: args = command and its arguments
+                   wfile = writable stream to the client
+        """
+        _command = args[0].upper() if args else ''
+        if _command == 'LIST' and len(args) == 1:
+            self._answer(wfile, lambda _o_datagram: True)
+        elif _command == 'GET' and len(args) == 2:
+            _uuid = args[1][5:] if args[1].startswith('uuid:') else args[1]
+            self._answer(wfile, lambda _o_datagram: getattr(
+                _o_datagram, 'uuid', '') == _uuid)
+        elif _command == 'SEARCH' and len(args) == 1:
+            self.search()
+            wfile.write(b'OK\n')
+        elif _command == 'SUBSCRIBE' and len(args) == 1:
+            self._subscribe(wfile)
+        else:
+            wfile.write(b'ERROR unknown command: ' +
+                        ' '.join(args).encode() + b'\n')
+
+    def _answer(self, wfile, match):
+        """Send all devices that match."""
+        with self._lock:
+            self._devices.expire()
+            _records = [_record(_o_datagram) for _o_datagram in self._devices
+                        if match(_o_datagram)]
+        wfile.write(b'OK\n' + b''.join(_data for _data in _records
+                                       if _data is not None))
+
+    def _subscribe(self, wfile):
+        """Send every received datagram until the client closes."""
+        _queue = queue.Queue(self.QUEUESIZE)
+        with self._lock:
+            self._subscribers.append(_queue)
+        try:
+            wfile.write(b'OK\n')
+            while True:
+                _record = _queue.get()
+                if _record is None:
+                    break
+                wfile.write(_record)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.remove(_queue)
+
+
+def query(command, path=None):
+    """Send a command to the daemon and receive its answer.
+
+    This is a generator.
+    Returns: SSDPdatagram objects from the answer
+    Raises: OSError if the daemon is not running, ValueError if the daemon
+            answers with an error
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _sock:
+        _sock.connect(socket_path() if path is None else path)
+        _sock.sendall(command.encode() + b'\n')
+        with _sock.makefile('rb') as _file:
+            _status = _file.readline().decode(errors='replace').strip()
+            if _status != 'OK':
+                raise ValueError(_status or 'no answer from daemon')
+            for _record in read_records(_file):
+                _o_datagram = SSDPdatagram((_record['ip'], _record['port']),
+                                           _record['raw'] or None)
+                _o_datagram.timestamp = _record['ts']
+                _o_datagram.request = _record['request']
+                _o_datagram.interface = _record['interface']
+                yield _o_datagram
+
+
+class Client(Mcast):
+    """Get datagrams from a running daemon instead of the network."""
+    _verbose = False
+    _datagrams = None
+
+    def __init__(self, command, path=None, verbose=False, output='text'):
+        """Setup the command for the daemon and the output.
+
+        Arguments: command = LIST, GET <uuid>, SEARCH or SUBSCRIBE
+                   output = one of Mcast.OUTPUTS
+        """
+        self._command = command
+        self._path = path
+        self._verbose = verbose
+        self._output = output
+
+    def request(self):
+        """Send the command to the daemon."""
+        self._datagrams = query(self._command, self._path)
+
+    def get(self):
+        """Get the next datagram of the answer.
+
+        Returns: the formated datagram or None at the end of the answer
+        """
+        try:
+            return self._format(next(self._datagrams), 0)
+        except (StopIteration, KeyboardInterrupt):
+            return None
+
+
+def _terminate(signum, frame):  # pylint: disable=unused-argument
+    """Stop the daemon like <ctrl>C."""
+    raise KeyboardInterrupt()
+
+
+def main(argv=None, prog=None):
+    """This is the entry point of the program and the command line parser
+
+    Arguments: argv = command line arguments, default are the arguments of
+               the program
+               prog = name of the program in the help text
+    """
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Daemon that keeps the state of UPnP devices '
+        'for local clients, without a command it runs the daemon')
+    parser.add_argument("-V", "--version", action="store_true",
+                        help="show program version")
+    parser.add_argument("-s", "--socket", metavar="PATH",
+                        help="Unix domain socket of the daemon (default: {})"
+                        .format(socket_path()))
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-l", "--list", action="store_true",
+                       help="list the devices known by the daemon")
+    group.add_argument("-g", "--get", metavar="UUID",
+                       help="list the entries of one device")
+    group.add_argument("--search", action="store_true",
+                       help="let the daemon search for devices now")
+    group.add_argument("--subscribe", action="store_true",
+                       help="print every datagram received by the daemon, "
+                       "stop with <ctrl>C")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="verbose output of the client")
+    parser.add_argument("--scope", action="append", choices=list(Mcast.SCOPES),
+                        help="multicast scope of the daemon: ipv4, IPv6 "
+                        "link-local or site-local, may be repeated (default:"
+                        " ipv4)")
+    parser.add_argument("-f", "--format", choices=Client.OUTPUTS,
+                        default='text', help="output format of the client "
+                        "(default: text)")
+    args = parser.parse_args(argv)
+    if args.version:
+        print("Build", build())
+        return
+    _command = 'LIST' if args.list else 'GET ' + args.get if args.get else \
+        'SEARCH' if args.search else 'SUBSCRIBE' if args.subscribe else None
+    if _command is not None:
+        try:
+            print_it(Client(_command, path=args.socket, verbose=args.verbose,
+                            output=args.format))
+        except (OSError, ValueError) as err:
+            raise SystemExit("ERROR: {}".format(err))
+        return
+
+    signal.signal(signal.SIGTERM, _terminate)
+    o_daemon = Daemon(args.socket, scopes=args.scope)
+    try:
+        o_daemon.open()
+        o_daemon.search()
+        o_daemon.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        raise SystemExit("ERROR: {}".format(err))
+    finally:
+        o_daemon.close()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
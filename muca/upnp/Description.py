@@ -0,0 +1,166 @@
+"""Module to fetch device descriptions of UPnP devices.
+
+Every SSDP response and notify has a LOCATION header with the URL of the
+device description. Descriptions are downloaded concurrently with a bounded
+number of threads. HTTP connections are kept alive and reused for every host.
+Descriptions are cached with the unique identifier, BOOTID.UPNP.ORG and
+CONFIGID.UPNP.ORG of a device, so unchanged devices are not fetched again.
+"""
+
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+
+class DescriptionFetcher:
+    """Fetch and cache device descriptions from the LOCATION of datagrams."""
+
+    def __init__(self, workers=4, timeout=5):
+        """Setup the number of parallel downloads and the timeout (in sec)."""
+        self._workers = workers
+        self._timeout = timeout
+        # key -> description
+        self._cache = {}
+        # (host, port) -> list of idle connections
+        self._pool = {}
+        self._lock = threading.Lock()
+        self.errors = {}
+        self.hits = 0
+        self.fetched = 0
+        self.connections = 0
+
+    @staticmethod
+    def key(o_datagram):
+        """This returns the cache key of a datagram."""
+        return (getattr(o_datagram, 'uuid', ''),
+                getattr(o_datagram, 'bootid_upnp_org', ''),
+                getattr(o_datagram, 'configid_upnp_org', ''))
+
+    def _connection(self, host, port):
+        """This returns an idle connection to the host or a new one."""
+        with self._lock:
+            _idle = self._pool.get((host, port))
+            if _idle:
+                return _idle.pop(), True
+            self.connections += 1
+        return http.client.HTTPConnection(host, port,
+                                          timeout=self._timeout), False
+
+    def _release(self, host, port, conn):
+        """Put a connection back into the pool to keep it alive."""
+        with self._lock:
+            self._pool.setdefault((host, port), []).append(conn)
+
+    def _download(self, location):
+        """Download a description with a kept alive connection.
+
+        Returns: the description as bytes
+        Raises: OSError or http.client.HTTPException
+        """
+        _url = urlsplit(location)
+        if _url.scheme != 'http' or not _url.hostname:
+            raise ValueError('unsupported location: ' + location)
+        _path = _url.path or '/'
+        if _url.query:
+            _path += '?' + _url.query
+        _host, _port = _url.hostname, _url.port or 80
+        while True:
+            _conn, _reused = self._connection(_host, _port)
+            try:
+                _conn.request('GET', _path)
+                _response = _conn.getresponse()
+                _data = _response.read()
+            except (OSError, http.client.HTTPException):
+                _conn.close()
+                if _reused:
+                    # The host may have closed an idle connection, try again
+                    # with a new one.
+                    continue
+                raise
+            if _response.will_close:
+                _conn.close()
+            else:
+                self._release(_host, _port, _conn)
+            if _response.status != 200:
+                raise http.client.HTTPException('HTTP {} {}: {}'.format(
+                    _response.status, _response.reason, location))
+            return _data
+
+    def _fetch(self, key, location):
+        """Fetch a description into the cache.
+
+        Returns: the description or None on error
+        """
+        try:
+            _data = self._download(location)
+        except (OSError, ValueError, http.client.HTTPException) as err:
+            with self._lock:
+                self.errors[key] = str(err)
+            return None
+        with self._lock:
+            self._cache[key] = _data
+            self.errors.pop(key, None)
+            self.fetched += 1
+        return _data
+
+    def get(self, o_datagram):
+        """This returns the description of a datagram.
+
+        Returns: the description as bytes or None if it is not available
+        """
+        return self.fetch([o_datagram])[0][1]
+
+    def fetch(self, datagrams):
+        """Fetch the descriptions of many datagrams concurrently.
+
+        Datagrams of the same device and datagrams with cached descriptions
+        are only fetched once.
+        Returns: list of tuples (datagram, description) in the order of the
+        datagrams, description is None if it is not available.
+        """
+        _keys = []
+        _pending = {}
+        for _o_datagram in datagrams:
+            _key = self.key(_o_datagram)
+            _keys.append(_key)
+            if _key in self._cache:
+                self.hits += 1
+                continue
+            if _key in _pending:
+                continue
+            _location = getattr(_o_datagram, 'location', None)
+            if _location is None:
+                self.errors[_key] = 'no location'
+                continue
+            _pending[_key] = _location
+        if _pending:
+            with ThreadPoolExecutor(max_workers=self._workers) as _executor:
+                for _key, _location in _pending.items():
+                    _executor.submit(self._fetch, _key, _location)
+        return [(_o_datagram, self._cache.get(_key))
+                for _o_datagram, _key in zip(datagrams, _keys)]
+
+    def close(self):
+        """Close all kept alive connections."""
+        with self._lock:
+            _pool = self._pool
+            self._pool = {}
+        for _idle in _pool.values():
+            for _conn in _idle:
+                _conn.close()
+
+
+def friendly_name(description):
+    """This returns the friendlyName of the root device in a description."""
+    try:
+        _root = ElementTree.fromstring(description)
+    except ElementTree.ParseError:
+        return ''
+    for _element in _root.iter():
+        if _element.tag.rpartition('}')[2] == 'friendlyName':
+            return (_element.text or '').strip()
+    return ''
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
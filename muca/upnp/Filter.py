@@ -0,0 +1,286 @@
+"""Filter expressions over the fields of SSDP datagrams.
+
+An expression is compiled once into a predicate for SSDPdatagram objects, for
+example:
+
+    nt ~ "MediaRenderer" and nts == "ssdp:alive" and ip in 192.168.10.0/24
+
+Fields are the source 'ip' and 'port', the 'method' (NOTIFY, M-SEARCH or ""
+for a response), the 'interface' and every header as property name of
+SSDPdatagram, for example 'nt', 'location' or 'cache_control'. Operators are
+    field == value      equal
+    field != value      not equal
+    field ~ regex       the regular expression matches
+    field !~ regex      the regular expression does not match
+    ip in network       the source is in the network, for example 10.0.0.0/8
+    field               the header is available
+Values are words or strings in double quotes. Comparisons are combined with
+'and', 'or', 'not' and parentheses. A comparison with a missing header is
+false.
+
+The cheap clauses on the source, the method and the presence of headers are
+also checked on the raw datagram before it is parsed. Datagrams that fail
+this check are dropped without building a SSDPdatagram.
+"""
+
+import re
+import socket
+import ipaddress
+
+# Tokens: string in double quotes, operator or parenthesis, word, anything
+# else is an error.
+_TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|(==|!=|!~|~|\(|\))|'
+                    r'([^\s()"~=!]+)|(\S))')
+_FIELD = re.compile(r'[a-z][a-z0-9_]*$')
+_KEYWORDS = ('and', 'or', 'not', 'in')
+# Fields that are not headers of the datagram.
+_SOURCE = ('ip', 'port', 'method', 'interface')
+
+
+def _raw_method(data):
+    """This returns the method of a raw datagram like SSDPdatagram does."""
+    _end = data.find(b'\n')
+    _end = data.find(b' * HTTP', 0, len(data) if _end < 0 else _end)
+    return data[:_end].decode() if _end >= 0 else ''
+
+
+def _header_pattern(name):
+    """This returns a regex that finds the header of a property name.
+
+    Returns: compiled regex on bytes or None if the name cannot be checked
+             on the raw datagram
+    """
+    # 'uuid' is taken from the usn header and names with a leading 'x' may
+    # have been prefixed by SSDPdatagram.
+    if name == 'uuid' or name[0] == 'x':
+        return None
+    _name = ''.join('[^0-9a-z:\r\n]' if _c == '_' else re.escape(_c)
+                    for _c in name)
+    return re.compile(r'(?im)^[ \t]*{}[ \t]*:'.format(_name).encode())
+
+
+def _in_network(value):
+    """This returns a test if an ip address is in a network."""
+    try:
+        _network = ipaddress.ip_network(value, strict=False)
+    except ValueError as err:
+        raise ValueError('invalid network: {}'.format(err)) from None
+    if _network.version == 4:
+        _net = int(_network.network_address)
+        _mask = int(_network.netmask)
+
+        def _test(ipaddr):
+            try:
+                return int.from_bytes(socket.inet_aton(ipaddr),
+                                      'big') & _mask == _net
+            except OSError:
+                return False
+        return _test
+
+    def _test6(ipaddr):
+        try:
+            return ipaddress.ip_address(ipaddr) in _network
+        except ValueError:
+            return False
+    return _test6
+
+
+def _value_test(field, operator, value):
+    """This returns a test of a field value for a comparison."""
+    if operator == '==':
+        return lambda _value: _value == value
+    if operator == '!=':
+        return lambda _value: _value != value
+    if operator in ('~', '!~'):
+        try:
+            _search = re.compile(value).search
+        except re.error as err:
+            raise ValueError('invalid regex "{}": {}'.format(
+                value, err)) from None
+        if operator == '~':
+            return lambda _value: _search(_value) is not None
+        return lambda _value: _search(_value) is None
+    if field != 'ip':
+        raise ValueError('operator "in" is only available for ip')
+    return _in_network(value)
+
+
+def _comparison(field, operator=None, value=None):
+    """Compile a comparison or a presence check of a field.
+
+    Returns: tuple (predicate, raw check or None, raw check is exact)
+    """
+    if field in _SOURCE:
+        if operator is None:
+            raise ValueError('field "{}" needs a comparison'.format(field))
+        _test = _value_test(field, operator, value)
+        if field == 'ip':
+            return (lambda _o: _test(_o.ipaddr),
+                    lambda _addr, _data: _test(_addr[0]), True)
+        if field == 'port':
+            return (lambda _o: _test(_o.port),
+                    lambda _addr, _data: _test(str(_addr[1])), True)
+        if field == 'method':
+            return (lambda _o: _test(_o.method),
+                    lambda _addr, _data: _test(_raw_method(_data)), True)
+        return lambda _o: _test(_o.interface), None, False
+
+    _pattern = _header_pattern(field)
+    _present = None if _pattern is None else \
+        lambda _addr, _data: _pattern.search(_data) is not None
+    if operator is None:
+        return (lambda _o: _o.get(field) is not None, _present,
+                _present is not None)
+
+    _test = _value_test(field, operator, value)
+
+    def _predicate(o_datagram):
+        _value = o_datagram.get(field)
+        return _value is not None and _test(_value)
+    if operator != '==':
+        return _predicate, _present, False
+    # An equal value must be somewhere in the raw datagram.
+    _bytes = value.encode()
+    if _present is None:
+        return _predicate, lambda _addr, _data: _bytes in _data, False
+    return (_predicate, lambda _addr, _data: _bytes in _data and
+            _pattern.search(_data) is not None, False)
+
+
+def _and(left, right):
+    """Combine two compiled expressions with 'and'."""
+    _pred1, _raw1, _exact1 = left
+    _pred2, _raw2, _exact2 = right
+    if _raw1 is None or _raw2 is None:
+        _raw = _raw1 or _raw2
+    else:
+        def _raw(addr, data):
+            return _raw1(addr, data) and _raw2(addr, data)
+    return (lambda _o: _pred1(_o) and _pred2(_o), _raw,
+            _exact1 and _exact2)
+
+
+def _or(left, right):
+    """Combine two compiled expressions with 'or'."""
+    _pred1, _raw1, _exact1 = left
+    _pred2, _raw2, _exact2 = right
+    _raw = None
+    if _raw1 is not None and _raw2 is not None:
+        def _raw(addr, data):
+            return _raw1(addr, data) or _raw2(addr, data)
+    return (lambda _o: _pred1(_o) or _pred2(_o), _raw,
+            _exact1 and _exact2)
+
+
+def _not(operand):
+    """Negate a compiled expression.
+
+    Only an exact raw check can be negated.
+    """
+    _pred, _raw, _exact = operand
+    if not _exact:
+        return lambda _o: not _pred(_o), None, False
+    return (lambda _o: not _pred(_o),
+            lambda _addr, _data: not _raw(_addr, _data), True)
+
+
+class Filter:
+    """A compiled filter expression.
+
+    The object is a predicate that gets a SSDPdatagram. 'prematch' is a check
+    of the source address and the raw datagram before it is parsed, or None.
+    A datagram that fails the prematch does not match the expression. If
+    'exact' is True, the prematch decides alone and the datagram needs not
+    to be checked after parsing.
+    """
+
+    def __init__(self, expression):
+        """Compile the expression.
+
+        Raises: ValueError if the expression is invalid
+        """
+        self.expression = expression
+        self._tokens = []
+        for _match in _TOKEN.finditer(expression):
+            _string, _operator, _word, _error = _match.groups()
+            if _error is not None:
+                raise ValueError('unexpected "{}" at position {}'.format(
+                    _error, _match.start(4)))
+            if _string is not None:
+                self._tokens.append(
+                    ('value', re.sub(r'\\(.)', r'\1', _string[1:-1])))
+            elif _operator is not None:
+                self._tokens.append(('op', _operator))
+            elif _word in _KEYWORDS:
+                self._tokens.append(('op', _word))
+            elif _word is not None:
+                self._tokens.append(('word', _word))
+        self._pos = 0
+        _predicate, self.prematch, self.exact = self._or()
+        if self._pos < len(self._tokens):
+            raise ValueError('unexpected "{}"'.format(
+                self._tokens[self._pos][1]))
+        self.exact = self.exact and self.prematch is not None
+        self._predicate = _predicate
+        del self._tokens
+
+    def __call__(self, o_datagram):
+        """This returns True if the datagram matches the expression."""
+        return self._predicate(o_datagram)
+
+    def __repr__(self):
+        return 'Filter({!r})'.format(self.expression)
+
+    def _next(self, *operators):
+        """This returns the next token if it is one of the operators."""
+        if self._pos < len(self._tokens):
+            _kind, _value = self._tokens[self._pos]
+            if _kind == 'op' and _value in operators:
+                self._pos += 1
+                return _value
+        return None
+
+    def _or(self):
+        """or: and ('or' and)*"""
+        _result = self._and()
+        while self._next('or'):
+            _result = _or(_result, self._and())
+        return _result
+
+    def _and(self):
+        """and: not ('and' not)*"""
+        _result = self._not()
+        while self._next('and'):
+            _result = _and(_result, self._not())
+        return _result
+
+    def _not(self):
+        """not: 'not' not | atom"""
+        if self._next('not'):
+            return _not(self._not())
+        return self._atom()
+
+    def _atom(self):
+        """atom: '(' or ')' | field [operator value]"""
+        if self._next('('):
+            _result = self._or()
+            if not self._next(')'):
+                raise ValueError('missing ")"')
+            return _result
+        if self._pos >= len(self._tokens):
+            raise ValueError('unexpected end of expression')
+        _kind, _field = self._tokens[self._pos]
+        if _kind != 'word' or not _FIELD.match(_field):
+            raise ValueError('field expected instead of "{}"'.format(_field))
+        self._pos += 1
+        _operator = self._next('==', '!=', '~', '!~', 'in')
+        if _operator is None:
+            return _comparison(_field)
+        if self._pos >= len(self._tokens) or \
+                self._tokens[self._pos][0] == 'op':
+            raise ValueError('value expected after "{}"'.format(_operator))
+        _value = self._tokens[self._pos][1]
+        self._pos += 1
+        return _comparison(_field, _operator, _value)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,103 @@
+"""Response latencies of UPnP devices to search requests.
+
+A device answers a M-SEARCH after a random delay of up to MX seconds. The
+latency of a response is the time from sending the request until the kernel
+has received the response, both from the monotonic clock in nanoseconds. The
+first response of every device to every request is counted in a histogram
+with buckets relative to MX, so slow devices and a too small or too large MX
+can be seen.
+"""
+
+from bisect import bisect_left
+
+from muca.Metrics import Histogram
+
+
+class DeviceLatency(Histogram):
+    """Latencies of the responses of one device.
+
+    The histogram counts the latency as fraction of MX, the sum, minimum and
+    maximum are in seconds.
+    """
+    # Upper bounds of the buckets (fraction of MX).
+    BUCKETS = (0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0)
+
+    def __init__(self, address):
+        """Setup empty buckets for the device at address (ip:port)."""
+        super().__init__()
+        self.address = address
+        self.min = None
+        # Numbers of the requests the device has answered.
+        self.requests = set()
+
+    def observe_ns(self, latency_ns, mx, request):
+        """Count the latency (in ns) of a response to a request with MX."""
+        _seconds = max(latency_ns, 0) / 1e9
+        self.counts[bisect_left(self.BUCKETS,
+                                _seconds / mx if mx else 0.0)] += 1
+        self.count += 1
+        self.sum += _seconds
+        if _seconds > self.max:
+            self.max = _seconds
+        if self.min is None or _seconds < self.min:
+            self.min = _seconds
+        self.requests.add(request)
+
+
+class LatencyReport:
+    """Latencies of all devices over the requests of a search.
+
+    MsearchDevice calls request() for every request it sends and observe()
+    for the first response of a device to it.
+    """
+
+    def __init__(self):
+        """Setup an empty report."""
+        self.requests = 0
+        self.mx = 0
+        self._devices = {}
+
+    def request(self, mx):
+        """Count a request with the response time MX (in sec)."""
+        self.requests += 1
+        self.mx = mx
+
+    def observe(self, key, address, latency_ns, request):
+        """Count the latency of a device (uuid or ip) to a request."""
+        _device = self._devices.get(key)
+        if _device is None:
+            _device = self._devices[key] = DeviceLatency(address)
+        _device.observe_ns(latency_ns, self.mx, request)
+
+    def stats(self):
+        """This returns the report as dictionary."""
+        _devices = {}
+        for _key, _device in self._devices.items():
+            _stats = _device.stats()
+            _stats['address'] = _device.address
+            _stats['min'] = _device.min or 0.0
+            _stats['answered'] = len(_device.requests)
+            _devices[_key] = _stats
+        return {'requests': self.requests, 'mx': self.mx,
+                'devices': _devices}
+
+    def freport(self):
+        """This returns the report formated for printing, the slowest
+        device first."""
+        _stats = self.stats()
+        _lines = ['latency of {} request(s) with MX {}s, buckets of MX: {}'
+                  .format(_stats['requests'], _stats['mx'], ' '.join(
+                      '<={:g}'.format(_bound)
+                      for _bound in DeviceLatency.BUCKETS) + ' more')]
+        for _key, _device in sorted(_stats['devices'].items(),
+                                    key=lambda _item: -_item[1]['mean']):
+            _lines.append(
+                '{} {} answered {}/{} min {:.1f}ms mean {:.1f}ms max {:.1f}ms'
+                ' [{}]'.format(_key, _device['address'], _device['answered'],
+                               _stats['requests'], _device['min'] * 1e3,
+                               _device['mean'] * 1e3, _device['max'] * 1e3,
+                               ' '.join(str(_count) for _count in
+                                        _device['buckets'].values())))
+        return '\n'.join(_lines)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
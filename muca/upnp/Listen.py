@@ -1,65 +1,730 @@
 #!/usr/bin/env python3
 """module to discover UPnP devices"""
 
+import os
+import sys
 import socket
 import argparse
 import struct
-from time import time
+from time import time, time_ns, perf_counter
 
 from muca.Common import build
-from muca.upnp.Common import SSDPdatagram, Mcast
+from muca.upnp.Common import SSDPdatagram, Mcast, StormFilter, ChangeTable, \
+                             ANCBUFSIZE, interfaces6, print_losses, _warning
 
 
 class Listen(Mcast):
     """Passive listen for notifies from devices on the local network
 
-    We are only listen to the upnp multicast group.
+    We are only listen to the upnp multicast groups of the scopes, see
+    Mcast.SCOPES. IPv4 and IPv6 groups are received on two sockets that are
+    serviced by one selector. If a DeviceTable is given,
+    every received datagram updates it. If a StormFilter is given, it is
+    applied to the raw data of every datagram before it is parsed. Datagrams
+    that do not match a filter are dropped before they update the
+    DeviceTable. If a ChangeTable is given, only the datagrams that change
+    the state of a device are returned and expired devices are returned at
+    their expiry time, see _get_change().
     """
     _verbose = False
     _open_timestamp = 0
     _timeout = 0
     _sock = None
     _o_datagram = None
+    _devices = None
+    _storm = None
+    _changes = None
+    # Changes not returned yet.
+    _pending = None
 
-    def __init__(self, verbose=False):
-        """Setup verbose output if requested."""
+    def __init__(self, verbose=False, devices=None, output='text',
+                 storm=None, metrics=None, rcvbuf=None, match=None,
+                 scopes=None, changes=None):
+        """Setup verbose output if requested and the table of devices.
+
+        Arguments: output = one of Mcast.OUTPUTS
+                   storm = StormFilter or None
+                   metrics = muca.Metrics.Metrics or None
+                   rcvbuf = size of the kernel receive buffer, see
+                   Mcast.RCVBUF
+                   match = muca.upnp.Filter.Filter or None, see
+                   Mcast._setup_match()
+                   scopes = keys of Mcast.SCOPES, default is ipv4
+                   changes = ChangeTable or None, not used by ListenBatch
+                   and ListenPipeline
+        Raises: ValueError if a scope is unknown
+        """
+        if rcvbuf is not None:
+            self.RCVBUF = rcvbuf
+        self._setup_scopes(scopes)
         self._verbose = verbose
+        self._devices = devices
+        self._output = output
+        self._storm = storm
+        self._metrics = metrics
+        self._changes = changes
+        self._setup_match(match)
 
     def open(self):
         """Initialize and open a connection and join to the multicast group"""
 
         self._open_timestamp = time()
         self._timeout = -1
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                   socket.IPPROTO_UDP)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # use MCAST_GRP instead of '' to listen only to MCAST_GRP,
-        # not all groups on MCAST_PORT
-        # self._sock.bind(('', self._MCAST_PORT))
-        self._sock.bind((self._MCAST_GRP, self._MCAST_PORT))
-        mreq = struct.pack("4sl", socket.inet_aton(self._MCAST_GRP),
-                           socket.INADDR_ANY)
-        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
-                              mreq)
-
-    def _get_datagram(self):
-        """Listen to the next SSDP datagram on the local network"""
+        self._pending = []
+        self._sock = None
+        self._sock6 = None
+        self._selector = None
+        if 'ipv4' in self._scopes:
+            self._sock = self._open4(self._MCAST_GRP, self._MCAST_PORT)
+        if self._groups6():
+            self._sock6 = self._open6()
+            if self._sock is None:
+                self._sock = self._sock6
+            else:
+                self._register(self._sock)
+                self._register(self._sock6)
+
+    def _open6(self):
+        """Open a connection and join to the IPv6 multicast groups.
+
+        The socket is bound to the wildcard address because it receives more
+        than one group. Every group is joined on all interfaces.
+        Returns: the IPv6 socket
+        """
+        _sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM,
+                              socket.IPPROTO_UDP)
+        _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        self._setup_socket(_sock)
+        _sock.bind(('::', self._MCAST_PORT))
+        _interfaces = interfaces6()
+        for _, _group in self._groups6():
+            _joined = 0
+            for _, _index in _interfaces:
+                mreq = socket.inet_pton(socket.AF_INET6, _group) + \
+                    struct.pack('@I', _index)
+                try:
+                    _sock.setsockopt(socket.IPPROTO_IPV6,
+                                     socket.IPV6_JOIN_GROUP, mreq)
+                    _joined += 1
+                except OSError:
+                    # interface without IPv6 or multicast
+                    continue
+            if _joined == 0:
+                _warning('multicast group %s not joined on any interface',
+                         _group)
+        return _sock
+
+    def _get_datagram(self, wakeup=0):
+        """Listen to the next SSDP datagram on the local network
+
+        Arguments: wakeup = wall clock time to return with _o_datagram None
+                   if nothing has been received until then, None waits
+                   without limit, 0 leaves the timeout of the socket as it is
+        """
         if self._timeout != 0:
             try:
-                data, addr = self._sock.recvfrom(self.RECVBUF)
-                if len(data) >= self.RECVBUF:
-                    raise SystemExit("ERROR: receive buffer overflow")
-                self._o_datagram = SSDPdatagram(addr, data)
+                while True:
+                    _tout = None
+                    if wakeup:
+                        _tout = wakeup - time()
+                        if _tout <= 0:
+                            raise socket.timeout()
+                    if self._selector is not None:
+                        _received = self._recv(self._select(_tout).fileobj)
+                    else:
+                        if wakeup != 0:
+                            self._sock.settimeout(_tout)
+                        _received = self._recv(self._sock)
+                    if _received is None:
+                        continue
+                    data, addr, rxtime = _received
+                    if self._storm is not None and \
+                            not self._storm.accept(addr[0], data, time()):
+                        continue
+                    self._o_datagram = self._parse(addr, data, rxtime)
+                    if self._postmatch is None or \
+                            self._postmatch(self._o_datagram):
+                        break
+                if self._devices is not None:
+                    self._devices.update(self._o_datagram)
+            except socket.timeout:
+                self._o_datagram = None
             except KeyboardInterrupt:
                 self._timeout = 0
 
+    def _get_change(self):
+        """Listen until the state of a device changes.
+
+        The datagram with the change is in _o_datagram. Renewals without
+        change are skipped. The receiving wakes up at the next expiry time of
+        the ChangeTable to return the expired devices in time.
+        """
+        while not self._pending:
+            self._get_datagram(self._changes.wakeup())
+            if self._timeout == 0:
+                return
+            if self._o_datagram is None:
+                self._pending = self._changes.expire(time())
+            else:
+                self._pending = self._changes.update(self._o_datagram)
+        self._o_datagram = self._pending.pop(0)
+
     def get(self):
-        """Listen for upnp datagrams on the local network."""
-        self._get_datagram()
+        """Listen for upnp datagrams on the local network.
+
+        Returns: the next datagram formated in the selected output or None if
+        listening has been terminated.
+        """
+        if self._changes is None:
+            self._get_datagram()
+        else:
+            self._get_change()
+        if self._timeout == 0:
+            return
+        return self._format(self._o_datagram, self._open_timestamp)
+
+    def __iter__(self):
+        """Listen for upnp datagrams on the local network.
+
+        This is a generator. It opens the connection if it is not open and
+        yields SSDPdatagram objects until listening has been terminated. The
+        datagrams are not formated:
+
+            for o_datagram in Listen():
+                print(o_datagram.ipaddr, getattr(o_datagram, 'nt', ''))
+        """
+        if self._timeout == 0:
+            self.open()
+        while True:
+            if self._changes is None:
+                self._get_datagram()
+            else:
+                self._get_change()
+            if self._timeout == 0:
+                return
+            yield self._o_datagram
+
+
+class ListenBatch(Listen):
+    """Passive listen and drain all queued datagrams on every wakeup.
+
+    A blocking receive waits for the next datagram. Then all other datagrams
+    already queued on the socket are fetched without blocking into a
+    preallocated ring of receive buffers. The whole batch is parsed and
+    formated in one go, so bursts of notifies need less system calls and
+    allocations per datagram.
+    """
+    # Number of receive buffers in the ring. It limits the size of a batch.
+    RINGSIZE = 64
+
+    _ring = None
+    _slots = None
+    _batches = 0
+    _datagrams = 0
+    _max_batch = 0
+    _histogram = None
+
+    def open(self):
+        """Open the connection and allocate the ring of receive buffers."""
+        super().open()
+        self._ring = memoryview(bytearray(self.RECVBUF * self.RINGSIZE))
+        # Every slot is a list with one buffer for recvmsg_into().
+        self._slots = [[self._ring[i:i+self.RECVBUF]] for i in
+                       range(0, self.RECVBUF * self.RINGSIZE, self.RECVBUF)]
+        self._batches = 0
+        self._datagrams = 0
+        self._max_batch = 0
+        # Batch sizes are counted in power of two buckets: 1, 2-3, 4-7, ...
+        self._histogram = [0] * self.RINGSIZE.bit_length()
+
+    def _get_batch(self):
+        """Receive the next batch of SSDP datagrams on the local network.
+
+        Returns: list with tuples of (address, raw datagram, kernel receive
+                 time or None)
+        """
+        _batch = []
         if self._timeout == 0:
+            return _batch
+        _prematch = self._prematch
+        try:
+            # With more than one socket the batch is drained from the next
+            # readable socket.
+            _sock = self._sock if self._selector is None \
+                else self._select().fileobj
+            _recv = _sock.recvmsg_into
+            # The first receive blocks until there is data available.
+            for _slot in self._slots:
+                try:
+                    if _batch:
+                        _nbytes, _ancdata, _flags, _addr = _recv(
+                            _slot, ANCBUFSIZE, socket.MSG_DONTWAIT)
+                    else:
+                        _nbytes, _ancdata, _flags, _addr = _recv(
+                            _slot, ANCBUFSIZE)
+                except BlockingIOError:
+                    break
+                _rxtime = self._ancillary(_sock, _ancdata) if _ancdata \
+                    else None
+                if _flags & socket.MSG_TRUNC:
+                    self._truncate(_addr)
+                    continue
+                _data = bytes(_slot[0][:_nbytes])
+                if _prematch is None or _prematch(_addr, _data):
+                    _batch.append((_addr, _data, _rxtime))
+        except KeyboardInterrupt:
+            self._timeout = 0
+        if _batch:
+            self._batches += 1
+            self._datagrams += len(_batch)
+            self._max_batch = max(self._max_batch, len(_batch))
+            self._histogram[len(_batch).bit_length() - 1] += 1
+        return _batch
+
+    def _get_datagrams(self):
+        """Listen for the next batch of upnp datagrams on the local network.
+
+        Returns: list of SSDPdatagram objects or None if listening has been
+        terminated.
+        """
+        _parse = self._parse
+        while True:
+            _batch = self._get_batch()
+            if not _batch:
+                if self._timeout == 0:
+                    return
+                # All datagrams of the batch failed the filter.
+                continue
+            if self._storm is not None:
+                _accept = self._storm.accept
+                _now = time()
+                _batch = [_item for _item in _batch
+                          if _accept(_item[0][0], _item[1], _now)]
+            _datagrams = [_parse(_addr, _data, _rxtime)
+                          for _addr, _data, _rxtime in _batch]
+            if self._postmatch is not None:
+                _datagrams = [_o_datagram for _o_datagram in _datagrams
+                              if self._postmatch(_o_datagram)]
+            if _datagrams:
+                break
+        if self._devices is not None:
+            for _o_datagram in _datagrams:
+                self._devices.update(_o_datagram)
+        return _datagrams
+
+    def get(self):
+        """Listen for the next batch of upnp datagrams on the local network.
+
+        Returns: formated datagrams of the batch as one string or None if
+        listening has been terminated.
+        """
+        _datagrams = self._get_datagrams()
+        if _datagrams is None:
             return
-        return self._o_datagram.fdevice(base_time=self._open_timestamp,
-                                        verbose=self._verbose)
+        _base_time = self._open_timestamp
+        _records = [self._format(_o_datagram, _base_time)
+                    for _o_datagram in _datagrams]
+        return (b'' if self._output == 'binary' else '').join(_records)
+
+    def __iter__(self):
+        """Listen for upnp datagrams on the local network in batches.
+
+        This is a generator that yields the SSDPdatagram objects of every
+        batch, see Listen.__iter__().
+        """
+        if self._timeout == 0:
+            self.open()
+        _datagrams = self._get_datagrams()
+        while _datagrams is not None:
+            yield from _datagrams
+            _datagrams = self._get_datagrams()
+
+    def stats(self):
+        """This returns the batch size statistics as dictionary."""
+        return {
+            'batches': self._batches,
+            'datagrams': self._datagrams,
+            'max': self._max_batch,
+            'mean': (self._datagrams / self._batches if self._batches
+                     else 0.0),
+            'histogram': {
+                '{}-{}'.format(1 << i, (2 << i) - 1): count
+                for i, count in enumerate(self._histogram or []) if count}}
+
+    def fstats(self):
+        """This returns the batch size statistics formated for printing."""
+        _stats = self.stats()
+        return 'batches: {} datagrams: {} mean: {:.2f} max: {} {}'.format(
+            _stats['batches'], _stats['datagrams'], _stats['mean'],
+            _stats['max'], ' '.join(
+                '[{}]: {}'.format(size, count)
+                for size, count in _stats['histogram'].items()))
+
+
+class _Worker(Mcast):
+    """Parse, filter and format batches of datagrams in a worker process."""
+
+    def __init__(self, output, fields, template, verbose, base_time, match,
+                 keep, measure=False):
+        """Setup the output like the Listen object that receives.
+
+        Arguments: match = callable that gets a SSDPdatagram and returns
+                   False to drop it, or None
+                   keep = return the SSDPdatagram objects too
+                   measure = measure the time to parse and format
+        """
+        self._output = output
+        self.FIELDS = fields
+        self.TEMPLATE = template
+        self._verbose = verbose
+        self._base_time = base_time
+        self._match = match
+        self._keep = keep
+        self._measure = measure
+
+    def work(self, batch, formated):
+        """Parse, filter and format a batch.
+
+        Arguments: batch = list of tuples (receive time in nanoseconds since
+                   the epoch, address, raw datagram)
+                   formated = format the datagrams
+        Returns: tuple (list of formated datagrams or None if not formated,
+                 list of SSDPdatagram objects or empty list if they are
+                 formated and not kept, muca.Metrics.Metrics of the batch or
+                 None if not measured)
+        """
+        _records = [] if formated else None
+        _datagrams = []
+        _keep = self._keep or not formated
+        _match = self._match
+        if self._measure:
+            # pylint: disable=import-outside-toplevel
+            from muca.Metrics import Metrics
+            self._metrics = Metrics()
+        _metrics = self._metrics
+        for _rxtime, _addr, _data in batch:
+            # The receiver has counted the datagrams, only the parse time is
+            # measured.
+            if _metrics is None:
+                _o_datagram = SSDPdatagram(_addr, _data)
+            else:
+                _start = perf_counter()
+                _o_datagram = SSDPdatagram(_addr, _data)
+                _metrics.observe('parse', perf_counter() - _start)
+            _o_datagram.set_rxtime(_rxtime)
+            if _match is not None and not _match(_o_datagram):
+                continue
+            if formated:
+                _records.append(self._format(_o_datagram, self._base_time))
+            if _keep:
+                _datagrams.append(_o_datagram)
+        return _records, _datagrams, _metrics
+
+
+# _Worker object of a worker process, set by _init_worker().
+_worker = None
+
+
+def _init_worker(o_worker):
+    """Setup a worker process."""
+    import signal  # pylint: disable=import-outside-toplevel
+    global _worker  # pylint: disable=global-statement
+    _worker = o_worker
+    # <ctrl>C stops the main process, it shuts down the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _work(batch, formated):
+    """Process a batch in a worker process."""
+    return _worker.work(batch, formated)
+
+
+class ListenPipeline(Listen):
+    """Passive listen with parsing and formating in worker processes.
+
+    A receiver thread only receives and timestamps the raw datagrams and
+    applies the StormFilter. The datagrams are collected in batches and
+    parsed, filtered and formated by a pool of worker processes. get() returns
+    the results of the batches in arrival order, so the socket is emptied
+    while the datagrams of former batches are still formated. On iteration
+    the workers only parse and filter.
+
+    The worker processes are forked on open(), so the match function needs
+    not to be pickled.
+    """
+    # Maximal number of datagrams in a batch.
+    BATCHSIZE = 256
+    # Maximal time (in sec) a received datagram waits for its batch to fill.
+    LATENCY = 0.05
+
+    _workers = 1
+    # The workers format the datagrams of the next batches.
+    _formated = True
+    _pool = None
+    _results = None
+    _receiver = None
+    _stop = None
+
+    def __init__(self, verbose=False, devices=None, output='text',
+                 storm=None, metrics=None, rcvbuf=None, workers=None,
+                 match=None, scopes=None):
+        """Setup the output and the worker processes.
+
+        Arguments: workers = number of worker processes, default is the
+                   number of CPUs
+                   match = muca.upnp.Filter.Filter or a callable, the
+                   parsed datagrams are checked in the workers
+        """
+        super().__init__(verbose=verbose, devices=devices, output=output,
+                         storm=storm, metrics=metrics, rcvbuf=rcvbuf,
+                         match=match, scopes=scopes)
+        self._workers = workers or os.cpu_count() or 1
+
+    def open(self):
+        """Open the connection, start the workers and the receiver thread."""
+        # pylint: disable=import-outside-toplevel
+        import queue
+        import threading
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        super().open()
+        if self._selector is None:
+            self._sock.settimeout(self.LATENCY)
+        self._pool = ProcessPoolExecutor(
+            self._workers, mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker, initargs=(_Worker(
+                self._output, self.FIELDS, self.TEMPLATE, self._verbose,
+                self._open_timestamp, self._postmatch,
+                self._devices is not None, self._metrics is not None),))
+        # All workers are forked on the first job, before the receiver
+        # thread exists.
+        self._pool.submit(int).result()
+        # Futures of the submitted batches in arrival order, None at the end.
+        self._results = queue.Queue(self._workers * 4)
+        self._stop = threading.Event()
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def _submit(self, batch):
+        """Submit a batch to the workers."""
+        self._put(self._pool.submit(_work, batch, self._formated))
+
+    def _put(self, item):
+        """Queue a result for get() unless listening has been stopped."""
+        import queue  # pylint: disable=import-outside-toplevel
+        while not self._stop.is_set():
+            try:
+                self._results.put(item, timeout=self.LATENCY)
+                return
+            except queue.Full:
+                pass
+
+    def _receive(self):
+        """Receive datagrams and submit them in batches to the workers.
+
+        This runs in the receiver thread. A batch is submitted if it is full
+        or if there are no more datagrams within LATENCY.
+        """
+        _batch = []
+        _storm = self._storm
+        _metrics = self._metrics
+        try:
+            while not self._stop.is_set():
+                try:
+                    _received = self._recv(
+                        self._sock if self._selector is None
+                        else self._select(self.LATENCY).fileobj)
+                except socket.timeout:
+                    if _batch:
+                        self._submit(_batch)
+                        _batch = []
+                    continue
+                if _received is None:
+                    continue
+                _data, _addr, _rxtime = _received
+                if _rxtime is None:
+                    _rxtime = time_ns()
+                if _storm is not None and \
+                        not _storm.accept(_addr[0], _data, _rxtime / 1e9):
+                    continue
+                if _metrics is not None:
+                    _metrics.count('datagrams_received')
+                    _metrics.count('bytes_received', len(_data))
+                _batch.append((_rxtime, _addr, _data))
+                if len(_batch) >= self.BATCHSIZE:
+                    self._submit(_batch)
+                    _batch = []
+        except (OSError, KeyboardInterrupt):
+            # The socket has been closed or the input has ended.
+            pass
+        finally:
+            if _batch and not self._stop.is_set():
+                self._submit(_batch)
+            self._put(None)
+
+    def _get_results(self):
+        """Get the results of the next batch from the workers.
+
+        The metrics of the workers are added to the metrics of this object.
+        The receiver thread and the workers are stopped at the end and if a
+        worker has failed.
+        Returns: tuple (list of formated datagrams or None, list of
+        SSDPdatagram objects) or None if listening has been terminated.
+        Raises: the exception of a failed worker
+        """
+        try:
+            while self._timeout != 0:
+                try:
+                    _future = self._results.get()
+                    if _future is None:
+                        break
+                    _records, _datagrams, _metrics = _future.result()
+                except KeyboardInterrupt:
+                    break
+                if _metrics is not None:
+                    self._metrics.merge(_metrics)
+                if self._devices is not None:
+                    for _o_datagram in _datagrams:
+                        self._devices.update(_o_datagram)
+                if _records or _datagrams:
+                    return _records, _datagrams
+        except BaseException:
+            self.close()
+            raise
+        self.close()
+        return None
+
+    def get(self):
+        """Get the next batch of upnp datagrams from the workers.
+
+        Returns: formated datagrams of the batch as one string or None if
+        listening has been terminated.
+        """
+        self._formated = True
+        _results = self._get_results()
+        if _results is None:
+            return None
+        _records, _datagrams = _results
+        if _records is None:
+            # The batch has been submitted during an iteration.
+            _records = [self._format(_o_datagram, self._open_timestamp)
+                        for _o_datagram in _datagrams]
+        return (b'' if self._output == 'binary' else '').join(_records)
+
+    def __iter__(self):
+        """Get the upnp datagrams from the workers.
+
+        This is a generator that yields the SSDPdatagram objects of every
+        batch, see Listen.__iter__(). The workers do not format them.
+        """
+        self._formated = False
+        if self._timeout == 0:
+            self.open()
+        _results = self._get_results()
+        while _results is not None:
+            yield from _results[1]
+            _results = self._get_results()
+
+    def close(self):
+        """Stop the receiver thread and the workers and close the socket."""
+        self._timeout = 0
+        if self._pool is None:
+            return
+        self._stop.set()
+        self._receiver.join()
+        self._pool.shutdown(cancel_futures=True)
+        self._pool = None
+        self._close_sockets()
+
+
+class ListenPcap(Listen):
+    """Listen to SSDP datagrams from a capture file instead of the network.
+
+    UDP datagrams from or to the upnp port are read from a pcap or pcapng
+    file. The datagrams get the timestamps from the capture and the time
+    base is the first datagram. The number of datagrams and the throughput
+    are counted.
+    """
+    _filename = ''
+    _datagrams = None
+    _count = 0
+    _elapsed = 0.0
+
+    def __init__(self, filename, verbose=False, devices=None, output='text',
+                 storm=None, metrics=None, match=None, changes=None):
+        """Setup the capture file to read.
+
+        With a ChangeTable devices expire by the capture time of the
+        following datagrams.
+        """
+        super().__init__(verbose=verbose, devices=devices, output=output,
+                         storm=storm, metrics=metrics, match=match,
+                         changes=changes)
+        self._filename = filename
+
+    def open(self):
+        """Open the capture file."""
+        # pylint: disable=import-outside-toplevel
+        from muca.Pcap import udp_datagrams
+        self._open_timestamp = 0
+        self._timeout = -1
+        self._pending = []
+        self._count = 0
+        self._elapsed = 0.0
+        self._datagrams = udp_datagrams(self._filename,
+                                        ports=(self._MCAST_PORT,))
+
+    def _get_datagram(self, wakeup=0):  # pylint: disable=unused-argument
+        """Read the next SSDP datagram from the capture file.
+
+        The wakeup time is not used, a capture has no waiting.
+        """
+        if self._timeout == 0:
+            return
+        _start = perf_counter()
+        try:
+            while True:
+                _timestamp, addr, _, data = next(self._datagrams)
+                if self._prematch is not None and \
+                        not self._prematch(addr, data):
+                    continue
+                # The filter uses the capture time.
+                if self._storm is not None and \
+                        not self._storm.accept(addr[0], data, _timestamp):
+                    continue
+                self._o_datagram = self._parse(addr, data)
+                if self._postmatch is None or \
+                        self._postmatch(self._o_datagram):
+                    break
+        except (StopIteration, KeyboardInterrupt):
+            self._timeout = 0
+            return
+        except (OSError, ValueError) as err:
+            raise SystemExit("ERROR: {}".format(err))
+        self._o_datagram.timestamp = _timestamp
+        if self._open_timestamp == 0:
+            self._open_timestamp = _timestamp
+        if self._devices is not None:
+            self._devices.update(self._o_datagram)
+        self._count += 1
+        self._elapsed += perf_counter() - _start
+
+    def stats(self):
+        """This returns the number of datagrams and throughput as dictionary.
+
+        The throughput counts reading and parsing of the datagrams.
+        """
+        return {
+            'datagrams': self._count,
+            'seconds': self._elapsed,
+            'rate': self._count / self._elapsed if self._elapsed else 0.0}
+
+    def fstats(self):
+        """This returns the throughput formated for printing."""
+        _stats = self.stats()
+        return 'datagrams: {} seconds: {:.3f} rate: {:.0f} datagrams/s'.format(
+            _stats['datagrams'], _stats['seconds'], _stats['rate'])
 
 
 def print_it(o_mcast):
@@ -74,27 +739,162 @@ def print_it(o_mcast):
     o_mcast.open()
     datagram = o_mcast.get()
     while datagram is not None:
-        print(datagram, end='', flush=True)
+        if isinstance(datagram, bytes):
+            sys.stdout.buffer.write(datagram)
+            sys.stdout.buffer.flush()
+        else:
+            print(datagram, end='', flush=True)
         datagram = o_mcast.get()
 
 
-def main():
-    """This is the entry point of the program and the command line parser"""
+def main(argv=None, prog=None):
+    """This is the entry point of the program and the command line parser
+
+    Arguments: argv = command line arguments, default are the arguments of
+               the program
+               prog = name of the program in the help text
+    """
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Passive listen to UPnP datagrams, stop with <ctrl>+C')
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-v", "--verbose", action="store_true",
                        help="verbose output")
     group.add_argument("-V", "--version", action="store_true",
                        help="show program version")
-    args = parser.parse_args()
-    if args.verbose:
-        print_it(Listen(verbose=True))
-    elif args.version:
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="drain all queued datagrams on every wakeup and"
+                        " report batch size statistics on exit")
+    parser.add_argument("-p", "--pipeline", type=int, nargs="?", const=0,
+                        metavar="N", help="parse and format in N worker "
+                        "processes (default: number of CPUs)")
+    parser.add_argument("-r", "--read", metavar="FILE",
+                        help="read datagrams from a pcap or pcapng capture"
+                        " file and report the throughput on exit")
+    parser.add_argument("-f", "--format", choices=Listen.OUTPUTS,
+                        default='text', help="output format, verbose adds "
+                        "the whole datagram (default: text)")
+    parser.add_argument("-H", "--header", action="append", metavar="NAME",
+                        help="header field for ndjson and binary output, may"
+                        " be repeated (default: {})".format(
+                            ' '.join(Listen.FIELDS)))
+    parser.add_argument("-T", "--template", metavar="TEMPLATE",
+                        help="format of the text output, for example: "
+                        "\"{ts} {ip} {uuid} {nt}\"")
+    parser.add_argument("-F", "--filter", metavar="EXPR",
+                        help="print only datagrams that match the filter "
+                        "expression, for example: nts == ssdp:alive and "
+                        "ip in 192.168.10.0/24")
+    parser.add_argument("-c", "--changes", action="store_true",
+                        help="print only state changes of the devices: new,"
+                        " byebye, changed location, bootid or configid and "
+                        "expired without renewal")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not update the persistent device cache")
+    parser.add_argument("--rate", type=float, metavar="N",
+                        help="limit the datagrams of every source to N per "
+                        "second and report suppressed datagrams on exit")
+    parser.add_argument("--burst", type=int, metavar="N",
+                        help="allow bursts of N datagrams with --rate "
+                        "(default: datagrams of one second)")
+    parser.add_argument("--dedupe", type=float, metavar="SEC",
+                        help="drop identical datagrams repeated within SEC "
+                        "and report suppressed datagrams on exit")
+    parser.add_argument("--scope", action="append", choices=list(Mcast.SCOPES),
+                        help="multicast scope: ipv4, IPv6 link-local or "
+                        "site-local, may be repeated (default: ipv4)")
+    parser.add_argument("--rcvbuf", type=int, metavar="BYTES",
+                        help="size of the kernel receive buffer, a larger "
+                        "buffer drops less datagrams on bursts")
+    parser.add_argument("--stats", action="store_true",
+                        help="print counters and latencies of receive, parse,"
+                        " dedupe and format on exit")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                        help="write the metrics in Prometheus text format "
+                        "periodically to FILE")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        metavar="SEC", help="interval of writing the "
+                        "metrics file (default: 10)")
+    args = parser.parse_args(argv)
+    if args.version:
         print("Build", build())
+        return
+    if args.changes and (args.batch or args.pipeline is not None):
+        parser.error("--changes: not available with --batch or --pipeline")
+    # Only the modules of the selected options are imported, so the program
+    # starts fast.
+    # pylint: disable=import-outside-toplevel
+    _match = None
+    if args.filter:
+        from muca.upnp.Filter import Filter
+        try:
+            _match = Filter(args.filter)
+        except ValueError as err:
+            parser.error("--filter: {}".format(err))
+    _template = None
+    if args.template:
+        from muca.upnp.Template import Template
+        try:
+            _template = Template(args.template)
+        except ValueError as err:
+            parser.error("--template: {}".format(err))
+    _devices = None
+    # Old datagrams from a capture file are not cached.
+    if not args.no_cache and not args.read:
+        import sqlite3
+        from muca.upnp.Cache import DeviceCache
+        try:
+            _devices = DeviceCache()
+        except (sqlite3.Error, OSError) as err:
+            print("WARNING: device cache not available:", err,
+                  file=sys.stderr)
+    _storm = None
+    if args.rate or args.dedupe:
+        _storm = StormFilter(rate=args.rate, burst=args.burst,
+                             window=args.dedupe)
+    _metrics = None
+    if args.stats or args.metrics_file:
+        from muca.Metrics import Metrics
+        _metrics = Metrics()
+    _changes = ChangeTable() if args.changes else None
+    if args.metrics_file:
+        _metrics.start_export(args.metrics_file, args.metrics_interval)
+    if args.read:
+        o_listen = ListenPcap(args.read, verbose=args.verbose,
+                              output=args.format, storm=_storm,
+                              metrics=_metrics, match=_match,
+                              changes=_changes)
+    elif args.batch:
+        o_listen = ListenBatch(verbose=args.verbose, devices=_devices,
+                               output=args.format, storm=_storm,
+                               metrics=_metrics, rcvbuf=args.rcvbuf,
+                               match=_match, scopes=args.scope)
+    elif args.pipeline is not None:
+        o_listen = ListenPipeline(verbose=args.verbose, devices=_devices,
+                                  output=args.format, storm=_storm,
+                                  metrics=_metrics, rcvbuf=args.rcvbuf,
+                                  workers=args.pipeline, match=_match,
+                                  scopes=args.scope)
     else:
-        print_it(Listen())
-
+        o_listen = Listen(verbose=args.verbose, devices=_devices,
+                          output=args.format, storm=_storm, metrics=_metrics,
+                          rcvbuf=args.rcvbuf, match=_match,
+                          scopes=args.scope, changes=_changes)
+    if args.header:
+        o_listen.FIELDS = tuple(args.header)
+    o_listen.TEMPLATE = _template
+    print_it(o_listen)
+    print_losses(o_listen)
+    if args.metrics_file:
+        _metrics.stop_export()
+    if args.stats:
+        print(_metrics.fstats(), file=sys.stderr)
+    if _devices is not None:
+        _devices.close()
+    if args.read or args.batch:
+        print(o_listen.fstats(), file=sys.stderr)
+    if _storm is not None:
+        print(_storm.fstats(), file=sys.stderr)
 
 if __name__ == '__main__':
     main()
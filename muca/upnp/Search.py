@@ -1,11 +1,14 @@
 """Module to search for UPnP devices."""
 
+import os
+import sys
 import socket
 import argparse
-from time import time
+from time import time, monotonic_ns
 
 from muca.Common import build
-from muca.upnp.Common import SSDPdatagram, Mcast
+from muca.upnp.Common import SSDPdatagram, DeviceTable, Mcast, interfaces, \
+                             interfaces6, print_losses
 
 
 class Msearch(Mcast):
@@ -16,32 +19,76 @@ class Msearch(Mcast):
     [Multicast programming](https://www.tldp.org/HOWTO/Multicast-HOWTO-6.html)
     """
     _timestamp_request = 0
+    # Search target of the requests.
+    ST = 'upnp:rootdevice'
 
-    def __init__(self):
-        """Open a UDP network connection. """
+    def __init__(self, scopes=None):
+        """Open a UDP network connection.
+
+        Arguments: scopes = keys of Mcast.SCOPES, default is ipv4. IPv6
+                   scopes get their own socket, both sockets are serviced by
+                   one selector.
+        Raises: ValueError if a scope is unknown
+        """
+        self._setup_scopes(scopes)
         # Set up UDP socket with timeout and send a M-SEARCH structure
         # to the upnp multicast address and port.
         # IP_MULTICAST_LOOP is enabled by default.
         # IP_MULTICAST_TTL is set to 1 by default.
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                   socket.IPPROTO_UDP)
+        if 'ipv4' in self._scopes:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                       socket.IPPROTO_UDP)
+            self._setup_socket(self._sock)
+        if self._groups6():
+            # IPV6_MULTICAST_HOPS is set to 1 by default.
+            self._sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM,
+                                        socket.IPPROTO_UDP)
+            self._setup_socket(self._sock6)
+            if self._sock is None:
+                self._sock = self._sock6
+            else:
+                self._register(self._sock)
+                self._register(self._sock6)
 
     def request(self, ssdp_response_time=2):
         """Request for root devices on the upnp multicast channel.
 
         After 'request' you should 'get' the data as soon as possible to avoid
-        buffer overflow.
+        buffer overflow. The request is send to the group of every scope.
         """
         self._timestamp_request = time()
         self._response_time = ssdp_response_time
+        for _scope in self._scopes:
+            self._send(self._message(_scope), _scope)
+
+    def _send(self, msg, scope='ipv4'):
+        """Send a datagram to the upnp multicast group of a scope.
+
+        The link-local group is send on every interface.
+        """
+        if scope == 'ipv4':
+            self._sock.sendto(msg, (self._MCAST_GRP, self._MCAST_PORT))
+        elif scope == 'link':
+            for _, _index in interfaces6():
+                try:
+                    self._sock6.sendto(msg, (self.SCOPES[scope][0],
+                                             self._MCAST_PORT, 0, _index))
+                except OSError:
+                    # interface without IPv6 or multicast
+                    pass
+        else:
+            self._sock6.sendto(msg, (self.SCOPES[scope][0], self._MCAST_PORT))
+
+    def _message(self, scope='ipv4'):
+        """This returns the encoded M-SEARCH datagram to send to a scope."""
         _msg = \
             'M-SEARCH * HTTP/1.1\r\n' \
-            'HOST: 239.255.255.250:1900\r\n' \
+            'HOST: ' + self.SCOPES[scope][1] + '\r\n' \
             'MAN: "ssdp:discover"\r\n' \
             'MX: ' + str(self._response_time) + '\r\n' \
-            'ST: upnp:rootdevice\r\n' \
+            'ST: ' + self.ST + '\r\n' \
             '\r\n'
-        self._sock.sendto(_msg.encode(), (self._MCAST_GRP, self._MCAST_PORT))
+        return _msg.encode()
 
     def get(self):
         """Get next SSDP datagram from multicast net within a timeout.
@@ -63,15 +110,36 @@ class Msearch(Mcast):
                     self._response_time \
                     - (time() - self._timestamp_request))) \
                     + 1
-                self._sock.settimeout(_tout)
-                data, addr = self._sock.recvfrom(self.RECVBUF)
-                if len(data) >= self.RECVBUF:
-                    raise SystemExit("ERROR: receive buffer overflow")
-                return SSDPdatagram(addr, data)
+                return self._receive(_tout)
             except socket.timeout:
                 self._response_time = 0
                 return
 
+    def _receive(self, timeout):
+        """Receive the next datagram within the timeout (in sec).
+
+        Returns: a SSDPdatagram object
+        Raises: socket.timeout if no datagram has received
+        """
+        if self._selector is None:
+            self._sock.settimeout(timeout)
+        while True:
+            if self._selector is None:
+                _received = self._recv(self._sock)
+            else:
+                _received = self._recv(self._select(timeout).fileobj)
+            if _received is None:
+                continue
+            data, addr, rxtime = _received
+            _o_datagram = self._parse(addr, data, rxtime)
+            if self._postmatch is None or self._postmatch(_o_datagram):
+                return _o_datagram
+
+    def close(self):
+        """Close the sockets and the selector, the object cannot be used
+        for a further request."""
+        self._close_sockets()
+
 
 class MsearchDevice(Msearch):
     """Search for the next device on the network.
@@ -80,17 +148,79 @@ class MsearchDevice(Msearch):
     requests are lost. To improve reliability requests are send more than one
     time. Most devices will response on every request but we make the responses
     unique. Only the first response is reported.
+
+    Responses are recorded in a DeviceTable. It may be given to share it with
+    other search or listen objects. Responses that do not match a filter are
+    not recorded.
+
+    The response window of a request is the response time (MX) plus NETDELAY
+    seconds. Deadlines are taken from the monotonic clock in nanoseconds. The
+    search can be adapted with:
+    quiet   a window ends early if no new device has responded for this time
+            (in sec) since the request or the last new device
+    backoff every window is this factor longer than the window before
+    known   unique identifiers of expected devices, the search ends as soon as
+            all of them have responded
+    timeout the whole search ends after this time (in sec)
+
+    With a muca.upnp.Latency.LatencyReport the latency of the first response
+    of every device to every request is measured, from sending the request
+    to the kernel receive time of the response.
     """
+    # Added to the response time for the delay on the network (in sec).
+    NETDELAY = 1
+
     _timestamp_first_request = 0
-    _devicelist = []
+    _devices = None
     _count = -1
     _retry = 0
     _verbose = False
+    _quiet = None
+    _backoff = 1
+    _known = None
+    _timeout = None
+    # Times of the monotonic clock in nanoseconds.
+    _start = 0
+    _deadline = 0
+    _last_new = 0
+    _request_ns = 0
+    _missing = None
+    _latency = None
+    # Devices that have responded to the current request.
+    _answered = None
+    # Datagrams of the devices reported by the search.
+    _responses = ()
 
-    def __init__(self, verbose=False):
-        """Setup verbose output if requested."""
-        super().__init__()
+    def __init__(self, verbose=False, devices=None, output='text',
+                 quiet=None, backoff=1, known=None, timeout=None,
+                 metrics=None, rcvbuf=None, match=None, scopes=None,
+                 latency=None):
+        """Setup verbose output if requested and the table of devices.
+
+        Arguments: output = one of Mcast.OUTPUTS
+                   quiet, backoff, known, timeout = adaptive search, see
+                   class description
+                   metrics = muca.Metrics.Metrics or None
+                   rcvbuf = size of the kernel receive buffer, see
+                   Mcast.RCVBUF
+                   match = muca.upnp.Filter.Filter or None, see
+                   Mcast._setup_match()
+                   scopes = keys of Mcast.SCOPES, see Msearch
+                   latency = muca.upnp.Latency.LatencyReport or None
+        """
+        if rcvbuf is not None:
+            self.RCVBUF = rcvbuf
+        self._setup_match(match)
+        super().__init__(scopes)
         self._verbose = verbose
+        self._devices = DeviceTable() if devices is None else devices
+        self._output = output
+        self._quiet = quiet
+        self._backoff = backoff
+        self._known = None if known is None else frozenset(known)
+        self._timeout = timeout
+        self._metrics = metrics
+        self._latency = latency
 
     def request(self, retries=3):
         """Send a request for upnp root devices.
@@ -100,10 +230,121 @@ class MsearchDevice(Msearch):
         """
         if retries > 0:
             self._timestamp_first_request = time()
-            self._devicelist = []
+            self._start = monotonic_ns()
             self._count = retries
-            super().request()
-            self._retry = 1
+            self._retry = 0
+            self._missing = None if self._known is None else set(self._known)
+            self._responses = []
+            self._request()
+
+    def _request(self):
+        """Send the next request and set the deadline of its window."""
+        _now = monotonic_ns()
+        super().request()
+        self._retry += 1
+        self._request_ns = _now
+        self._last_new = _now
+        self._deadline = _now + int((self._response_time + self.NETDELAY)
+                                    * self._backoff ** (self._retry - 1) * 1e9)
+        if self._timeout is not None:
+            self._deadline = min(self._deadline,
+                                 self._start + int(self._timeout * 1e9))
+        if self._latency is not None:
+            self._answered = set()
+            self._latency.request(self._response_time)
+
+    def _end_window(self):
+        """Called at the end of a response window.
+
+        Returns: a datagram without data with the number of the next request
+        or 0 if the search has finished.
+        """
+        self._count -= 1
+        _o_dummy_datagram = SSDPdatagram()
+        if self._count > 0 and (self._timeout is None or monotonic_ns() <
+                                self._start + int(self._timeout * 1e9)):
+            self._request()
+            _o_dummy_datagram.request = self._retry
+        else:
+            self._count = -1
+            _o_dummy_datagram.request = 0
+        return _o_dummy_datagram
+
+    def cached(self):
+        """This returns the devices from the DeviceTable without a request.
+
+        Only entries of the search target ST whose max-age has not passed and
+        that match the filter are returned, formated in the selected output.
+        Entries of other notification types from listening are skipped. Like
+        a search, the end is reported by a datagram without data.
+        """
+        self._devices.expire()
+        self._responses = [
+            _o_datagram for _o_datagram in self._devices
+            if self._devices.key(_o_datagram)[-1] == self.ST and
+            (self._match is None or self._match(_o_datagram))]
+        _o_dummy_datagram = SSDPdatagram()
+        _o_dummy_datagram.request = 0
+        return [self._format(_o_datagram, 0) for _o_datagram in
+                self._responses + [_o_dummy_datagram]]
+
+    def responses(self):
+        """This returns the datagrams of the devices reported by the last
+        search or by cached()."""
+        return list(self._responses)
+
+    def _next(self):
+        """Get the next response from the network.
+
+        Returns: a SSDPdatagram object, a datagram without data at the end of
+        a response window, see _end_window(), or None if there is no search.
+        """
+        if self._count < 0:
+            return
+
+        while True:
+            _end = self._deadline
+            if self._quiet is not None:
+                _end = min(_end, self._last_new + int(self._quiet * 1e9))
+            _tout = (_end - monotonic_ns()) / 1e9
+            try:
+                if _tout <= 0:
+                    raise socket.timeout()
+                _o_datagram = self._receive(_tout)
+            except socket.timeout:
+                return self._end_window()
+            if self._latency is not None:
+                self._observe(_o_datagram)
+            # A device is reported if it has not responded since the
+            # first request.
+            _o_former = self._devices.update(_o_datagram)
+            if _o_former is None or \
+                    _o_former.timestamp < self._timestamp_first_request:
+                if self._metrics is not None:
+                    self._metrics.count('dedupe_new')
+                _o_datagram.request = self._retry
+                self._last_new = monotonic_ns()
+                self._responses.append(_o_datagram)
+                if self._missing is not None:
+                    self._missing.discard(getattr(_o_datagram, 'uuid', ''))
+                    if not self._missing:
+                        # All known devices have responded so the next call
+                        # finishes the search.
+                        self._count = 1
+                        self._deadline = 0
+                return _o_datagram
+            if self._metrics is not None:
+                self._metrics.count('dedupe_duplicates')
+
+    def _observe(self, o_datagram):
+        """Measure the latency of the first response of a device to the
+        current request."""
+        _key = o_datagram.get('uuid') or o_datagram.ipaddr
+        if _key not in self._answered:
+            self._answered.add(_key)
+            self._latency.observe(_key, o_datagram.address(),
+                                  o_datagram.rxtime - self._request_ns,
+                                  self._retry)
 
     def get(self):   # overload get() from parent
         """Get the next response from the network.
@@ -112,33 +353,118 @@ class MsearchDevice(Msearch):
         Returns: a received datagram, may be empty only with time and retry
         number.
         """
+        _o_datagram = self._next()
+        if _o_datagram is None:
+            return
+        return self._format(_o_datagram, self._timestamp_first_request)
+
+    def __iter__(self):
+        """Search for upnp root devices on the network.
+
+        This is a generator. It sends the requests if request() has not been
+        called and yields the SSDPdatagram objects of new devices until the
+        search has finished. The datagrams are not formated. Like with
+        AsyncMsearch, the end of every response window is reported by a
+        datagram without data and source address, with the number of the next
+        request or 0 after the last one:
+
+            for o_datagram in MsearchDevice():
+                if o_datagram.ipaddr:
+                    print(o_datagram.ipaddr, o_datagram.location)
+        """
         if self._count < 0:
+            self.request()
+        _o_datagram = self._next()
+        while _o_datagram is not None:
+            yield _o_datagram
+            _o_datagram = self._next()
+
+
+class MsearchInterfaces(MsearchDevice):
+    """Search for devices on all local IPv4 interfaces at once.
+
+    There is one socket for every interface with IP_MULTICAST_IF set to it.
+    A request is send on all sockets together and the responses are received
+    with one selector, so all interfaces share the same response window. The
+    responses are unique over all interfaces and every response is tagged
+    with the name of the interface it has received on. The socket of IPv6
+    scopes is serviced by the same selector, its responses are not tagged.
+    """
+    _socks = None
+
+    def __init__(self, verbose=False, devices=None, output='text',
+                 ifaddrs=None, **schedule):
+        """Open a UDP network connection on every interface.
+
+        Arguments: ifaddrs = list of tuples with (interface name, IPv4 address)
+                   to use, default are all local interfaces
+                   schedule = adaptive search arguments of MsearchDevice
+        """
+        super().__init__(verbose=verbose, devices=devices, output=output,
+                         **schedule)
+        if 'ipv4' in self._scopes:
+            # The unbound socket from Msearch is not used.
+            if self._selector is not None:
+                self._selector.unregister(self._sock)
+            self._sock.close()
+            self._sock = self._sock6
+        if self._selector is None:
+            import selectors  # pylint: disable=import-outside-toplevel
+            self._selector = selectors.DefaultSelector()
+            self._ready = []
+            if self._sock6 is not None:
+                self._register(self._sock6)
+        if ifaddrs is None:
+            ifaddrs = interfaces() if 'ipv4' in self._scopes else []
+        self._socks = []
+        for _name, _ipaddr in ifaddrs:
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                  socket.IPPROTO_UDP)
+            self._socks.append(_sock)
+            try:
+                _sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                 socket.inet_aton(_ipaddr))
+                self._setup_socket(_sock)
+                # Bind to the interface address so unicast responses are
+                # received on the socket of this interface.
+                _sock.bind((_ipaddr, 0))
+            except OSError:
+                self._close_sockets()
+                raise
+            self._register(_sock, _name)
+
+    def _send(self, msg, scope='ipv4'):
+        """Send a datagram to the upnp multicast group on all interfaces."""
+        if scope != 'ipv4':
+            super()._send(msg, scope)
             return
+        for _sock in self._socks:
+            _sock.sendto(msg, (self._MCAST_GRP, self._MCAST_PORT))
 
+    def _receive(self, timeout):
+        """Receive the next datagram from any interface within the timeout.
+
+        Returns: a SSDPdatagram object tagged with its interface name
+        Raises: socket.timeout if no datagram has received
+        """
         while True:
-            _o_datagram = super().get()
-            if _o_datagram is None:
-                self._count -= 1
-                _o_dummy_datagram = SSDPdatagram()
-                if self._count > 0:
-                    super().request()
-                    self._retry += 1
-                    _o_dummy_datagram.request = self._retry
-                    #return _rel_time + 's ' + str(self._retry) + '\r\n'
-                else:
-                    self._count = -1
-                    _o_dummy_datagram.request = 0
-                    #return _rel_time + 's ' + '0' + '\r\n'
-                return _o_dummy_datagram.fdevice(
-                    base_time=self._timestamp_first_request)
-            else:
-                _device = _o_datagram.ipaddr + ' ' +_o_datagram.uuid
-                if _device not in self._devicelist:
-                    self._devicelist.append(_device)
-                    _o_datagram.request = self._retry
-                    return _o_datagram.fdevice(
-                        base_time=self._timestamp_first_request,
-                        verbose=self._verbose)
+            _key = self._select(timeout)
+            _received = self._recv(_key.fileobj)
+            if _received is None:
+                continue
+            data, addr, rxtime = _received
+            _o_datagram = self._parse(addr, data, rxtime)
+            _o_datagram.interface = _key.data
+            if self._postmatch is None or self._postmatch(_o_datagram):
+                return _o_datagram
+
+    def _close_sockets(self):
+        """Close the sockets of the interfaces with the other sockets."""
+        super()._close_sockets()
+        for _sock in self._socks:
+            _sock.close()
+        self._socks = []
+
 
 def print_it(o_mcast):
     """Search for upnp root devices on the local network and print them.
@@ -152,26 +478,218 @@ def print_it(o_mcast):
     o_mcast.request()
     datagram = o_mcast.get()
     while datagram is not None:
-        print(datagram, end='', flush=True)
+        write(datagram)
         datagram = o_mcast.get()
 
 
-def main():
-    """This is the entry point of the program and the command line parser"""
+def write(datagram):
+    """Write a formated datagram to stdout."""
+    if isinstance(datagram, bytes):
+        sys.stdout.buffer.write(datagram)
+        sys.stdout.buffer.flush()
+    else:
+        print(datagram, end='', flush=True)
+
+
+def revalidate(search_class, **kwargs):
+    """Search in a detached background process to refresh the device cache.
+
+    The calling process returns immediately. The background process opens the
+    cache on its own because a database connection must not be used by a
+    forked process.
+    Arguments: search_class = MsearchDevice or a subclass
+               kwargs = arguments for the search object
+    Returns: None
+    """
+    # pylint: disable=import-outside-toplevel
+    from muca.upnp.Cache import DeviceCache
+    sys.stdout.flush()
+    if os.fork() > 0:
+        return
+    try:
+        os.setsid()
+        _devnull = os.open(os.devnull, os.O_RDWR)
+        for _fd in range(3):
+            os.dup2(_devnull, _fd)
+        with DeviceCache() as _devices:
+            o_search = search_class(devices=_devices, **kwargs)
+            o_search.request()
+            while o_search.get() is not None:
+                pass
+            o_search.close()
+    finally:
+        os._exit(0)   # pylint: disable=protected-access
+
+
+def main(argv=None, prog=None):
+    """This is the entry point of the program and the command line parser
+
+    Arguments: argv = command line arguments, default are the arguments of
+               the program
+               prog = name of the program in the help text
+    """
     parser = argparse.ArgumentParser(
-        description='Active scan three times for UPnP devices')
+        prog=prog, description='Active scan three times for UPnP devices')
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-v", "--verbose", action="store_true",
                        help="verbose active search for UPnP devices")
     group.add_argument("-V", "--version", action="store_true",
                        help="show program version")
-    args = parser.parse_args()
-    if args.verbose:
-        print_it(MsearchDevice(verbose=True))
-    elif args.version:
+    parser.add_argument("-i", "--interfaces", action="store_true",
+                        help="search on all local IPv4 interfaces at once")
+    parser.add_argument("-f", "--format", choices=MsearchDevice.OUTPUTS,
+                        default='text', help="output format, verbose adds "
+                        "the whole datagram (default: text)")
+    parser.add_argument("-H", "--header", action="append", metavar="NAME",
+                        help="header field for ndjson and binary output, may"
+                        " be repeated (default: {})".format(
+                            ' '.join(MsearchDevice.FIELDS)))
+    parser.add_argument("-T", "--template", metavar="TEMPLATE",
+                        help="format of the text output, for example: "
+                        "\"{rel:9.4f} {addr} {uuid} {location}\"")
+    parser.add_argument("-F", "--filter", metavar="EXPR",
+                        help="print only responses that match the filter "
+                        "expression, for example: nt ~ \"MediaRenderer\" "
+                        "and ip in 192.168.10.0/24")
+    parser.add_argument("-q", "--quiet", type=float, metavar="SEC",
+                        help="end a response window early if no new device "
+                        "has responded for this time")
+    parser.add_argument("-k", "--known", action="append", metavar="UUID",
+                        help="stop as soon as this device has responded, may"
+                        " be repeated")
+    parser.add_argument("--backoff", type=float, default=1, metavar="FACTOR",
+                        help="every response window is this factor longer "
+                        "than the window before (default: 1)")
+    parser.add_argument("-t", "--timeout", type=float, metavar="SEC",
+                        help="stop the search after this time")
+    parser.add_argument("-d", "--describe", action="store_true",
+                        help="fetch the device descriptions after the search"
+                        " and print uuid, friendly name and location")
+    parser.add_argument("--scope", action="append", choices=list(Mcast.SCOPES),
+                        help="multicast scope: ipv4, IPv6 link-local or "
+                        "site-local, may be repeated (default: ipv4)")
+    parser.add_argument("--rcvbuf", type=int, metavar="BYTES",
+                        help="size of the kernel receive buffer, a larger "
+                        "buffer drops less datagrams on bursts")
+    parser.add_argument("--stats", action="store_true",
+                        help="print counters and latencies of receive, parse,"
+                        " dedupe and format on exit")
+    parser.add_argument("--latency", action="store_true",
+                        help="print the response latencies of the devices "
+                        "on exit")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                        help="write the metrics in Prometheus text format "
+                        "periodically to FILE")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        metavar="SEC", help="interval of writing the "
+                        "metrics file (default: 10)")
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument("-c", "--cached", action="store_true",
+                       help="answer immediately with the cached devices and "
+                       "revalidate them in the background")
+    cache.add_argument("--no-cache", action="store_true",
+                       help="do not use the persistent device cache")
+    args = parser.parse_args(argv)
+    if args.version:
         print("Build", build())
-    else:
-        print_it(MsearchDevice())
+        return
+    # Only the modules of the selected options are imported, so the program
+    # starts fast.
+    # pylint: disable=import-outside-toplevel
+    _match = None
+    if args.filter:
+        from muca.upnp.Filter import Filter
+        try:
+            _match = Filter(args.filter)
+        except ValueError as err:
+            parser.error("--filter: {}".format(err))
+    _template = None
+    if args.template:
+        from muca.upnp.Template import Template
+        try:
+            _template = Template(args.template)
+        except ValueError as err:
+            parser.error("--template: {}".format(err))
+    _cache = None
+    if not args.no_cache:
+        import sqlite3
+        from muca.upnp.Cache import DeviceCache
+        try:
+            _cache = DeviceCache()
+        except (sqlite3.Error, OSError) as err:
+            print("WARNING: device cache not available:", err,
+                  file=sys.stderr)
+    _devices = DeviceTable() if _cache is None else _cache
+    _search = MsearchInterfaces if args.interfaces else MsearchDevice
+    _kwargs = {'verbose': args.verbose, 'output': args.format,
+               'quiet': args.quiet, 'known': args.known,
+               'backoff': args.backoff, 'timeout': args.timeout,
+               'rcvbuf': args.rcvbuf, 'scopes': args.scope}
+    _metrics = None
+    if args.stats or args.metrics_file:
+        from muca.Metrics import Metrics
+        _metrics = Metrics()
+    _latency = None
+    if args.latency:
+        from muca.upnp.Latency import LatencyReport
+        _latency = LatencyReport()
+    # The background revalidation refreshes all devices of the cache, so the
+    # filter is not in _kwargs.
+    o_search = _search(devices=_devices, metrics=_metrics, match=_match,
+                       latency=_latency, **_kwargs)
+    if args.header:
+        o_search.FIELDS = tuple(args.header)
+    o_search.TEMPLATE = _template
+    # Without cached devices of the search target it is searched now.
+    _cached = o_search.cached() if args.cached and _cache is not None \
+        else None
+    if _cached and o_search.responses():
+        for datagram in _cached:
+            write(datagram)
+        if args.describe:
+            print_descriptions(o_search.responses())
+        # The background search ends as soon as all cached devices have
+        # responded.
+        _kwargs['known'] = args.known or {
+            _o_datagram.uuid for _o_datagram in o_search.responses()
+            if getattr(_o_datagram, 'uuid', '')} or None
+        o_search.close()
+        _devices.close()
+        revalidate(_search, **_kwargs)
+        return
+    if args.metrics_file:
+        _metrics.start_export(args.metrics_file, args.metrics_interval)
+    print_it(o_search)
+    print_losses(o_search)
+    o_search.close()
+    if args.metrics_file:
+        _metrics.stop_export()
+    if args.stats:
+        print(_metrics.fstats(), file=sys.stderr)
+    if args.latency:
+        print(_latency.freport(), file=sys.stderr)
+    if args.describe:
+        print_descriptions(o_search.responses())
+    if _cache is not None:
+        _cache.close()
+
+
+def print_descriptions(datagrams):
+    """Fetch the device descriptions of datagrams and print them.
+
+    Arguments: list of SSDPdatagram objects
+    Returns: None
+    Output: print uuid, friendly name and location of every device
+    """
+    # pylint: disable=import-outside-toplevel
+    from muca.upnp.Description import DescriptionFetcher, friendly_name
+    o_fetcher = DescriptionFetcher()
+    for o_datagram, description in o_fetcher.fetch(datagrams):
+        print('uuid:{} {} {}'.format(
+            getattr(o_datagram, 'uuid', ''),
+            '-' if description is None else friendly_name(description),
+            getattr(o_datagram, 'location', '')), end='\r\n', flush=True)
+    o_fetcher.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+"""Output templates for the text output of SSDP datagrams.
+
+A template is a format string with the fields of a datagram, for example:
+
+    {ts} {ip} {uuid} {nt}
+
+It is compiled once into a formatter that is called for every datagram.
+Fields are
+    ts          timestamp in seconds since the epoch
+    rel         seconds since listening has been opened or since the first
+                request, 0.0 without a base time
+    request     request number
+    ip, port    source address and port, '' if not available
+    addr        ip:port, IPv6 addresses in brackets
+    interface   name of the interface the datagram has received on
+    method      NOTIFY, M-SEARCH or "" for a response
+    change      state change of the device with --changes, see ChangeTable
+    data        the whole datagram
+and every header as property name of SSDPdatagram, for example 'nt',
+'location' or 'cache_control'. Not available headers are empty strings.
+Like str.format() a field may have a conversion and a format specification,
+for example {rel:9.4f} or {server!r}. '{{' and '}}' are literal braces.
+"""
+
+import re
+import string
+
+from muca.upnp.Common import SSDPdatagram
+
+_FIELD = re.compile(r'[a-z][a-z0-9_]*$')
+
+# field -> function that gets the SSDPdatagram and the base time
+_GETTERS = {
+    'ts': lambda _o, _base: _o.timestamp,
+    'rel': lambda _o, _base: max(_o.timestamp - _base, 0.0) if _base else 0.0,
+    'request': lambda _o, _base: _o.request,
+    'ip': lambda _o, _base: _o.ipaddr,
+    'port': lambda _o, _base: _o.port,
+    'addr': lambda _o, _base: _o.address(),
+    'interface': lambda _o, _base: _o.interface,
+    'method': lambda _o, _base: _o.method,
+    'change': lambda _o, _base: _o.change,
+    'data': lambda _o, _base: _o.data or '',
+}
+
+
+def _header(name):
+    """This returns the getter of a header field."""
+    return lambda _o, _base: _o.get(name, '')
+
+
+class Template:
+    """A compiled output template.
+
+    The object is called with a SSDPdatagram and the base time of the
+    relative time and returns the formated line with 'end' appended.
+    """
+
+    def __init__(self, template, end='\r\n'):
+        """Compile the template.
+
+        Raises: ValueError if the template is invalid
+        """
+        self.template = template
+        _format = []
+        _getters = []
+        try:
+            _parsed = list(string.Formatter().parse(template))
+        except ValueError as err:
+            raise ValueError('invalid template: {}'.format(err)) from None
+        for _literal, _field, _spec, _conversion in _parsed:
+            _format.append(_literal.replace('{', '{{').replace('}', '}}'))
+            if _field is None:
+                continue
+            if not _FIELD.match(_field):
+                raise ValueError('field name expected instead of "{}"'.format(
+                    _field))
+            if '{' in _spec:
+                raise ValueError('nested field in "{}"'.format(_spec))
+            # The fields are given as positional arguments in order.
+            _format.append('{' + ('!' + _conversion if _conversion else '')
+                           + (':' + _spec if _spec else '') + '}')
+            _getters.append(_GETTERS.get(_field) or _header(_field))
+        self._format = (''.join(_format) + end).format
+        self._getters = tuple(_getters)
+        # Wrong conversions and format specifications fail on formating.
+        try:
+            self(SSDPdatagram(('', 0)), 0)
+        except (ValueError, TypeError) as err:
+            raise ValueError('invalid template: {}'.format(err)) from None
+
+    def __call__(self, o_datagram, base_time=0):
+        """This returns the datagram formated with the template."""
+        return self._format(*[_get(o_datagram, base_time)
+                              for _get in self._getters])
+
+    def __repr__(self):
+        return 'Template({!r})'.format(self.template)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,66 @@
+"""Tests for the benchmark suite.
+
+The benchmarks run only with a few datagrams, we test that they work and not
+how fast they are.
+"""
+from unittest import TestCase
+
+from benchmarks.Suite import BENCHMARKS, run, compare, synthetic
+from benchmarks.Startup import parse_importtime, run as run_startup
+
+
+class BenchmarkTestCase(TestCase):
+    """Tests for running and comparing benchmarks."""
+
+    def test_synthetic(self):
+        """Test the pool of synthetic datagrams."""
+        pool = synthetic(20, devices=4)
+        self.assertEqual(len(pool), 20)
+        self.assertEqual(pool[0][0], ('10.0.0.0', 1900))
+        self.assertIn(b'uuid:00000001-0000-1000-8000-000000000001::',
+                      pool[1][1])
+        self.assertEqual(set(addr[0] for addr, _ in pool),
+                         {'10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3'})
+
+    def test_run(self):
+        """Test that all benchmarks run and return machine-readable data."""
+        result = run(count=60, repeat=1)
+        self.assertEqual(result['meta']['count'], 60)
+        self.assertEqual(set(result['results']), set(BENCHMARKS))
+        for value in result['results'].values():
+            self.assertEqual(value['count'], 60)
+            self.assertGreater(value['ns_per_op'], 0)
+        result = run(count=12, repeat=1, names=['parse'])
+        self.assertEqual(list(result['results']), ['parse'])
+
+    def test_compare(self):
+        """Test finding regressions between two results."""
+        base = {'results': {'parse': {'ns_per_op': 100.0},
+                            'dedupe': {'ns_per_op': 200.0}}}
+        new = {'results': {'parse': {'ns_per_op': 105.0},
+                           'dedupe': {'ns_per_op': 250.0},
+                           'listen_get': {'ns_per_op': 50.0}}}
+        self.assertEqual(compare(base, new, threshold=10), [
+            ('parse', 100.0, 105.0, 5.0, False),
+            ('dedupe', 200.0, 250.0, 25.0, True)])
+        self.assertFalse(compare(base, new, threshold=30)[1][4])
+
+    def test_parse_importtime(self):
+        """Test reading the output of -X importtime."""
+        self.assertEqual(parse_importtime(
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       335 |        335 |   _io\n'
+            'import time:       812 |       4102 | argparse\n'
+            'import time:        12 |         40 | muca\n'
+            'other output\n'), {'argparse': 4102, 'muca': 40})
+
+    def test_startup(self):
+        """Test that the startup is measured against its budget."""
+        result = run_startup(['muca'], repeat=1)
+        value = result['results']['muca']
+        self.assertGreater(value['import_ms'], 0)
+        self.assertGreater(value['wall_ms'], value['import_ms'])
+        self.assertEqual(value['budget_ms'], 8.0)
+        self.assertIn('muca.Main', [_name for _name, _ in value['heaviest']])
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,130 @@
+"""Tests for the persistent device cache.
+
+Every test uses its own database in a temporary directory.
+"""
+from unittest import TestCase, mock
+import os
+import sqlite3
+import tempfile
+import time
+
+from muca.upnp.Common import SSDPdatagram
+from muca.upnp.Cache import DeviceCache, cache_dir
+from muca.upnp.Search import MsearchDevice
+from tests.CommonTest import SDATAGRAM1, LDATAGRAM1, LDATAGRAM2, \
+                             LDATAGRAM3, SADDR1, LADDR1, LADDR2, LADDR3
+
+
+class DeviceCacheTestCase(TestCase):
+    """Tests for the device cache."""
+
+    def setUp(self):
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        self.path = os.path.join(_tmpdir.name, 'devices.sqlite')
+
+    def test1_device_cache(self):
+        """Devices are available after reopening the cache."""
+        with DeviceCache(self.path) as o_cache:
+            o_datagram1 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+            o_datagram1.interface = 'eth0'
+            self.assertIsNone(o_cache.update(o_datagram1))
+            o_cache.update(SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3))
+            # search requests are not stored
+            o_cache.update(SSDPdatagram(addr=LADDR2, raw_data=LDATAGRAM2))
+            self.assertEqual(len(o_cache), 2)
+        with DeviceCache(self.path) as o_cache:
+            self.assertEqual(len(o_cache), 2)
+            o_datagram = o_cache.get(DeviceCache.key(o_datagram1))
+            self.assertEqual(o_datagram.timestamp, o_datagram1.timestamp)
+            self.assertEqual(o_datagram.fdevice(), o_datagram1.fdevice())
+            self.assertEqual(o_datagram.interface, 'eth0')
+            self.assertIs(o_cache.update(SSDPdatagram(
+                addr=SADDR1, raw_data=SDATAGRAM1)), o_datagram)
+
+    def test2_device_cache(self):
+        """Expired and removed devices are not loaded again."""
+        with DeviceCache(self.path) as o_cache:
+            o_datagram1 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+            o_cache.update(o_datagram1)
+            # LDATAGRAM1 has max-age=100
+            o_datagram2 = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)
+            o_datagram2.timestamp -= 100
+            o_cache.update(o_datagram2)
+            o_cache.update(SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3))
+            o_cache.update(SSDPdatagram(
+                addr=LADDR3, raw_data=LDATAGRAM3.replace(b'ssdp:alive',
+                                                         b'ssdp:byebye')))
+        with DeviceCache(self.path) as o_cache:
+            self.assertEqual([DeviceCache.key(_o) for _o in o_cache],
+                             [DeviceCache.key(o_datagram1)])
+            o_cache.remove(DeviceCache.key(o_datagram1))
+        with DeviceCache(self.path) as o_cache:
+            self.assertEqual(len(o_cache), 0)
+
+    def test3_device_cache(self):
+        """Answer from the cache without a request."""
+        with DeviceCache(self.path) as o_cache:
+            o_cache.update(SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1))
+            # notifies of one device from listening
+            _nt = b'urn:schemas-upnp-org:device:MediaRenderer:1'
+            for _target in (_nt, b'upnp:rootdevice',
+                            b'urn:schemas-upnp-org:service:AVTransport:1',
+                            b'urn:schemas-upnp-org:service:RenderingControl:1'):
+                o_cache.update(SSDPdatagram(
+                    addr=LADDR1, raw_data=LDATAGRAM1.replace(_nt, _target)))
+            self.assertEqual(len(o_cache), 5)
+        with DeviceCache(self.path) as o_cache, \
+                mock.patch('muca.upnp.Search.socket.socket') as mock_socket:
+            o_search = MsearchDevice(devices=o_cache)
+            result = o_search.cached()
+            mock_socket.return_value.sendto.assert_not_called()
+        # Only the entries of the search target and the end of the search
+        self.assertEqual(len(result), 3)
+        self.assertRegex(result[0], r'^0000\.0000s 0 192\.168\.10\.119:47383 '
+                         r'uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 ')
+        self.assertRegex(result[1], r' 192\.168\.10\.86:57535 uuid:'
+                         r'f4f7681c-3056-11e8-86bd-87a6e4e2c42d ')
+        self.assertRegex(result[2], r'^\d{4}\.\d{4}s 0\r\n$')
+        self.assertEqual([_o.ipaddr for _o in o_search.responses()],
+                         ['192.168.10.119', '192.168.10.86'])
+
+    def test4_device_cache(self):
+        """Two processes write to the same database."""
+        with DeviceCache(self.path) as o_cache1, \
+                DeviceCache(self.path) as o_cache2:
+            o_cache1.COMMIT_INTERVAL = o_cache2.COMMIT_INTERVAL = 0.05
+            # The update is not committed immediately, the second writer
+            # waits until the timer of the first one has committed it.
+            o_cache1.update(SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1))
+            o_cache2.update(SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3))
+            time.sleep(0.2)
+            # Both are committed without closing the caches.
+            with DeviceCache(self.path) as o_cache3:
+                self.assertEqual(len(o_cache3), 2)
+
+    def test5_device_cache(self):
+        """A locked database is logged and does not stop the updates."""
+        with mock.patch.object(DeviceCache, 'TIMEOUT', 0.01), \
+                DeviceCache(self.path) as o_cache:
+            o_db = sqlite3.connect(self.path)
+            o_db.execute('BEGIN IMMEDIATE')
+            with self.assertLogs('muca', level='WARNING') as logs:
+                o_cache.update(SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1))
+                o_cache.update(SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3))
+            self.assertEqual(len(logs.output), 1)
+            self.assertRegex(logs.output[0], r'^WARNING:muca\.upnp\.Common:'
+                             r'device cache not written: database is locked')
+            self.assertEqual(len(o_cache), 2)
+            o_db.rollback()
+            o_db.close()
+
+    def test_cache_dir(self):
+        """Test the cache directory."""
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': '/tmp/cache'}):
+            self.assertEqual(cache_dir(), '/tmp/cache/muca')
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': '',
+                                          'HOME': '/home/user'}):
+            self.assertEqual(cache_dir(), '/home/user/.cache/muca')
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -1,11 +1,16 @@
 """This are common used fixtures and tests for common used modules."""
 
 from unittest import TestCase
+from io import BytesIO
 from time import time
+import json
+import socket
+import struct
 # from pprint import pprint
 # pprint(vars(instance))
 
-from muca.upnp.Common import SSDPdatagram
+from muca.upnp.Common import SSDPdatagram, DeviceTable, Mcast, interfaces, \
+                             read_records, StormFilter, ChangeTable
 
 
 # three ssdp datagram from search response as test pattern
@@ -96,6 +101,39 @@ LDATAGRAM3 = (
     b'\r\n')
 
 
+def recvmsg(*datagrams):
+    """This returns a side effect to mock socket.recvmsg().
+
+    Arguments: tuples of (datagram, address), tuples of (datagram, ancdata,
+               flags, address) or exceptions to raise
+    """
+    return [_item if isinstance(_item, BaseException) or len(_item) == 4
+            else (_item[0], [], 0, _item[1]) for _item in datagrams]
+
+
+def recvmsg_into(*datagrams):
+    """This returns a side effect to mock socket.recvmsg_into().
+
+    Arguments: tuples of (datagram, address), tuples of (datagram, ancdata,
+               flags, address) or exceptions to raise. A datagram larger than
+               the buffer is truncated and gets the flag MSG_TRUNC.
+    """
+    datagrams = recvmsg(*datagrams)
+
+    def _recvmsg_into(buffers, ancbufsize, flags=0):  # pylint: disable=W0613
+        _item = datagrams.pop(0)
+        if isinstance(_item, BaseException):
+            raise _item
+        _data, _ancdata, _flags, _addr = _item
+        _buffer = buffers[0]
+        if len(_data) > len(_buffer):
+            _flags |= socket.MSG_TRUNC
+            _data = _data[:len(_buffer)]
+        _buffer[:len(_data)] = _data
+        return len(_data), _ancdata, _flags, _addr
+    return _recvmsg_into
+
+
 class CommonTestCase(TestCase):
     """Tests for common used modules."""
 
@@ -103,7 +141,8 @@ class CommonTestCase(TestCase):
         """Test structure of a SSDP datagram object from search response."""
         o_datagram = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
         self.assertAlmostEqual(o_datagram.timestamp, time(), 2)
-        self.assertEqual(len(o_datagram.__dict__), 17)
+        self.assertFalse(hasattr(o_datagram, '__dict__'))
+        self.assertEqual(len(o_datagram.headers()), 13)
 
         self.assertEqual(o_datagram.method, '')
         self.assertEqual(o_datagram.bootid_upnp_org, '0')
@@ -134,7 +173,8 @@ class CommonTestCase(TestCase):
         """Test SSDP datagram from search response without addr and data."""
         o_datagram = SSDPdatagram()
         self.assertAlmostEqual(o_datagram.timestamp, time(), 2)
-        self.assertEqual(len(o_datagram.__dict__), 4)
+        self.assertFalse(hasattr(o_datagram, '__dict__'))
+        self.assertEqual(o_datagram.headers(), {})
 
         self.assertEqual(o_datagram.ipaddr, '')
         self.assertEqual(o_datagram.port, '')
@@ -146,7 +186,8 @@ class CommonTestCase(TestCase):
         """Test SSDP datagram from search response without data."""
         o_datagram = SSDPdatagram(addr=SADDR1)
         self.assertAlmostEqual(o_datagram.timestamp, time(), 2)
-        self.assertEqual(len(o_datagram.__dict__), 4)
+        self.assertFalse(hasattr(o_datagram, '__dict__'))
+        self.assertEqual(o_datagram.headers(), {})
 
         self.assertEqual(o_datagram.ipaddr, '192.168.10.119')
         self.assertEqual(o_datagram.port, '47383')
@@ -158,7 +199,8 @@ class CommonTestCase(TestCase):
         """Test SSDP datagram from search response without addr."""
         o_datagram = SSDPdatagram(raw_data=SDATAGRAM1)
         self.assertAlmostEqual(o_datagram.timestamp, time(), 2)
-        self.assertEqual(len(o_datagram.__dict__), 17)
+        self.assertFalse(hasattr(o_datagram, '__dict__'))
+        self.assertEqual(len(o_datagram.headers()), 13)
 
         self.assertEqual(o_datagram.ipaddr, '')
         self.assertEqual(o_datagram.port, '')
@@ -197,6 +239,52 @@ class CommonTestCase(TestCase):
                          'f4f7681c-3056-11e8-86bd-87a6e4e2c42d')
         self.assertEqual(o_datagram.data, LDATAGRAM1.decode())
 
+    def test6_ssdp_datagram(self):
+        """Test lazy access to header properties of a SSDP datagram."""
+        o_datagram = SSDPdatagram(addr=LADDR2, raw_data=LDATAGRAM2)
+        self.assertEqual(o_datagram.method, 'M-SEARCH')
+        self.assertEqual(o_datagram.man, '"ssdp:discover"')
+        self.assertEqual(o_datagram.mx, '5')
+        self.assertFalse(hasattr(o_datagram, 'usn'))
+        self.assertFalse(hasattr(o_datagram, 'uuid'))
+        self.assertFalse(hasattr(o_datagram, 'server'))
+        with self.assertRaises(AttributeError):
+            o_datagram.location  # pylint: disable=pointless-statement
+        with self.assertRaises(AttributeError):
+            o_datagram.unknown = 'value'
+        self.assertEqual(o_datagram.headers(), {
+            'host': '239.255.255.250:1900', 'man': '"ssdp:discover"',
+            'mx': '5', 'st': 'urn:schemas-upnp-org:device:avm-aha:1'})
+
+    def test7_ssdp_datagram(self):
+        """Test SSDP datagram with duplicate and malformed header lines."""
+        o_datagram = SSDPdatagram(raw_data=(
+            b'NOTIFY * HTTP/1.1\n'
+            b'NT: first\n'
+            b' Nt : second \n'
+            b'_private: value\n'
+            b':no name\n'
+            b'USN: uuid:1234'))
+        self.assertEqual(o_datagram.method, 'NOTIFY')
+        self.assertEqual(o_datagram.nt, 'second')
+        self.assertEqual(o_datagram.x_private, 'value')
+        self.assertEqual(o_datagram.usn, 'uuid:1234')
+        self.assertEqual(o_datagram.uuid, '1234')
+
+    def test8_ssdp_datagram(self):
+        """Test header lookups with get() and the decoded data cache."""
+        o_datagram = SSDPdatagram(addr=('fe80::2', 1900, 0, 2),
+                                  raw_data=LDATAGRAM1)
+        self.assertEqual(o_datagram.get('nts'), 'ssdp:alive')
+        self.assertIsNone(o_datagram.get('st'))
+        self.assertEqual(o_datagram.get('st', ''), '')
+        # The missing header is cached.
+        self.assertIn('st', o_datagram._cache)  # pylint: disable=W0212
+        self.assertFalse(hasattr(o_datagram, 'st'))
+        self.assertIs(o_datagram.data, o_datagram.data)
+        self.assertEqual(o_datagram.address(), '[fe80::2]:1900')
+        self.assertEqual(SSDPdatagram().address(), '')
+
     def test1_fdevice(self):
         """Test formating a device output from a search datagram."""
         o_datagram = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
@@ -320,4 +408,298 @@ class CommonTestCase(TestCase):
         self.assertRegex(result[:9], r'^0001\.\d\d\d\d$')
         self.assertEqual(result[9:], 's 4\r\n' + LDATAGRAM1.decode())
 
+    def test11_fdevice(self):
+        """Test formating a device output tagged with its interface."""
+        o_datagram = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+        o_datagram.interface = 'eth0'
+        result = o_datagram.fdevice()
+        self.assertEqual(result, (
+            '0000.0000s 0 192.168.10.119:47383@eth0 '
+            'uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 Linux/3.10.79, '
+            'UPnP/1.0, Portable SDK for UPnP devices/1.6.18\r\n'))
+        result = o_datagram.fdevice(verbose=True)
+        self.assertEqual(result, '0000.0000s 0 192.168.10.119:47383@eth0\r\n'
+                         + SDATAGRAM1.decode())
+
+    def test1_fndjson(self):
+        """Test formating a listen datagram as JSON line."""
+        o_datagram = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)
+        o_datagram.timestamp = 1537722518.25
+        result = o_datagram.fndjson(base_time=1537722517.0,
+                                    fields=Mcast.FIELDS)
+        self.assertTrue(result.endswith('}\n'))
+        self.assertEqual(result.count('\n'), 1)
+        self.assertEqual(json.loads(result), {
+            'ts': 1537722518.25, 'rel': 1.25, 'request': 0,
+            'ip': '192.168.10.86', 'port': 57535, 'method': 'NOTIFY',
+            'uuid': 'f4f7681c-3056-11e8-86bd-87a6e4e2c42d',
+            'location': 'http://192.168.10.86:49494/description.xml',
+            'server': 'Linux/4.14.71-v7+, UPnP/1.0, Portable SDK for UPnP '
+                      'devices/1.6.19+git20160116',
+            'cache_control': 'max-age=100',
+            'nt': 'urn:schemas-upnp-org:device:MediaRenderer:1',
+            'nts': 'ssdp:alive'})
+        result = json.loads(o_datagram.fndjson(fields=('nts',), raw=True))
+        self.assertEqual(result['raw'], LDATAGRAM1.decode())
+        self.assertNotIn('rel', result)
+        self.assertNotIn('location', result)
+
+    def test2_fndjson(self):
+        """Test formating a datagram without addr and data as JSON line."""
+        o_datagram = SSDPdatagram()
+        o_datagram.request = 2
+        result = json.loads(o_datagram.fndjson(fields=Mcast.FIELDS, raw=True))
+        self.assertEqual(set(result), {'ts', 'request'})
+        self.assertEqual(result['request'], 2)
+
+    def test_fbinary(self):
+        """Test formating datagrams as binary records and read them."""
+        o_datagram1 = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)
+        o_datagram1.interface = 'eth0'
+        o_datagram2 = SSDPdatagram()
+        o_datagram2.request = 3
+        o_datagram3 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+        stream = BytesIO(
+            o_datagram1.fbinary(fields=('nts', 'location', 'st'))
+            + o_datagram2.fbinary(fields=Mcast.FIELDS, raw=True)
+            + o_datagram3.fbinary(fields=('st',), raw=True))
+        result = list(read_records(stream))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0], {
+            'ts': o_datagram1.timestamp, 'request': 0, 'port': 57535,
+            'ip': '192.168.10.86', 'interface': 'eth0', 'method': 'NOTIFY',
+            'uuid': 'f4f7681c-3056-11e8-86bd-87a6e4e2c42d', 'fields': {
+                'nts': 'ssdp:alive',
+                'location': 'http://192.168.10.86:49494/description.xml'},
+            'raw': b''})
+        self.assertEqual(result[1], {
+            'ts': o_datagram2.timestamp, 'request': 3, 'port': 0, 'ip': '',
+            'interface': '', 'method': '', 'uuid': '', 'fields': {},
+            'raw': b''})
+        self.assertEqual(result[2]['fields'], {'st': 'upnp:rootdevice'})
+        self.assertEqual(result[2]['raw'], SDATAGRAM1)
+
+    def test2_fbinary(self):
+        """Test a uuid longer than 255 bytes and truncated streams."""
+        _uuid = 'f4f7681c-' * 40
+        o_datagram = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1.replace(
+            b'f4f7681c-3056-11e8-86bd-87a6e4e2c42d', _uuid.encode()))
+        _record = o_datagram.fbinary(fields=('nt',), raw=True)
+        result = list(read_records(BytesIO(_record)))
+        self.assertEqual(result[0]['uuid'], _uuid)
+        self.assertEqual(result[0]['raw'], o_datagram.data.encode())
+        for _size in (10, 30, len(_record) - 1):
+            with self.assertRaisesRegex(ValueError, 'truncated binary record'):
+                list(read_records(BytesIO(_record + _record[:_size])))
+        # A record whose length is too short for its fields
+        _invalid = struct.pack('!I', 30) + _record[4:34]
+        with self.assertRaisesRegex(ValueError, 'invalid binary record'):
+            list(read_records(BytesIO(_invalid)))
+
+    def test_interfaces(self):
+        """Test the list of local interfaces with IPv4 address."""
+        for name, ipaddr in interfaces():
+            self.assertIsInstance(name, str)
+            self.assertRegex(ipaddr, r'^\d+\.\d+\.\d+\.\d+$')
+            self.assertFalse(ipaddr.startswith('127.'))
+
+
+class DeviceTableTestCase(TestCase):
+    """Tests for the table of devices."""
+
+    def test1_device_table(self):
+        """Test adding, refreshing and looking up devices."""
+        o_table = DeviceTable()
+        o_datagram1 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+        key1 = ('192.168.10.119', '3b2867a3-b55f-8e77-5ad8-a6d0c6990277',
+                'upnp:rootdevice')
+        self.assertEqual(DeviceTable.key(o_datagram1), key1)
+        self.assertIsNone(o_table.update(o_datagram1))
+        self.assertIsNone(o_table.update(
+            SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)))
+        self.assertIsNone(o_table.update(
+            SSDPdatagram(addr=LADDR2, raw_data=LDATAGRAM2)))
+        self.assertEqual(len(o_table), 2)
+        self.assertIn(key1, o_table)
+        self.assertIn((
+            '192.168.10.86', 'f4f7681c-3056-11e8-86bd-87a6e4e2c42d',
+            'urn:schemas-upnp-org:device:MediaRenderer:1'), o_table)
+        o_datagram2 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+        self.assertIs(o_table.update(o_datagram2), o_datagram1)
+        self.assertIs(o_table.get(key1), o_datagram2)
+        self.assertEqual(len(o_table), 2)
+        o_table.remove(key1)
+        self.assertIsNone(o_table.get(key1))
+        self.assertEqual(len(list(o_table)), 1)
+
+    def test2_device_table(self):
+        """Test expiry of devices by their max-age."""
+        o_table = DeviceTable()
+        o_datagram1 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+        o_datagram2 = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)
+        self.assertEqual(DeviceTable.max_age(o_datagram1), 1800)
+        self.assertEqual(DeviceTable.max_age(o_datagram2), 100)
+        self.assertEqual(DeviceTable.max_age(SSDPdatagram()), 1800)
+        o_table.update(o_datagram1)
+        o_table.update(o_datagram2)
+        self.assertEqual(o_table.expire(o_datagram2.timestamp + 99), [])
+        self.assertEqual(o_table.expire(o_datagram2.timestamp + 100),
+                         [o_datagram2])
+        self.assertEqual(len(o_table), 1)
+        # A refreshed device expires with its last max-age.
+        o_datagram3 = SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1)
+        o_datagram3.timestamp += 1000
+        o_table.update(o_datagram3)
+        self.assertEqual(o_table.expire(o_datagram1.timestamp + 1800), [])
+        self.assertEqual(o_table.expire(o_datagram3.timestamp + 1800),
+                         [o_datagram3])
+        self.assertEqual(len(o_table), 0)
+
+    def test3_device_table(self):
+        """Test removing a device with a ssdp:byebye notify."""
+        o_table = DeviceTable()
+        o_table.update(SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1))
+        self.assertEqual(len(o_table), 1)
+        o_byebye = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1.replace(
+            b'ssdp:alive', b'ssdp:byebye'))
+        self.assertIsNotNone(o_table.update(o_byebye))
+        self.assertEqual(len(o_table), 0)
+        self.assertIsNone(o_table.update(o_byebye))
+
+    def test4_device_table(self):
+        """Test that the heap is rebuild with many refreshed devices."""
+        o_table = DeviceTable()
+        for i in range(1000):
+            o_datagram = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)
+            o_datagram.timestamp += i
+            o_table.update(o_datagram)
+        self.assertEqual(len(o_table), 1)
+        self.assertLessEqual(len(o_table._heap), 66)  # pylint: disable=W0212
+
+    def test5_device_table(self):
+        """Test devices without unique identifier."""
+        o_table = DeviceTable()
+        data = SDATAGRAM3.replace(
+            b'USN: uuid:123402409-bccb-40e7-8e6c-3481C4FC71A9::'
+            b'upnp:rootdevice\r\n', b'')
+        o_datagram1 = SSDPdatagram(addr=SADDR3, raw_data=data)
+        self.assertEqual(DeviceTable.key(o_datagram1),
+                         ('192.168.10.3', '', 'upnp:rootdevice'))
+        self.assertIsNone(o_table.update(o_datagram1))
+        self.assertIs(o_table.update(SSDPdatagram(addr=SADDR3,
+                                                  raw_data=data)),
+                      o_datagram1)
+        # Another address is another device.
+        self.assertIsNone(o_table.update(SSDPdatagram(addr=SADDR1,
+                                                      raw_data=data)))
+        self.assertEqual(len(o_table), 2)
+
+
+class ChangeTableTestCase(TestCase):
+    """Tests for the state table that reports only changes."""
+
+    def test1_change_table(self):
+        """Test new devices, renewals and changed headers."""
+        o_table = ChangeTable()
+        o_datagram1 = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1)
+        self.assertEqual(o_table.update(o_datagram1), [o_datagram1])
+        self.assertEqual(o_datagram1.change, 'new')
+        # The state does not depend on the source address.
+        self.assertEqual(o_table.update(SSDPdatagram(
+            addr=LADDR3, raw_data=LDATAGRAM1)), [])
+        o_datagram2 = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1.replace(
+            b':49494/', b':49152/').replace(
+                b'NTS:', b'BOOTID.UPNP.ORG: 2\r\nNTS:'))
+        self.assertEqual(o_table.update(o_datagram2), [o_datagram2])
+        self.assertEqual(o_datagram2.change, 'changed:location,bootid')
+        # Another notification type of the same device is a new state.
+        o_datagram3 = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1.replace(
+            b'device:MediaRenderer', b'device:MediaServer'))
+        self.assertEqual(o_table.update(o_datagram3), [o_datagram3])
+        self.assertEqual(len(o_table), 2)
+        self.assertEqual(o_table.update(SSDPdatagram(
+            addr=LADDR2, raw_data=LDATAGRAM2)), [])
+        self.assertRegex(o_datagram2.fdevice(),
+                         r'^0000\.0000s 0 changed:location,bootid NOTIFY ')
+
+    def test2_change_table(self):
+        """Test byebye and expiry without renewal."""
+        o_table = ChangeTable()
+        o_byebye = SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1.replace(
+            b'ssdp:alive', b'ssdp:byebye'))
+        # An unknown device has no state to change.
+        self.assertEqual(o_table.update(o_byebye), [])
+        o_table.update(SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1))
+        self.assertEqual(o_table.update(o_byebye), [o_byebye])
+        self.assertEqual(o_byebye.change, 'byebye')
+        self.assertIsNone(o_table.wakeup())
+        o_datagram = SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3)
+        o_table.update(o_datagram)
+        self.assertEqual(o_table.wakeup(), o_datagram.timestamp + 100)
+        self.assertEqual(o_table.expire(o_datagram.timestamp + 99), [])
+        result = o_table.expire(o_datagram.timestamp + 100)
+        self.assertEqual(len(result), 1)
+        self.assertEqual((result[0].change, result[0].timestamp,
+                          result[0].address(), result[0].uuid),
+                         ('expired', o_datagram.timestamp + 100,
+                          '192.168.10.75:42047',
+                          '231179de-90e9-11e8-b505-4355ee6fa7cf'))
+        self.assertEqual(o_datagram.change, 'new')
+        self.assertEqual(len(o_table), 0)
+
+    def test3_change_table(self):
+        """Test that devices without unique identifier are not tracked."""
+        o_table = ChangeTable()
+        o_datagram = SSDPdatagram(addr=SADDR3, raw_data=SDATAGRAM3.replace(
+            b'USN: uuid:123402409-bccb-40e7-8e6c-3481C4FC71A9::'
+            b'upnp:rootdevice\r\n', b''))
+        self.assertEqual(o_table.update(o_datagram), [])
+        self.assertEqual(len(o_table), 0)
+
+
+class StormFilterTestCase(TestCase):
+    """Tests for the suppression of multicast storms."""
+
+    def test1_storm_filter(self):
+        """Test dropping of identical datagrams within the window."""
+        o_storm = StormFilter(window=2)
+        self.assertTrue(o_storm.accept(LADDR1[0], LDATAGRAM1, 100.0))
+        self.assertFalse(o_storm.accept(LADDR1[0], LDATAGRAM1, 101.0))
+        self.assertTrue(o_storm.accept(LADDR3[0], LDATAGRAM3, 101.0))
+        self.assertFalse(o_storm.accept(LADDR1[0], LDATAGRAM1, 101.9))
+        self.assertTrue(o_storm.accept(LADDR1[0], LDATAGRAM1, 102.0))
+        self.assertEqual(o_storm.stats(), {
+            'passed': 3, 'duplicates': 2, 'limited': 0,
+            'sources': {'192.168.10.86': 2}})
+
+    def test2_storm_filter(self):
+        """Test the token bucket for every source."""
+        o_storm = StormFilter(rate=2, burst=3)
+        self.assertEqual([o_storm.accept(LADDR1[0], LDATAGRAM1, 100.0)
+                          for _ in range(4)], [True, True, True, False])
+        # other sources have their own bucket
+        self.assertTrue(o_storm.accept(LADDR3[0], LDATAGRAM3, 100.0))
+        # two tokens per second
+        self.assertFalse(o_storm.accept(LADDR1[0], LDATAGRAM1, 100.4))
+        self.assertTrue(o_storm.accept(LADDR1[0], LDATAGRAM1, 100.5))
+        self.assertFalse(o_storm.accept(LADDR1[0], LDATAGRAM1, 100.6))
+        self.assertEqual(o_storm.limited, 3)
+        self.assertEqual(o_storm.fstats(),
+                         'passed: 5 duplicates: 0 limited: 3 '
+                         '[192.168.10.86]: 3')
+        # full buckets are removed
+        o_storm.accept(LADDR3[0], LDATAGRAM3, 110.0)
+        self.assertEqual(len(o_storm._buckets), 1)  # pylint: disable=W0212
+
+    def test3_storm_filter(self):
+        """Test that hashes are removed after the window."""
+        o_storm = StormFilter(rate=100, window=1)
+        for i in range(100):
+            o_storm.accept(LADDR1[0], LDATAGRAM1 + str(i).encode(), 100.0)
+        self.assertEqual(len(o_storm._seen), 100)  # pylint: disable=W0212
+        self.assertTrue(o_storm.accept(LADDR1[0], LDATAGRAM1, 101.5))
+        self.assertEqual(len(o_storm._seen), 1)  # pylint: disable=W0212
+        self.assertEqual(StormFilter().fstats(),
+                         'passed: 0 duplicates: 0 limited: 0')
+
 # vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,148 @@
+"""Tests for the mucad daemon and its clients.
+
+The daemon serves on a Unix domain socket in a temporary directory. Its device
+table is updated directly by the tests, so the network is not used.
+"""
+from unittest import TestCase, mock
+import os
+import socket
+import tempfile
+
+from muca.upnp.Common import SSDPdatagram, read_records
+from muca.upnp.Daemon import Daemon, Client, query, check_directory
+from tests.CommonTest import SDATAGRAM1, LDATAGRAM1, LDATAGRAM3, \
+                             SADDR1, LADDR1, LADDR3, recvmsg
+
+
+class DaemonTestCase(TestCase):
+    """Tests for the daemon."""
+
+    def setUp(self):
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        self.path = os.path.join(_tmpdir.name, 'mucad.sock')
+        self.daemon = Daemon(self.path)
+        self.daemon.open()
+        self.addCleanup(self.daemon.close)
+        self.daemon.update(SSDPdatagram(addr=SADDR1, raw_data=SDATAGRAM1))
+        self.daemon.update(SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1))
+
+    def test1_list(self):
+        """List all devices."""
+        result = list(query('LIST', self.path))
+        self.assertEqual(sorted(_o.uuid for _o in result), [
+            '3b2867a3-b55f-8e77-5ad8-a6d0c6990277',
+            'f4f7681c-3056-11e8-86bd-87a6e4e2c42d'])
+        _o_datagram = [_o for _o in result if _o.ipaddr == SADDR1[0]][0]
+        self.assertEqual(_o_datagram.port, str(SADDR1[1]))
+        self.assertEqual(_o_datagram.data, SDATAGRAM1.decode())
+
+    def test2_get(self):
+        """Get the entries of one device."""
+        result = list(query(
+            'GET uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d', self.path))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].nts, 'ssdp:alive')
+        self.assertEqual(list(query('get unknown', self.path)), [])
+        # a ssdp:byebye removes the device
+        self.daemon.update(SSDPdatagram(addr=LADDR1, raw_data=LDATAGRAM1
+                                        .replace(b'ssdp:alive',
+                                                 b'ssdp:byebye')))
+        self.assertEqual(list(query(
+            'GET f4f7681c-3056-11e8-86bd-87a6e4e2c42d', self.path)), [])
+
+    def test3_subscribe(self):
+        """Subscribers get every received datagram."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _sock:
+            _sock.connect(self.path)
+            _sock.sendall(b'SUBSCRIBE\n')
+            _file = _sock.makefile('rb')
+            self.assertEqual(_file.readline(), b'OK\n')
+            self.daemon.update(SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3))
+            _record = next(read_records(_file))
+            self.assertEqual(_record['ip'], LADDR3[0])
+            self.assertEqual(_record['raw'], LDATAGRAM3)
+            _file.close()
+        # the daemon ends the subscription
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _sock:
+            _sock.connect(self.path)
+            _sock.sendall(b'SUBSCRIBE\n')
+            _file = _sock.makefile('rb')
+            self.assertEqual(_file.readline(), b'OK\n')
+            self.daemon.close()
+            self.assertEqual(list(read_records(_file)), [])
+            _file.close()
+
+    def test4_errors(self):
+        """Unknown commands are answered with an error."""
+        with self.assertRaisesRegex(ValueError, 'unknown command: LIST all'):
+            list(query('LIST all', self.path))
+        with self.assertRaises(OSError):
+            list(query('LIST', self.path + '.missing'))
+
+    def test4_long_uuid(self):
+        """A datagram that cannot be written does not stop the daemon."""
+        _uuid = b'f4f7681c-' * 40
+        self.daemon.update(SSDPdatagram(addr=LADDR3, raw_data=LDATAGRAM3
+                                        .replace(b'231179de', _uuid)))
+        self.assertEqual(len(list(query('LIST', self.path))), 3)
+        with mock.patch.object(SSDPdatagram, 'fbinary',
+                               side_effect=ValueError('too long')), \
+                self.assertLogs('muca', level='WARNING') as logs:
+            self.assertEqual(list(query('LIST', self.path)), [])
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _sock:
+                _sock.connect(self.path)
+                _sock.sendall(b'SUBSCRIBE\n')
+                self.assertEqual(_sock.makefile('rb').readline(), b'OK\n')
+                self.daemon.update(SSDPdatagram(addr=LADDR3,
+                                                raw_data=LDATAGRAM3))
+        self.assertEqual(len(logs.output), 4)
+        self.assertIn('skipped: too long', logs.output[0])
+
+    def test4_socket_directory(self):
+        """The daemon refuses a directory that other users can access."""
+        _directory = os.path.dirname(self.path)
+        check_directory(_directory)
+        _unsafe = os.path.join(_directory, 'unsafe')
+        os.mkdir(_unsafe, 0o700)
+        os.chmod(_unsafe, 0o755)
+        with self.assertRaisesRegex(PermissionError, 'mode 755, not 700'):
+            Daemon(os.path.join(_unsafe, 'mucad.sock')).open()
+        _link = os.path.join(_directory, 'link')
+        os.symlink(_directory, _link)
+        with self.assertRaisesRegex(PermissionError, 'is no directory'):
+            Daemon(os.path.join(_link, 'mucad.sock')).open()
+        with mock.patch('os.getuid', return_value=os.getuid() + 1), \
+                self.assertRaisesRegex(PermissionError, 'another user'):
+            check_directory(_directory)
+        self.assertEqual(os.listdir(_unsafe), [])
+
+    def test5_search(self):
+        """Start a search in the background."""
+        with mock.patch.object(Daemon, '_search') as mock_search:
+            self.assertEqual(list(query('SEARCH', self.path)), [])
+        mock_search.assert_called_once_with()
+
+    def test6_run(self):
+        """Listened datagrams update the table without being formated."""
+        with mock.patch('muca.upnp.Listen.socket.socket') as mock_socket, \
+                mock.patch('muca.upnp.Listen.Listen._format') as mock_format:
+            mock_socket.return_value.mock_add_spec(
+                ['setsockopt', 'getsockopt', 'bind', 'recvmsg'],
+                spec_set=True)
+            mock_socket.return_value.recvmsg.side_effect = recvmsg(
+                (LDATAGRAM3, LADDR3), KeyboardInterrupt())
+            self.daemon.run()
+        mock_format.assert_not_called()
+        self.assertEqual(len(list(query('LIST', self.path))), 3)
+
+    def test_client(self):
+        """Test the formated output of a client."""
+        o_client = Client('GET 3b2867a3-b55f-8e77-5ad8-a6d0c6990277',
+                          path=self.path)
+        o_client.request()
+        self.assertRegex(o_client.get(), r'^0000\.0000s 0 192\.168\.10\.119:'
+                         r'47383 uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 ')
+        self.assertIsNone(o_client.get())
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,147 @@
+"""Tests for fetching device descriptions.
+
+A local http.server stands in for the UPnP devices. It serves the
+description of every device with kept alive HTTP/1.1 connections.
+"""
+from unittest import TestCase
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+
+from muca.upnp.Common import SSDPdatagram
+from muca.upnp.Description import DescriptionFetcher, friendly_name
+from tests.CommonTest import SDATAGRAM1, SADDR1
+
+DESCRIPTION = \
+    b'<?xml version="1.0"?>\r\n' \
+    b'<root xmlns="urn:schemas-upnp-org:device-1-0">\r\n' \
+    b'<specVersion><major>1</major><minor>0</minor></specVersion>\r\n' \
+    b'<device>\r\n' \
+    b'<deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType>' \
+    b'\r\n<friendlyName>{}</friendlyName>\r\n' \
+    b'</device>\r\n' \
+    b'</root>\r\n'
+
+
+class DeviceHandler(BaseHTTPRequestHandler):
+    """Serve descriptions with the device number from the path."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Answer a description request."""
+        with self.server.lock:
+            self.server.requests += 1
+        if not self.path.startswith('/device'):
+            self.send_error(404)
+            return
+        _data = DESCRIPTION.replace(
+            b'{}', b'Device ' + self.path[7:].encode())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(_data)))
+        self.end_headers()
+        self.wfile.write(_data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Do not log requests."""
+
+
+def datagram(server, number, bootid=1, path='/device'):
+    """This returns a response datagram of a device from the server."""
+    _host, _port = server.server_address[:2]
+    _location = 'http://{}:{}{}{}'.format(_host, _port, path, number)
+    _uuid = 'uuid:00000000-0000-1000-8000-{:012x}'.format(number)
+    _data = SDATAGRAM1 \
+        .replace(b'http://192.168.10.119:8008/ssdp/device-desc.xml',
+                 _location.encode()) \
+        .replace(b'uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277',
+                 _uuid.encode()) \
+        .replace(b'\r\n\r\n',
+                 'BOOTID.UPNP.ORG: {}\r\n\r\n'.format(bootid).encode())
+    return SSDPdatagram(SADDR1, _data)
+
+
+class DescriptionTestCase(TestCase):
+    """Tests for the description fetcher with a local HTTP server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DeviceHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        _thread = threading.Thread(target=self.server.serve_forever)
+        _thread.start()
+        self.addCleanup(_thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.fetcher = DescriptionFetcher(workers=4, timeout=5)
+        self.addCleanup(self.fetcher.close)
+
+    def test1_fetch(self):
+        """Fetch descriptions of many devices concurrently."""
+        _datagrams = [datagram(self.server, i) for i in range(20)]
+        result = self.fetcher.fetch(_datagrams)
+        self.assertEqual(len(result), 20)
+        for i, (_o_datagram, _description) in enumerate(result):
+            self.assertIs(_o_datagram, _datagrams[i])
+            self.assertEqual(friendly_name(_description),
+                             'Device {}'.format(i))
+        self.assertEqual(self.fetcher.fetched, 20)
+        self.assertEqual(self.server.requests, 20)
+        # connections are kept alive and reused
+        self.assertLessEqual(self.fetcher.connections, 4)
+        self.assertEqual(self.fetcher.errors, {})
+
+    def test2_cache(self):
+        """Unchanged devices are not fetched again."""
+        _o_datagram = datagram(self.server, 1)
+        self.assertEqual(friendly_name(self.fetcher.get(_o_datagram)),
+                         'Device 1')
+        # duplicates in one batch and cached descriptions
+        result = self.fetcher.fetch([datagram(self.server, 1),
+                                     datagram(self.server, 2),
+                                     datagram(self.server, 2)])
+        self.assertEqual([friendly_name(_d) for _, _d in result],
+                         ['Device 1', 'Device 2', 'Device 2'])
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.fetcher.hits, 1)
+        # a reboot of the device changes BOOTID.UPNP.ORG
+        self.fetcher.get(datagram(self.server, 1, bootid=2))
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.fetcher.connections, 1)
+
+    def test3_errors(self):
+        """Failed downloads return None."""
+        _o_datagram = datagram(self.server, 1, path='/missing')
+        self.assertIsNone(self.fetcher.get(_o_datagram))
+        self.assertIn('404', self.fetcher.errors[
+            DescriptionFetcher.key(_o_datagram)])
+        # no cached error, it is fetched again
+        self.assertIsNone(self.fetcher.get(_o_datagram))
+        self.assertEqual(self.server.requests, 2)
+        # unsupported location and no location
+        _o_https = SSDPdatagram(SADDR1, SDATAGRAM1.replace(
+            b'http://', b'https://'))
+        self.assertIsNone(self.fetcher.get(_o_https))
+        _o_nolocation = SSDPdatagram(SADDR1, SDATAGRAM1.replace(
+            b'LOCATION:', b'X-LOCATION:'))
+        self.assertIsNone(self.fetcher.get(_o_nolocation))
+        self.assertEqual(self.fetcher.fetched, 0)
+
+    def test4_closed_connection(self):
+        """A connection closed by the host is replaced by a new one."""
+        self.fetcher.get(datagram(self.server, 1))
+        for _idle in self.fetcher._pool.values():  # pylint: disable=W0212
+            for _conn in _idle:
+                _conn.sock.close()
+        self.assertEqual(friendly_name(self.fetcher.get(
+            datagram(self.server, 2))), 'Device 2')
+        self.assertEqual(self.fetcher.connections, 2)
+
+    def test_friendly_name(self):
+        """Test the friendly name of descriptions."""
+        self.assertEqual(friendly_name(DESCRIPTION.replace(b'{}', b' TV ')),
+                         'TV')
+        self.assertEqual(friendly_name(b'<root/>'), '')
+        self.assertEqual(friendly_name(b'no xml'), '')
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,131 @@
+"""Tests for the filter expressions."""
+from unittest import TestCase, mock
+import socket
+
+from muca.upnp.Common import SSDPdatagram
+from muca.upnp.Filter import Filter
+from muca.upnp.Listen import Listen
+from muca.upnp.Search import MsearchDevice
+from tests.CommonTest import SDATAGRAM1, SDATAGRAM2, SDATAGRAM3, \
+                             LDATAGRAM1, LDATAGRAM2, LDATAGRAM3, \
+                             SADDR1, SADDR2, SADDR3, LADDR1, LADDR2, LADDR3, \
+                             recvmsg
+
+DATAGRAMS = ((SADDR1, SDATAGRAM1), (SADDR2, SDATAGRAM2), (SADDR3, SDATAGRAM3),
+             (LADDR1, LDATAGRAM1), (LADDR2, LDATAGRAM2), (LADDR3, LDATAGRAM3))
+
+
+class FilterTestCase(TestCase):
+    """Tests for compiling and matching filter expressions."""
+
+    def matching(self, expression):
+        """This returns the indexes of the DATAGRAMS that match."""
+        o_filter = Filter(expression)
+        return [i for i, (_addr, _data) in enumerate(DATAGRAMS)
+                if o_filter(SSDPdatagram(_addr, _data))]
+
+    def test1_filter(self):
+        """Test the operators."""
+        self.assertEqual(self.matching(
+            'nt ~ "MediaRenderer" and nts == "ssdp:alive" and '
+            'ip in 192.168.10.0/24'), [3])
+        self.assertEqual(self.matching('ip in 192.168.10.0/24'),
+                         [0, 2, 3, 4, 5])
+        self.assertEqual(self.matching('ip == 192.168.49.1'), [1])
+        self.assertEqual(self.matching('port != 1900'), [0, 1, 3, 4, 5])
+        self.assertEqual(self.matching('method == NOTIFY'), [3, 5])
+        self.assertEqual(self.matching('method == ""'), [0, 1, 2])
+        self.assertEqual(self.matching('method ~ SEARCH'), [4])
+        self.assertEqual(self.matching('server !~ Cling'), [0, 2, 3, 5])
+        self.assertEqual(self.matching('uuid == '
+                                       'f4f7681c-3056-11e8-86bd-87a6e4e2c42d'),
+                         [3])
+        self.assertEqual(self.matching('bootid_upnp_org'), [0])
+        self.assertEqual(self.matching('x01_nls and not ip == 192.168.10.86'),
+                         [0, 5])
+        self.assertEqual(self.matching('(st or nt) and not (st == '
+                                       'upnp:rootdevice)'), [3, 4, 5])
+        self.assertEqual(self.matching('interface == ""'),
+                         [0, 1, 2, 3, 4, 5])
+
+    def test2_filter(self):
+        """The raw check must agree with the check of the parsed datagram."""
+        for expression in (
+                'ip in 192.168.10.0/24', 'method == NOTIFY', 'nts',
+                'not cache_control', 'nts == ssdp:alive', 'nt ~ Media',
+                'usn != x', 'uuid == 3b2867a3-b55f-8e77-5ad8-a6d0c6990277',
+                'not (method == M-SEARCH or port == 1900)',
+                'location and not ip in 192.168.10.64/26',
+                'interface == eth0 or ip == 192.168.10.3'):
+            o_filter = Filter(expression)
+            for _addr, _data in DATAGRAMS:
+                _match = o_filter(SSDPdatagram(_addr, _data))
+                if o_filter.prematch is None:
+                    continue
+                _prematch = o_filter.prematch(_addr, _data)
+                if o_filter.exact:
+                    self.assertEqual(_prematch, _match, expression)
+                elif not _prematch:
+                    self.assertFalse(_match, expression)
+
+    def test3_filter(self):
+        """Test which expressions are decided on the raw datagram."""
+        self.assertTrue(Filter('ip in 10.0.0.0/8 and not method == '
+                               'M-SEARCH').exact)
+        self.assertTrue(Filter('location or cache_control').exact)
+        o_filter = Filter('nts == ssdp:alive')
+        self.assertFalse(o_filter.exact)
+        self.assertIsNotNone(o_filter.prematch)
+        self.assertIsNone(Filter('not nt ~ Media').prematch)
+        self.assertIsNone(Filter('interface == eth0').prematch)
+        self.assertIsNone(Filter('uuid or ip == 10.0.0.1').prematch)
+
+    def test4_filter(self):
+        """Test invalid expressions."""
+        for expression, message in (
+                ('', 'unexpected end'),
+                ('nt ==', 'value expected'),
+                ('nt == a b', 'unexpected "b"'),
+                ('(nt', 'missing'),
+                ('nt = a', 'unexpected "="'),
+                ('NT == a', 'field expected'),
+                ('ip in 10.0.0.300/8', 'invalid network'),
+                ('nt in 10.0.0.0/8', 'only available for ip'),
+                ('nt ~ "("', 'invalid regex'),
+                ('method', 'needs a comparison')):
+            with self.assertRaisesRegex(ValueError, message):
+                Filter(expression)
+
+    @mock.patch('muca.upnp.Listen.socket.socket')
+    def test_listen(self, mock_socket):
+        """Datagrams that fail the raw check are not parsed."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), (LDATAGRAM3, LADDR3),
+            KeyboardInterrupt())
+        o_listen = Listen(match=Filter('method == NOTIFY and '
+                                       'not ip == 192.168.10.86'))
+        o_listen.open()
+        with mock.patch('muca.upnp.Common.SSDPdatagram',
+                        wraps=SSDPdatagram) as mock_datagram:
+            self.assertRegex(o_listen.get(), r'^0000\.0\d{3}s 0 NOTIFY '
+                             r'192\.168\.10\.75:42047 ')
+            self.assertIsNone(o_listen.get())
+        self.assertEqual(mock_datagram.call_count, 1)
+
+    @mock.patch('muca.upnp.Search.socket.socket')
+    def test_search(self, mock_socket):
+        """Responses that do not match are not recorded."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1), (SDATAGRAM2, SADDR2), (SDATAGRAM3, SADDR3),
+            socket.timeout())
+        o_search = MsearchDevice(match=Filter('server ~ "Linux/3"'))
+        o_search.request(retries=1)
+        self.assertRegex(o_search.get(), r' 192\.168\.10\.119:47383 ')
+        self.assertRegex(o_search.get(), r' 192\.168\.49\.1:34731 ')
+        self.assertRegex(o_search.get(), r'^\d{4}\.\d{4}s 0\r\n$')
+        self.assertEqual(len(o_search.responses()), 2)
+        self.assertEqual(len(o_search.cached()), 3)
+        self.assertEqual([_o.ipaddr for _o in o_search.responses()],
+                         ['192.168.10.119', '192.168.49.1'])
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,48 @@
+"""Tests for the program with subcommands."""
+from unittest import TestCase, mock
+from io import StringIO
+import sys
+import subprocess
+
+from muca.Main import main
+
+
+class MainTestCase(TestCase):
+    """Tests for the subcommand dispatcher."""
+
+    def test1_main(self):
+        """Test help and version without a command."""
+        with mock.patch('sys.stdout', new=StringIO()) as mock_stdout:
+            main([])
+            main(['-V'])
+        self.assertRegex(mock_stdout.getvalue(), (
+            r'^usage: muca \[-h\] \[-V\] COMMAND \.\.\.\n\ncommands:\n'
+            r'  search    search for UPnP devices\n(.|\n)*\nBuild 2\n$'))
+
+    def test2_main(self):
+        """Test an unknown command."""
+        with mock.patch('sys.stderr', new=StringIO()) as mock_stderr, \
+                self.assertRaises(SystemExit) as cm:
+            main(['serach'])
+        self.assertEqual(cm.exception.code, 2)
+        self.assertTrue(mock_stderr.getvalue().endswith(
+            "muca: error: unknown command 'serach'\n"))
+
+    def test3_main(self):
+        """Test that a command gets its arguments and program name."""
+        with mock.patch('sys.stdout', new=StringIO()) as mock_stdout:
+            main(['search', '--version'])
+            with self.assertRaises(SystemExit):
+                main(['listen', '--help'])
+        self.assertRegex(mock_stdout.getvalue(),
+                         r'^Build 2\nusage: muca listen \[-h\]')
+
+    def test4_main(self):
+        """The program imports nothing before a command runs."""
+        result = subprocess.run([sys.executable, '-c', (
+            'import sys, muca.Main; print(sorted(_m for _m in sys.modules '
+            'if _m.startswith("muca.upnp") or _m in ("argparse", "socket")))'
+        )], stdout=subprocess.PIPE, check=True)
+        self.assertEqual(result.stdout, b'[]\n')
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,130 @@
+"""Tests for counters, histograms and their export."""
+from unittest import TestCase, mock
+import os
+import socket
+import tempfile
+
+from muca.Metrics import Metrics, Histogram
+from muca.upnp.Listen import Listen
+from muca.upnp.Search import MsearchDevice
+from tests.CommonTest import LDATAGRAM1, LDATAGRAM3, SDATAGRAM1, \
+                             LADDR1, LADDR3, SADDR1, recvmsg
+
+
+class MetricsTestCase(TestCase):
+    """Tests for the metrics."""
+
+    def test1_histogram(self):
+        """Test the buckets of a histogram."""
+        o_histogram = Histogram()
+        for _value in (0.5e-6, 1e-6, 3e-6, 2.0):
+            o_histogram.observe(_value)
+        _stats = o_histogram.stats()
+        self.assertEqual(_stats['count'], 4)
+        self.assertEqual(_stats['max'], 2.0)
+        self.assertAlmostEqual(_stats['mean'], 4.5e-6 / 4 + 0.5)
+        self.assertEqual(_stats['buckets'][1e-6], 2)
+        self.assertEqual(_stats['buckets'][5e-6], 1)
+        self.assertEqual(_stats['buckets'][float('inf')], 1)
+
+    def test2_metrics(self):
+        """Test counters, summary and Prometheus text format."""
+        o_metrics = Metrics()
+        o_metrics.count('datagrams_received')
+        o_metrics.count('bytes_received', 100)
+        o_metrics.observe('parse', 2e-5)
+        self.assertEqual(o_metrics.counter('bytes_received'), 100)
+        self.assertEqual(o_metrics.counter('unknown'), 0)
+        self.assertIsNone(o_metrics.histogram('format'))
+        self.assertEqual(o_metrics.stats()['counters'], {
+            'datagrams_received': 1, 'bytes_received': 100})
+        self.assertEqual(o_metrics.fstats(), (
+            'bytes_received: 100\n'
+            'datagrams_received: 1\n'
+            'parse: count 1 mean 20.0us max 20.0us'))
+        _text = o_metrics.prometheus()
+        self.assertIn('# TYPE muca_bytes_received_total counter\n'
+                      'muca_bytes_received_total 100\n', _text)
+        self.assertIn('# TYPE muca_parse_seconds histogram\n'
+                      'muca_parse_seconds_bucket{le="1e-06"} 0\n', _text)
+        self.assertIn('muca_parse_seconds_bucket{le="2.5e-05"} 1\n'
+                      'muca_parse_seconds_bucket{le="5e-05"} 1\n', _text)
+        self.assertTrue(_text.endswith(
+            'muca_parse_seconds_bucket{le="+Inf"} 1\n'
+            'muca_parse_seconds_sum 2e-05\n'
+            'muca_parse_seconds_count 1\n'))
+
+    def test2_metrics_merge(self):
+        """Test adding the metrics of a worker."""
+        o_metrics = Metrics()
+        o_metrics.count('datagrams_received', 2)
+        o_metrics.observe('parse', 2e-5)
+        o_worker = Metrics()
+        o_worker.count('datagrams_received')
+        o_worker.observe('parse', 3e-3)
+        o_worker.observe('format', 1e-6)
+        o_metrics.merge(o_worker)
+        self.assertEqual(o_metrics.counter('datagrams_received'), 3)
+        _stats = o_metrics.stats()['histograms']
+        self.assertEqual((_stats['parse']['count'], _stats['parse']['max']),
+                         (2, 3e-3))
+        self.assertEqual(_stats['parse']['buckets'][1e-2], 1)
+        self.assertEqual(_stats['format']['count'], 1)
+
+    def test3_export(self):
+        """Test writing the Prometheus text format to a file."""
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        _filename = os.path.join(_tmpdir.name, 'muca.prom')
+        o_metrics = Metrics(prefix='test')
+        o_metrics.start_export(_filename, interval=60)
+        o_metrics.count('datagrams_received', 3)
+        o_metrics.stop_export()
+        o_metrics.stop_export()
+        with open(_filename) as _file:
+            self.assertEqual(_file.read(), (
+                '# TYPE test_datagrams_received_total counter\n'
+                'test_datagrams_received_total 3\n'))
+        self.assertEqual(os.listdir(_tmpdir.name), ['muca.prom'])
+
+    @mock.patch('muca.upnp.Listen.socket.socket')
+    def test4_listen(self, mock_socket):
+        """Test metrics of listening."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM3, LADDR3),
+            (b'x' * 4096, [], socket.MSG_TRUNC, LADDR1),
+            (LDATAGRAM1, [(socket.SOL_SOCKET, 40, b'\x02\x00\x00\x00')], 0,
+             LADDR1), KeyboardInterrupt())
+        o_metrics = Metrics()
+        o_listen = Listen(metrics=o_metrics)
+        o_listen.open()
+        o_listen.get()
+        o_listen.get()
+        with self.assertLogs('muca', level='WARNING'):
+            o_listen.get()
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(o_metrics.stats()['counters'], {
+            'datagrams_received': 3,
+            'bytes_received': 2 * len(LDATAGRAM1) + len(LDATAGRAM3),
+            'datagrams_truncated': 1,
+            'datagrams_dropped': 2})
+        self.assertEqual(o_metrics.histogram('parse').count, 3)
+        self.assertEqual(o_metrics.histogram('format').count, 3)
+
+    @mock.patch('muca.upnp.Search.socket.socket')
+    def test5_search(self, mock_socket):
+        """Test metrics of the dedupe of responses."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1), (SDATAGRAM1, SADDR1), (SDATAGRAM1, SADDR1),
+            socket.timeout())
+        o_metrics = Metrics()
+        o_search = MsearchDevice(metrics=o_metrics)
+        o_search.request(retries=1)
+        self.assertRegex(o_search.get(), r'192\.168\.10\.119')
+        self.assertRegex(o_search.get(), r'^\d{4}\.\d{4}s 0\r\n$')
+        self.assertIsNone(o_search.get())
+        self.assertEqual(o_metrics.counter('dedupe_new'), 1)
+        self.assertEqual(o_metrics.counter('dedupe_duplicates'), 2)
+        self.assertEqual(o_metrics.counter('datagrams_received'), 3)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,144 @@
+"""Tests for the monitor of multicast groups."""
+from unittest import TestCase, mock
+import socket
+import struct
+
+from muca.Monitor import Monitor, GroupStats, parse_group
+from tests.CommonTest import recvmsg_into
+from tests.MpegtsTest import ts_packet, rtp_header
+
+
+def timestamp(ns):
+    """This returns the ancillary data of a kernel receive time."""
+    return [(socket.SOL_SOCKET, 35, struct.pack('@ll', *divmod(ns,
+                                                              1000000000)))]
+
+
+class GroupStatsTestCase(TestCase):
+    """Tests for the counters of a group."""
+
+    def test1_parse_group(self):
+        """Test groups from the command line."""
+        self.assertEqual(parse_group('239.1.1.1:5000'), ('239.1.1.1', 5000))
+        for text, message in (('239.1.1.1', 'invalid group'),
+                              ('192.168.10.1:5000', 'no multicast group'),
+                              (':5000', 'invalid group'),
+                              ('239.1.1.1:0', 'invalid port'),
+                              ('239.1.1.1:x', 'invalid port')):
+            with self.assertRaisesRegex(ValueError, message):
+                parse_group(text)
+
+    def test2_group_stats(self):
+        """Test gaps, jitter and rates."""
+        o_stats = GroupStats('239.1.1.1', 5000, 0.1)
+        o_stats.mark(0)
+        # 1 ms intervals with one pause of 150 ms
+        _rxtime = 10**9
+        for i in range(100):
+            _rxtime += 150000000 if i == 50 else 1000000
+            o_stats.observe(1316, _rxtime)
+        result = o_stats.stats()
+        self.assertEqual((result['packets'], result['bytes'], result['gaps']),
+                         (100, 131600, 1))
+        self.assertAlmostEqual(result['max_gap'], 0.15)
+        # The pause raises the jitter that decays afterwards.
+        self.assertGreater(result['jitter'], 0.0)
+        self.assertLess(result['jitter'], 0.01)
+        self.assertEqual(o_stats.rates(2 * 10**9), (50.0, 526400.0))
+        self.assertEqual(o_stats.rates(3 * 10**9), (0.0, 0.0))
+
+
+class MonitorTestCase(TestCase):
+    """Tests with mocked sockets and selector."""
+
+    def setUp(self):
+        """This patches the network sockets and the selector."""
+        patcher = mock.patch('muca.upnp.Common.socket.socket')
+        self.addCleanup(patcher.stop)
+        self.mock_socket = patcher.start()
+        self.mock_socket.side_effect = lambda *args: mock.Mock(spec_set=[
+            'setsockopt', 'getsockopt', 'bind', 'recvmsg_into',
+            'setblocking', 'close'])
+        patcher = mock.patch('selectors.DefaultSelector')
+        self.addCleanup(patcher.stop)
+        self.mock_selector = patcher.start()
+        self.keys = []
+        self.mock_selector.return_value.register.side_effect = \
+            lambda sock, events, data: self.keys.append(
+                mock.Mock(fileobj=sock, data=data))
+        self.ready = []
+        self.mock_selector.return_value.select.side_effect = \
+            lambda timeout: [(self.keys[i], 1) for i in self.ready.pop(0)] \
+            if self.ready else []
+
+    def test1_monitor(self):
+        """Test receiving two groups with one selector."""
+        o_monitor = Monitor([('239.1.1.1', 5000), ('239.1.1.2', 5000)])
+        o_monitor.open()
+        self.assertEqual(len(self.keys), 2)
+        o_sock1 = self.keys[0].fileobj
+        o_sock2 = self.keys[1].fileobj
+        o_sock1.bind.assert_called_with(('239.1.1.1', 5000))
+        o_sock2.bind.assert_called_with(('239.1.1.2', 5000))
+        o_sock1.setblocking.assert_called_with(False)
+        o_sock1.recvmsg_into.side_effect = recvmsg_into(
+            (b'\x47' * 1316, timestamp(10**9), 0, ('192.168.1.1', 4000)),
+            (b'\x47' * 1316, timestamp(10**9 + 2000000), 0,
+             ('192.168.1.1', 4000)),
+            (b'\x47' * 3000, [], 0, ('192.168.1.1', 4000)),
+            BlockingIOError())
+        o_sock2.recvmsg_into.side_effect = recvmsg_into(
+            (b'\x47' * 188, [(socket.SOL_SOCKET, 40, struct.pack('I', 3))],
+             0, ('192.168.1.2', 4000)),
+            BlockingIOError())
+        self.ready = [[0, 1]]
+        # The last ready socket is serviced first.
+        self.assertEqual(o_monitor.poll(), 1)
+        self.assertEqual(o_monitor.poll(), 2)
+        self.assertEqual(o_monitor.poll(0.1), 0)
+        result = o_monitor.stats()
+        self.assertEqual(result[0], {
+            'group': '239.1.1.1:5000', 'packets': 2, 'bytes': 2632,
+            'dropped': 0, 'truncated': 1, 'gaps': 0, 'max_gap': 0.002,
+            'jitter': 0.0})
+        self.assertEqual((result[1]['packets'], result[1]['dropped']), (1, 3))
+        self.assertEqual((o_monitor.dropped, o_monitor.truncated), (3, 1))
+        self.assertRegex(o_monitor.freport().splitlines()[2],
+                         r'^239\.1\.1\.2:5000 +\d+\.\d +\d\.\d{3} +0 +'
+                         r'0\.0ms +0\.00ms +3$')
+        o_monitor.close()
+        o_sock1.close.assert_called_once_with()
+        self.mock_selector.return_value.close.assert_called_once_with()
+
+    def test2_monitor(self):
+        """A busy socket is drained only up to DRAIN datagrams."""
+        o_monitor = Monitor([('239.1.1.1', 5000)])
+        o_monitor.DRAIN = 2
+        o_monitor.open()
+        self.keys[0].fileobj.recvmsg_into.side_effect = recvmsg_into(
+            *[(b'\x47' * 188, ('192.168.1.1', 4000))] * 3, BlockingIOError())
+        self.ready = [[0], [0]]
+        self.assertEqual(o_monitor.poll(), 2)
+        self.assertEqual(o_monitor.poll(), 1)
+
+    def test3_monitor(self):
+        """Test the analysis of a transport stream in RTP."""
+        o_monitor = Monitor([('239.1.1.1', 5000)], analyze=True)
+        o_monitor.open()
+        self.keys[0].fileobj.recvmsg_into.side_effect = recvmsg_into(
+            (rtp_header(1) + b''.join(ts_packet(256, i) for i in range(7)),
+             ('192.168.1.1', 4000)),
+            (rtp_header(3) + ts_packet(256, 8) + ts_packet(0x1fff, 0),
+             ('192.168.1.1', 4000)),
+            BlockingIOError())
+        self.ready = [[0]]
+        self.assertEqual(o_monitor.poll(), 2)
+        result = o_monitor.stats()[0]
+        self.assertEqual((result['ts_packets'], result['cc_errors'],
+                          result['rtp_lost'], result['null_ratio']),
+                         (9, 1, 1, 1 / 9))
+        self.assertRegex(o_monitor.freport(), r' cc err +null +max pcr +'
+                         r'pcr jit +rtp lost\n239\.1\.1\.1:5000 .* +1 +'
+                         r'11\.1% +0\.0ms +0\.00ms +1\n$')
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,130 @@
+"""Tests for the analysis of MPEG transport streams."""
+from unittest import TestCase, skipIf
+import struct
+
+from muca.Mpegts import TsAnalyzer, payload_offset, read_pcr, numpy
+
+
+def ts_packet(pid, cc, payload=True, pcr=None, discontinuity=False,
+              tei=False):
+    """This returns a TS packet of 188 bytes.
+
+    Arguments: pcr = program clock reference in 27 MHz ticks or None
+    """
+    _header = struct.pack('!BHB', 0x47, (0x8000 if tei else 0) | pid,
+                          (0x10 if payload else 0) | cc
+                          | (0x20 if pcr is not None or discontinuity else 0))
+    _adaptation = b''
+    if pcr is not None or discontinuity:
+        _flags = (0x80 if discontinuity else 0) | \
+            (0x10 if pcr is not None else 0)
+        _field = bytes((_flags,))
+        if pcr is not None:
+            _base, _ext = divmod(pcr, 300)
+            _field += struct.pack('!IH', _base >> 1,
+                                  ((_base & 1) << 15) | 0x7e00 | _ext)
+        _adaptation = bytes((len(_field),)) + _field
+    return (_header + _adaptation).ljust(188, b'\xff')
+
+
+def rtp_header(seq):
+    """This returns a RTP header for MPEG-TS (payload type 33)."""
+    return struct.pack('!BBHII', 0x80, 33, seq, 0, 0)
+
+
+class MpegtsTestCase(TestCase):
+    """Tests for the TS analyzer, with and without NumPy."""
+    vectorized = False
+
+    def analyze(self, o_analyzer, datagrams, slot=2048):
+        """Analyze datagrams with receive times (in ns) in one batch."""
+        _buffer = bytearray(slot * len(datagrams))
+        for i, (_data, _) in enumerate(datagrams):
+            _buffer[i*slot:i*slot+len(_data)] = _data
+        o_analyzer.analyze(_buffer, [i * slot for i in range(len(datagrams))],
+                           [len(_data) for _data, _ in datagrams],
+                           [_rxtime for _, _rxtime in datagrams])
+
+    def test1_payload_offset(self):
+        """Test TS packets in UDP and RTP."""
+        _packet = ts_packet(256, 0)
+        self.assertEqual(payload_offset(_packet, 188), (0, None))
+        self.assertEqual(payload_offset(rtp_header(4711) + _packet, 200),
+                         (12, 4711))
+        # RTP with one CSRC and a header extension of one word
+        _data = b'\x91' + rtp_header(1)[1:] + b'\0' * 4 + \
+            b'\0\0\0\x01' + b'\0' * 4 + _packet
+        self.assertEqual(payload_offset(_data, len(_data)), (24, 1))
+        self.assertEqual(read_pcr(ts_packet(100, 0, pcr=123456789012), 6),
+                         123456789012)
+
+    def test2_ts_analyzer(self):
+        """Test continuity counters and null packets over two batches."""
+        o_analyzer = TsAnalyzer(vectorized=self.vectorized)
+        _packets = [ts_packet(256, 0), ts_packet(257, 5), ts_packet(256, 1),
+                    ts_packet(0x1fff, 0), ts_packet(256, 1),
+                    ts_packet(257, 6, payload=False), ts_packet(257, 6),
+                    ts_packet(256, 3)]
+        self.analyze(o_analyzer, [(b''.join(_packets[:4]), 0),
+                                  (b''.join(_packets[4:]), 0)])
+        # 256: duplicate 1 and lost 2, 257: counter without payload kept
+        self.analyze(o_analyzer, [(ts_packet(257, 8), 0),
+                                  (ts_packet(256, 4, tei=True), 0),
+                                  (ts_packet(258, 9, discontinuity=True), 0),
+                                  (ts_packet(258, 2, discontinuity=True), 0)])
+        result = o_analyzer.stats()
+        self.assertEqual(
+            (result['ts_packets'], result['cc_errors'], result['pids'],
+             result['transport_errors'], result['sync_errors']),
+            (12, 2, 4, 1, 0))
+        self.assertAlmostEqual(result['null_ratio'], 1 / 12)
+
+    def test3_ts_analyzer(self):
+        """Test sync errors and lost RTP datagrams."""
+        o_analyzer = TsAnalyzer(vectorized=self.vectorized)
+        _packet = ts_packet(256, 0)
+        self.analyze(o_analyzer, [
+            (rtp_header(65534) + _packet * 7, 0),
+            (rtp_header(65535) + _packet[:100], 0),
+            (rtp_header(2) + b'\x00' + _packet[1:] + _packet, 0),
+            # reordered
+            (rtp_header(1) + _packet, 0)])
+        result = o_analyzer.stats()
+        self.assertEqual((result['rtp_lost'], result['sync_errors'],
+                          result['ts_packets']), (2, 2, 9))
+
+    def test4_ts_analyzer(self):
+        """Test PCR intervals and jitter."""
+        o_analyzer = TsAnalyzer(vectorized=self.vectorized)
+        _wrap = (1 << 33) * 300
+        self.analyze(o_analyzer, [
+            (ts_packet(100, 0, pcr=_wrap - 270000), 10**9),
+            (ts_packet(101, 0) + ts_packet(100, 1, pcr=540000), 10**9
+             + 30000000),
+            (ts_packet(100, 2, pcr=1890000), 10**9 + 80000000)])
+        # A discontinuity does not count the interval.
+        self.analyze(o_analyzer, [
+            (ts_packet(100, 3, pcr=0, discontinuity=True), 10**9
+             + 90000000)])
+        result = o_analyzer.stats()
+        self.assertEqual((result['pcrs'], result['pcr_late'],
+                          result['cc_errors']), (4, 1, 0))
+        self.assertAlmostEqual(result['pcr_max_interval'], 0.05)
+        # receive intervals 30 ms and 50 ms for PCR intervals 30 and 50 ms
+        self.assertAlmostEqual(result['pcr_max_jitter'], 0.0)
+        self.assertAlmostEqual(result['pcr_mean_jitter'], 0.0)
+
+    def test5_ts_analyzer(self):
+        """Test that NumPy is needed for the vectorized analysis."""
+        if numpy is None:
+            with self.assertRaisesRegex(ValueError, 'needs NumPy'):
+                TsAnalyzer(vectorized=True)
+        self.assertEqual(TsAnalyzer().vectorized, numpy is not None)
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class VectorizedTestCase(MpegtsTestCase):
+    """The same tests with the vectorized analysis."""
+    vectorized = True
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,170 @@
+"""Fixtures and tests for reading capture files.
+
+The capture files are build in temporary files from the SSDP test pattern.
+"""
+
+from unittest import TestCase
+import os
+import socket
+import struct
+import tempfile
+
+from muca.Pcap import udp_datagrams, udp_datagram, LINKTYPE_ETHERNET, \
+                      LINKTYPE_LINUX_SLL, LINKTYPE_RAW
+from tests.CommonTest import LDATAGRAM1, LDATAGRAM2, SDATAGRAM1, \
+                             LADDR1, LADDR2, SADDR1
+
+
+def udp_ipv4(src, dst, payload, fragment=0):
+    """This returns an IPv4 packet with an UDP datagram."""
+    _udp = struct.pack('!HHHH', src[1], dst[1], 8 + len(payload), 0)
+    return struct.pack(
+        '!BBHHHBBH4s4s', 0x45, 0, 20 + len(_udp) + len(payload), 0,
+        fragment, 1, 17, 0, socket.inet_aton(src[0]),
+        socket.inet_aton(dst[0])) + _udp + payload
+
+
+def udp_ipv6(src, dst, payload):
+    """This returns an IPv6 packet with an UDP datagram."""
+    _udp = struct.pack('!HHHH', src[1], dst[1], 8 + len(payload), 0)
+    return struct.pack(
+        '!IHBB16s16s', 0x60000000, len(_udp) + len(payload), 17, 1,
+        socket.inet_pton(socket.AF_INET6, src[0]),
+        socket.inet_pton(socket.AF_INET6, dst[0])) + _udp + payload
+
+
+def ethernet(packet, ethertype=0x0800, vlan=None):
+    """This returns an ethernet frame, optional with a VLAN tag."""
+    _header = b'\x01\x00\x5e\x7f\xff\xfa' + b'\x02\x00\x00\x00\x00\x01'
+    if vlan is not None:
+        _header += struct.pack('!HH', 0x8100, vlan)
+    return _header + struct.pack('!H', ethertype) + packet
+
+
+def pcap(records, linktype=LINKTYPE_ETHERNET, order='<', nsec=False):
+    """This returns a pcap file with records of (timestamp, frame)."""
+    _data = [struct.pack(order + 'IHHiIII',
+                         0xa1b23c4d if nsec else 0xa1b2c3d4,
+                         2, 4, 0, 0, 65535, linktype)]
+    for _timestamp, _frame in records:
+        _frac = round(_timestamp % 1 * (1e9 if nsec else 1e6))
+        _data.append(struct.pack(order + 'IIII', int(_timestamp), _frac,
+                                 len(_frame), len(_frame)) + _frame)
+    return b''.join(_data)
+
+
+def pcapng_block(block_type, body, order='<'):
+    """This returns a pcapng block with padded body."""
+    body += b'\x00' * (-len(body) % 4)
+    _length = struct.pack(order + 'I', len(body) + 12)
+    return struct.pack(order + 'I', block_type) + _length + body + _length
+
+
+def pcapng(records, linktype=LINKTYPE_ETHERNET, order='<', tsresol=None):
+    """This returns a pcapng file with records of (timestamp, frame)."""
+    _data = [pcapng_block(0x0a0d0d0a, struct.pack(
+        order + 'IHHq', 0x1a2b3c4d, 1, 0, -1), order)]
+    _options = b''
+    _units = 1e6
+    if tsresol is not None:
+        _options = struct.pack(order + 'HHB3x', 9, 1, tsresol) + b'\x00' * 4
+        _units = 2 ** (tsresol & 0x7f) if tsresol & 0x80 \
+            else 10 ** tsresol
+    _data.append(pcapng_block(
+        1, struct.pack(order + 'HHI', linktype, 0, 65535) + _options, order))
+    # unknown blocks are skipped
+    _data.append(pcapng_block(0x00000bad, b'unknown', order))
+    for _timestamp, _frame in records:
+        _ts = round(_timestamp * _units)
+        _data.append(pcapng_block(6, struct.pack(
+            order + 'IIIII', 0, _ts >> 32, _ts & 0xffffffff, len(_frame),
+            len(_frame)) + _frame, order))
+    return b''.join(_data)
+
+
+def capture_file(testcase, data):
+    """This writes a temporary capture file and returns its name."""
+    _fd, _filename = tempfile.mkstemp(suffix='.pcap')
+    with os.fdopen(_fd, 'wb') as _file:
+        _file.write(data)
+    testcase.addCleanup(os.remove, _filename)
+    return _filename
+
+
+MCAST = ('239.255.255.250', 1900)
+RECORDS = [
+    (1537722518.25, ethernet(udp_ipv4(LADDR1, MCAST, LDATAGRAM1))),
+    (1537722518.5, ethernet(udp_ipv4(('192.168.10.3', 5353),
+                                     ('224.0.0.251', 5353), b'mdns'))),
+    (1537722519.0, ethernet(b'\x00' * 28, ethertype=0x0806)),
+    (1537722519.75, ethernet(udp_ipv4(LADDR2, MCAST, LDATAGRAM2), vlan=10)),
+    (1537722520.5, ethernet(udp_ipv4(('192.168.10.119', 1900), SADDR1,
+                                     SDATAGRAM1))),
+]
+
+
+class PcapTestCase(TestCase):
+    """Tests for reading capture files."""
+
+    def check_records(self, filename):
+        """Check the UDP datagrams from a capture of RECORDS."""
+        result = list(udp_datagrams(filename, ports=(1900,)))
+        self.assertEqual(len(result), 3)
+        self.assertAlmostEqual(result[0][0], 1537722518.25, 5)
+        self.assertEqual(result[0][1:], (LADDR1, MCAST, LDATAGRAM1))
+        self.assertAlmostEqual(result[1][0], 1537722519.75, 5)
+        self.assertEqual(result[1][1:], (LADDR2, MCAST, LDATAGRAM2))
+        self.assertAlmostEqual(result[2][0], 1537722520.5, 5)
+        self.assertEqual(result[2][1:], (('192.168.10.119', 1900), SADDR1,
+                                         SDATAGRAM1))
+        self.assertEqual(len(list(udp_datagrams(filename))), 4)
+
+    def test1_pcap(self):
+        """Test pcap files with both byte orders and resolutions."""
+        self.check_records(capture_file(self, pcap(RECORDS)))
+        self.check_records(capture_file(self, pcap(RECORDS, order='>')))
+        self.check_records(capture_file(self, pcap(RECORDS, nsec=True)))
+
+    def test2_pcap(self):
+        """Test a truncated pcap file."""
+        _data = pcap(RECORDS)
+        result = list(udp_datagrams(capture_file(self, _data[:-10])))
+        self.assertEqual(len(result), 3)
+
+    def test1_pcapng(self):
+        """Test pcapng files with both byte orders and resolutions."""
+        self.check_records(capture_file(self, pcapng(RECORDS)))
+        self.check_records(capture_file(self, pcapng(RECORDS, order='>')))
+        self.check_records(capture_file(self, pcapng(RECORDS, tsresol=9)))
+        self.check_records(capture_file(self, pcapng(RECORDS, tsresol=0x94)))
+
+    def test_no_capture(self):
+        """Test files that are no capture files."""
+        with self.assertRaises(ValueError):
+            list(udp_datagrams(capture_file(self, b'')))
+        with self.assertRaises(ValueError):
+            list(udp_datagrams(capture_file(self, LDATAGRAM1)))
+        with self.assertRaises(OSError):
+            list(udp_datagrams('/nonexistent/capture.pcap'))
+
+    def test_udp_datagram(self):
+        """Test decoding of link types and network protocols."""
+        _packet = udp_ipv4(LADDR1, MCAST, LDATAGRAM1)
+        _sll = b'\x00\x00\x00\x01\x00\x06' + b'\x00' * 8 + b'\x08\x00'
+        self.assertEqual(udp_datagram(LINKTYPE_LINUX_SLL, _sll + _packet),
+                         (LADDR1, MCAST, LDATAGRAM1))
+        self.assertEqual(udp_datagram(LINKTYPE_RAW, _packet),
+                         (LADDR1, MCAST, LDATAGRAM1))
+        self.assertEqual(udp_datagram(LINKTYPE_RAW, udp_ipv6(
+            ('fe80::1', 1900), ('ff02::c', 1900), LDATAGRAM1)),
+                         (('fe80::1', 1900), ('ff02::c', 1900), LDATAGRAM1))
+        self.assertIsNone(udp_datagram(LINKTYPE_RAW, udp_ipv4(
+            LADDR1, MCAST, LDATAGRAM1, fragment=0x2000)))
+        self.assertIsNone(udp_datagram(LINKTYPE_ETHERNET, b'\x00' * 10))
+        # IPv4 header length below 20 bytes and beyond the frame.
+        self.assertIsNone(udp_datagram(LINKTYPE_RAW, b'\x44' + _packet[1:]))
+        self.assertIsNone(udp_datagram(LINKTYPE_RAW,
+                                       b'\x4f' + _packet[1:40]))
+        self.assertIsNone(udp_datagram(228, _packet))
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -0,0 +1,97 @@
+"""Tests for the output templates."""
+from unittest import TestCase, mock
+from io import StringIO
+import socket
+
+from muca.upnp.Common import SSDPdatagram
+from muca.upnp.Template import Template
+from muca.upnp.Listen import Listen, ListenPipeline, print_it
+from muca.upnp.Search import MsearchDevice
+from tests.CommonTest import SDATAGRAM1, LDATAGRAM1, LDATAGRAM2, \
+                             SADDR1, LADDR1, LADDR2, recvmsg
+
+
+class TemplateTestCase(TestCase):
+    """Tests for compiling and formating templates."""
+
+    def test1_template(self):
+        """Test the fields of a datagram."""
+        o_datagram = SSDPdatagram(SADDR1, SDATAGRAM1)
+        o_datagram.request = 2
+        o_template = Template('{ip} {port} {addr} {request} {method} '
+                              '{uuid} {st} {nt}|')
+        self.assertEqual(o_template(o_datagram), (
+            '192.168.10.119 47383 192.168.10.119:47383 2  '
+            '3b2867a3-b55f-8e77-5ad8-a6d0c6990277 upnp:rootdevice |\r\n'))
+        o_datagram = SSDPdatagram(LADDR1, LDATAGRAM1)
+        self.assertEqual(Template('{method} {nts!r}', end='')(o_datagram),
+                         "NOTIFY 'ssdp:alive'")
+        self.assertEqual(Template('{data}', end='')(o_datagram),
+                         LDATAGRAM1.decode())
+        self.assertEqual(Template('{{{x_user_agent:>5}}}')(SSDPdatagram()),
+                         '{     }\r\n')
+
+    def test2_template(self):
+        """Test the timestamp and the relative time."""
+        o_datagram = SSDPdatagram(LADDR1, LDATAGRAM1)
+        o_datagram.timestamp = 1000.5
+        o_template = Template('{ts:.1f} {rel:9.4f}s')
+        self.assertEqual(o_template(o_datagram), '1000.5    0.0000s\r\n')
+        self.assertEqual(o_template(o_datagram, 999.25),
+                         '1000.5    1.2500s\r\n')
+        self.assertEqual(o_template(o_datagram, 1001),
+                         '1000.5    0.0000s\r\n')
+
+    def test3_template(self):
+        """Test invalid templates."""
+        for template, message in (
+                ('{ip', 'invalid template'),
+                ('{}', 'field name expected'),
+                ('{0}', 'field name expected'),
+                ('{ip.x}', 'field name expected'),
+                ('{NT}', 'field name expected'),
+                ('{ts:{nt}}', 'nested field'),
+                ('{ip:.2f}', 'invalid template'),
+                ('{ip!x}', 'invalid template')):
+            with self.assertRaisesRegex(ValueError, message):
+                Template(template)
+
+    @mock.patch('muca.upnp.Listen.socket.socket')
+    def test_listen(self, mock_socket):
+        """Test the text output of listening with a template."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), KeyboardInterrupt())
+        o_listen = Listen()
+        o_listen.TEMPLATE = Template('{addr} {method} {nt}')
+        with mock.patch('sys.stdout', new=StringIO()) as mock_stdout:
+            print_it(o_listen)
+        self.assertEqual(mock_stdout.getvalue(), (
+            '192.168.10.86:57535 NOTIFY '
+            'urn:schemas-upnp-org:device:MediaRenderer:1\r\n'
+            '192.168.10.3:57509 M-SEARCH \r\n'))
+
+    @mock.patch('muca.upnp.Listen.socket.socket')
+    def test_listen_pipeline(self, mock_socket):
+        """The workers format with the template."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), KeyboardInterrupt())
+        o_listen = ListenPipeline(workers=1)
+        o_listen.TEMPLATE = Template('{ip}')
+        o_listen.open()
+        self.assertEqual(o_listen.get(),
+                         '192.168.10.86\r\n192.168.10.3\r\n')
+        self.assertIsNone(o_listen.get())
+
+    @mock.patch('muca.upnp.Search.socket.socket')
+    def test_search(self, mock_socket):
+        """The end of a response window has empty fields."""
+        mock_socket.return_value.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1), socket.timeout())
+        o_search = MsearchDevice()
+        o_search.TEMPLATE = Template('{request} {ip} {uuid}')
+        o_search.request(retries=1)
+        self.assertEqual(o_search.get(),
+                         '1 192.168.10.119 '
+                         '3b2867a3-b55f-8e77-5ad8-a6d0c6990277\r\n')
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
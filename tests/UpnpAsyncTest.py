@@ -0,0 +1,191 @@
+"""Tests for searching and listening with asyncio.
+
+The network socket is mocked like in the other network tests. The transport
+of the event loop is also mocked so we can feed datagrams direct to the
+protocol.
+"""
+from unittest import IsolatedAsyncioTestCase, mock
+from time import time
+import asyncio
+import socket
+
+from muca.upnp.Common import SSDPdatagram, StormFilter, ChangeTable
+from muca.upnp.Filter import Filter
+from muca.upnp.Async import AsyncListen, AsyncMsearch
+from tests.CommonTest import SDATAGRAM1, SDATAGRAM2, SADDR1, SADDR2, \
+                             LDATAGRAM1, LDATAGRAM2, LDATAGRAM3, LADDR1, \
+                             LADDR2, LADDR3
+
+
+class AsyncTestCase(IsolatedAsyncioTestCase):
+    """These are tests with a mocked socket and transport."""
+
+    def setUp(self):
+        """This patches the network sockets from Search and Listen."""
+        for module in ('Search', 'Listen'):
+            patcher = mock.patch('muca.upnp.{}.socket.socket'.format(module))
+            self.addCleanup(patcher.stop)
+            patcher.start().side_effect = lambda *args: mock.Mock()
+        self.protocol = None
+        self.transport = mock.Mock(spec_set=['sendto', 'close'])
+        self.transport.close.side_effect = \
+            lambda: self.protocol.connection_lost(None)
+        # The protocols and transports of further sockets.
+        self.protocols = []
+        self.transports = []
+
+    async def asyncSetUp(self):
+        """This patches the creation of the datagram endpoints."""
+        async def create_datagram_endpoint(factory, sock):
+            self.assertIsNotNone(sock)
+            if self.protocol is None:
+                self.protocol = factory()
+                return self.transport, self.protocol
+            _protocol = factory()
+            self.protocols.append(_protocol)
+            _transport = mock.Mock(spec_set=['sendto', 'close'])
+            self.transports.append(_transport)
+            _transport.close.side_effect = \
+                lambda: _protocol.connection_lost(None)
+            return _transport, _protocol
+        patcher = mock.patch.object(
+            asyncio.get_running_loop(), 'create_datagram_endpoint',
+            side_effect=create_datagram_endpoint)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    async def test1_async_listen(self):
+        """Test to listen for datagrams until the transport is closed."""
+        async with AsyncListen() as o_listen:
+            self.protocol.datagram_received(LDATAGRAM1, LADDR1)
+            self.protocol.datagram_received(LDATAGRAM2, LADDR2)
+            asyncio.get_running_loop().call_soon(o_listen.close)
+            result = [o_datagram async for o_datagram in o_listen]
+        self.assertEqual(len(result), 2)
+        self.assertIsInstance(result[0], SSDPdatagram)
+        self.assertEqual(result[0].uuid,
+                         'f4f7681c-3056-11e8-86bd-87a6e4e2c42d')
+        self.assertEqual(result[1].method, 'M-SEARCH')
+        self.assertEqual(result[1].ipaddr, '192.168.10.3')
+        self.transport.close.assert_called_once_with()
+
+    @mock.patch('muca.upnp.Listen.interfaces6', return_value=[('eth0', 2)])
+    async def test2_async_listen(self, _):
+        """Test the IPv6 socket, the StormFilter and the filter."""
+        o_storm = StormFilter(rate=0.1, burst=1)
+        async with AsyncListen(scopes=('ipv4', 'link'), storm=o_storm,
+                               match=Filter('method == NOTIFY')) as o_listen:
+            self.assertEqual(len(self.protocols), 1)
+            self.assertIsNone(o_listen._selector)  # pylint: disable=W0212
+            self.protocol.datagram_received(LDATAGRAM1, LADDR1)
+            self.protocol.datagram_received(LDATAGRAM1, LADDR1)
+            self.protocol.datagram_received(LDATAGRAM2, LADDR2)
+            self.protocols[0].datagram_received(
+                LDATAGRAM3, ('fe80::2', 42047, 0, 2))
+            asyncio.get_running_loop().call_soon(o_listen.close)
+            result = [o_datagram async for o_datagram in o_listen]
+        self.assertEqual([o.ipaddr for o in result],
+                         ['192.168.10.86', 'fe80::2'])
+        self.assertEqual(o_storm.stats()['sources'], {'192.168.10.86': 1})
+
+    async def test3_async_listen(self):
+        """Test to listen only for changes of the devices."""
+        o_listen = AsyncListen(changes=ChangeTable())
+        await o_listen.open()
+        self.protocol.datagram_received(LDATAGRAM1, LADDR1)
+        self.protocol.datagram_received(LDATAGRAM1, LADDR1)
+        self.protocol.datagram_received(LDATAGRAM3, LADDR3)
+        self.protocol.datagram_received(
+            LDATAGRAM3.replace(b'ssdp:alive', b'ssdp:byebye'), LADDR3)
+        # The timer wakes up at the expiry of the first device.
+        # pylint: disable=protected-access
+        self.assertAlmostEqual(o_listen._timer.when()
+                               - asyncio.get_running_loop().time(), 100,
+                               delta=1)
+        with mock.patch('muca.upnp.Async.time', return_value=time() + 101):
+            o_listen._expired()
+        self.assertIsNone(o_listen._timer)
+        o_listen.close()
+        result = [o_datagram async for o_datagram in o_listen]
+        self.assertEqual([(o.change, o.ipaddr) for o in result], [
+            ('new', '192.168.10.86'), ('new', '192.168.10.75'),
+            ('byebye', '192.168.10.75'), ('expired', '192.168.10.86')])
+
+    async def test1_async_msearch(self):
+        """Test search with retries as timers and unique responses."""
+        o_msearch = AsyncMsearch()
+        o_msearch.NETDELAY = 0.05
+        await o_msearch.request(retries=2, ssdp_response_time=0)
+        self.assertEqual(self.transport.sendto.call_count, 1)
+        self.assertIn(b'MX: 0\r\n', self.transport.sendto.call_args[0][0])
+        self.assertEqual(self.transport.sendto.call_args[0][1],
+                         ('239.255.255.250', 1900))
+        self.protocol.datagram_received(SDATAGRAM1, SADDR1)
+        self.protocol.datagram_received(SDATAGRAM1, SADDR1)
+        result = []
+        async for o_datagram in o_msearch:
+            result.append(o_datagram)
+            if o_datagram.request == 2 and o_datagram.data is None:
+                self.protocol.datagram_received(SDATAGRAM1, SADDR1)
+                self.protocol.datagram_received(SDATAGRAM2, SADDR2)
+        self.assertEqual(self.transport.sendto.call_count, 2)
+        self.assertEqual([(o.request, o.ipaddr) for o in result], [
+            (1, '192.168.10.119'), (2, ''), (2, '192.168.49.1'), (0, '')])
+        o_msearch.close()
+
+    async def test2_async_msearch(self):
+        """Test search without retries."""
+        o_msearch = AsyncMsearch()
+        await o_msearch.request(retries=0)
+        result = [o_datagram async for o_datagram in o_msearch]
+        self.assertEqual(result, [])
+        self.transport.sendto.assert_not_called()
+
+    async def test3_async_msearch(self):
+        """Test to close a search within the response window."""
+        o_msearch = AsyncMsearch()
+        await o_msearch.request(retries=3)
+        self.protocol.datagram_received(SDATAGRAM2, SADDR2)
+        asyncio.get_running_loop().call_soon(o_msearch.close)
+        result = [o_datagram async for o_datagram in o_msearch]
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].request, 1)
+        self.assertEqual(self.transport.sendto.call_count, 1)
+
+    @mock.patch('muca.upnp.Async.interfaces6',
+                return_value=[('eth0', 2), ('eth1', 3)])
+    async def test4_async_msearch(self, _):
+        """Test search on IPv4 and IPv6 link-local and use after close."""
+        o_msearch = AsyncMsearch(scopes=('ipv4', 'link'))
+        # pylint: disable=protected-access
+        self.assertIsNone(o_msearch._selector)
+        await o_msearch.request(retries=1, ssdp_response_time=1)
+        self.assertEqual(len(self.transports), 1)
+        self.assertEqual(self.transport.sendto.call_args[0][1],
+                         ('239.255.255.250', 1900))
+        self.assertEqual(
+            [call[0][1] for call in self.transports[0].sendto.call_args_list],
+            [('ff02::c', 1900, 0, 2), ('ff02::c', 1900, 0, 3)])
+        self.assertIn(b'HOST: [FF02::C]:1900\r\n',
+                      self.transports[0].sendto.call_args[0][0])
+        self.protocols[0].datagram_received(
+            SDATAGRAM1, ('fe80::2', 1900, 0, 2))
+        asyncio.get_running_loop().call_soon(o_msearch.close)
+        result = [o_datagram async for o_datagram in o_msearch]
+        self.assertEqual([o.ipaddr for o in result], ['fe80::2'])
+        self.transports[0].close.assert_called_once_with()
+        with self.assertRaises(ValueError):
+            await o_msearch.request()
+        self.assertEqual(self.transport.sendto.call_count, 1)
+
+    async def test5_async_msearch(self):
+        """Test to close a search that has never been opened."""
+        o_msearch = AsyncMsearch()
+        o_msearch.close()
+        # pylint: disable=protected-access
+        o_msearch._sock.close.assert_called_once_with()
+        with self.assertRaises(ValueError):
+            await o_msearch.open()
+        self.assertIsNone(self.protocol)
+
+# vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
@@ -6,12 +6,21 @@ consuming we mock the builtin network socket object for all tests in the test
 case within self.setUp().
 """
 from unittest import TestCase, mock
-from io import StringIO
+from io import StringIO, BytesIO, TextIOWrapper
+import json
 import socket
+import struct
+from time import time_ns
 
-from muca.upnp.Listen import Listen, print_it, socket as upnplisten_socket
+from muca.Metrics import Metrics
+from muca.upnp.Common import DeviceTable, StormFilter, ChangeTable, \
+                             read_records, print_losses, ANCBUFSIZE
+from muca.upnp.Listen import Listen, ListenBatch, ListenPcap, \
+                            ListenPipeline, print_it, \
+                            socket as upnplisten_socket
 from tests.CommonTest import LDATAGRAM1, LDATAGRAM2, LDATAGRAM3, \
-                             LADDR1, LADDR2, LADDR3
+                             LADDR1, LADDR2, LADDR3, recvmsg, recvmsg_into
+from tests.PcapTest import RECORDS, pcap, capture_file
 
 
 # from upnp.upnplisten import argparse as upnplisten_argparse
@@ -44,7 +53,7 @@ class NetSocketTestCase(TestCase):
         self.mock_socket = patcher.start()
         self.o_mock_socket = self.mock_socket.return_value
         self.o_mock_socket.mock_add_spec(
-            ['setsockopt', 'bind', 'recvfrom'], spec_set=True)
+            ['setsockopt', 'getsockopt', 'bind', 'recvmsg'], spec_set=True)
 
     def test_mock_socket(self):
         """Test if general patch from self.setUp() for all tests is working."""
@@ -59,89 +68,120 @@ class NetSocketTestCase(TestCase):
         self.mock_socket.assert_called_with(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.o_mock_socket.bind.assert_called_with(('239.255.255.250', 1900))
-        self.assertEqual(self.o_mock_socket.setsockopt.call_count, 2)
+        self.assertEqual(self.o_mock_socket.setsockopt.call_count, 4)
         self.o_mock_socket.setsockopt.assert_called_with(0, 35, (
             b'\xef\xff\xff\xfa\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
             b'\x00'))
 
+    def test_listen_rcvbuf(self):
+        """Test the size of the receive buffer and the loss report."""
+        self.o_mock_socket.getsockopt.return_value = 8192
+        o_listen = Listen(rcvbuf=65536)
+        with mock.patch('sys.platform', 'freebsd12'), \
+                self.assertLogs('muca', level='WARNING') as logs:
+            o_listen.open()
+        self.o_mock_socket.setsockopt.assert_any_call(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        self.assertEqual(logs.output, [
+            'WARNING:muca.upnp.Common:receive buffer limited to 8192 bytes'])
+
+        # Linux reports the doubled size.
+        self.o_mock_socket.getsockopt.return_value = 100000
+        with mock.patch('sys.platform', 'linux'), \
+                self.assertLogs('muca', level='WARNING') as logs:
+            Listen(rcvbuf=65536).open()
+        self.assertEqual(logs.output, [
+            'WARNING:muca.upnp.Common:receive buffer limited to 50000 bytes'])
+        self.o_mock_socket.getsockopt.return_value = 131072
+        with mock.patch('sys.platform', 'linux'), \
+                mock.patch('muca.upnp.Common._warning') as mock_warning:
+            Listen(rcvbuf=65536).open()
+        mock_warning.assert_not_called()
+
+        o_listen.dropped = 3
+        with mock.patch('sys.stderr', new=StringIO()) as mock_stderr:
+            print_losses(o_listen)
+        self.assertEqual(mock_stderr.getvalue(), 'WARNING: datagrams dropped '
+                         'by the kernel: 3 truncated: 0\n')
+
     def test1_listen_get(self):
         """Test to listen for upnp datagrams on the local network."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (LDATAGRAM1, LADDR1),
             (LDATAGRAM2, LADDR2),
             (LDATAGRAM3, LADDR3),
             KeyboardInterrupt()
-        ]
+        )
         o_listen = Listen()
         o_listen.open()
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, (
             r'^0000\.0\d\d\ds 0 NOTIFY 192\.168\.10\.86:57535 '
             r'uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d Linux/4\.14\.71-v7\+, '
             r'UPnP/1\.0, Portable SDK for UPnP devices/1\.6\.19\+git20160116'
             r'\r\n$'))
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, (r'^0000.0\d\d\ds 0 M-SEARCH '
                                   r'192\.168\.10\.3:57509\r\n$'))
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result, (
             r'^0000\.0\d\d\ds 0 NOTIFY 192\.168\.10\.75:42047 '
             r'uuid:231179de-90e9-11e8-b505-4355ee6fa7cf Linux/4\.14\.70-v7\+, '
             r'UPnP/1\.0, Portable SDK for UPnP devices/1\.6\.19\+git20160116'
             r'\r\n$'))
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(result)
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(result)
 
     def test2_listen_get(self):
         """Test to verbose listen for upnp datagrams on the local network."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (LDATAGRAM1, LADDR1),
             (LDATAGRAM2, LADDR2),
             (LDATAGRAM3, LADDR3),
             KeyboardInterrupt()
-        ]
+        )
         o_listen = Listen(verbose=True)
         o_listen.open()
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result[:9], r'^0000\.0\d\d\d$')
         self.assertEqual(result[9:], 's 0 192.168.10.86:57535\r\n'
                          + LDATAGRAM1.decode())
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result[:9], r'^0000\.0\d\d\d$')
         self.assertEqual(result[9:], 's 0 192.168.10.3:57509\r\n'
                          + LDATAGRAM2.decode())
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result[:9], r'^0000\.0\d\d\d$')
         self.assertEqual(result[9:], 's 0 192.168.10.75:42047\r\n'
                          + LDATAGRAM3.decode())
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(result)
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(result)
 
     def test3_listen_get(self):
         """Test to open the same instance two times."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (LDATAGRAM1, LADDR1),
             (LDATAGRAM1, LADDR1),
             KeyboardInterrupt()
-        ]
+        )
         o_listen = Listen()
         o_listen.open()
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, (
             r'^0000\.0\d\d\ds 0 NOTIFY 192\.168\.10\.86:57535 '
             r'uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d Linux/4\.14\.71-v7\+, '
@@ -149,26 +189,124 @@ class NetSocketTestCase(TestCase):
             r'\r\n$'))
         o_listen.open()
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, (
             r'^0000\.0\d\d\ds 0 NOTIFY 192\.168\.10\.86:57535 '
             r'uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d Linux/4\.14\.71-v7\+, '
             r'UPnP/1\.0, Portable SDK for UPnP devices/1\.6\.19\+git20160116'
             r'\r\n$'))
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertIsNone(result)
         result = o_listen.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertIsNone(result)
 
+    def test4_listen_get(self):
+        """Test to listen with a table of devices and a byebye notify."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM2, LADDR2),
+            (LDATAGRAM3, LADDR3),
+            (LDATAGRAM1.replace(b'ssdp:alive', b'ssdp:byebye'), LADDR1),
+            KeyboardInterrupt()
+        )
+        o_devices = DeviceTable()
+        o_listen = Listen(devices=o_devices)
+        o_listen.open()
+        o_listen.get()
+        o_listen.get()
+        o_listen.get()
+        self.assertEqual(len(o_devices), 2)
+        o_listen.get()
+        self.assertEqual(len(o_devices), 1)
+        self.assertEqual([o.ipaddr for o in o_devices], ['192.168.10.75'])
+
+    def test5_listen_get(self):
+        """Test to listen with rate limiting for every source."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            *[(LDATAGRAM1, LADDR1)] * 5, (LDATAGRAM3, LADDR3),
+            KeyboardInterrupt())
+        o_storm = StormFilter(rate=0.1, burst=2)
+        o_listen = Listen(storm=o_storm)
+        o_listen.open()
+        self.assertRegex(o_listen.get(), r'192\.168\.10\.86')
+        self.assertRegex(o_listen.get(), r'192\.168\.10\.86')
+        self.assertRegex(o_listen.get(), r'192\.168\.10\.75')
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 6)
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(o_storm.stats()['sources'], {'192.168.10.86': 3})
+
+    def test6_listen_get(self):
+        """Test the kernel receive timestamp of a datagram."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, [(socket.SOL_SOCKET, 35,
+                           struct.pack('@ll', 1700000000, 250000000))], 0,
+             LADDR1),
+            (LDATAGRAM2, LADDR2),
+            KeyboardInterrupt())
+        result = list(Listen())
+        self.assertAlmostEqual(result[0].timestamp, 1700000000.25, 6)
+        self.assertLess(result[0].rxtime, result[1].rxtime)
+        self.assertGreater(result[1].timestamp, 1700000000.25)
+
+    def test7_listen_get(self):
+        """Test to listen only for changes of the devices."""
+        self.o_mock_socket.mock_add_spec(
+            ['setsockopt', 'getsockopt', 'bind', 'recvmsg', 'settimeout'],
+            spec_set=True)
+        _old = struct.pack('@ll', *divmod(time_ns() - 200000000000,
+                                          1000000000))
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, [(socket.SOL_SOCKET, 35, _old)], 0, LADDR1),
+            (LDATAGRAM2, LADDR2),
+            (LDATAGRAM3, LADDR3),
+            (LDATAGRAM3, LADDR3),
+            socket.timeout(),
+            (LDATAGRAM3.replace(b'ssdp:alive', b'ssdp:byebye'), LADDR3),
+            KeyboardInterrupt())
+        o_listen = Listen(changes=ChangeTable())
+        o_listen.open()
+        self.assertRegex(o_listen.get(), r'^0000\.0000s 0 new NOTIFY '
+                         r'192\.168\.10\.86:57535 ')
+        # The max-age of the first device has passed, it expires without
+        # receiving.
+        self.assertRegex(o_listen.get(), r' 0 expired NOTIFY '
+                         r'192\.168\.10\.86:57535 ')
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
+        self.assertRegex(o_listen.get(), r' 0 new NOTIFY '
+                         r'192\.168\.10\.75:42047 ')
+        self.assertRegex(o_listen.get(), r' 0 byebye NOTIFY '
+                         r'192\.168\.10\.75:42047 ')
+        # The receiving wakes up at the expiry of the second device.
+        self.assertAlmostEqual(
+            self.o_mock_socket.settimeout.call_args[0][0], 100, delta=1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 6)
+        self.assertIsNone(o_listen.get())
+
+    def test_listen_iter(self):
+        """Test iterating over the datagram objects."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), (LDATAGRAM3, LADDR3),
+            KeyboardInterrupt())
+        o_devices = DeviceTable()
+        result = list(Listen(devices=o_devices))
+        self.mock_socket.assert_called_once_with(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.assertEqual([(o.method, o.ipaddr) for o in result], [
+            ('NOTIFY', '192.168.10.86'), ('M-SEARCH', '192.168.10.3'),
+            ('NOTIFY', '192.168.10.75')])
+        self.assertEqual(result[2].uuid,
+                         '231179de-90e9-11e8-b505-4355ee6fa7cf')
+        self.assertEqual(len(o_devices), 2)
+
     def test_print_it(self):
         """Test if the output works."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (LDATAGRAM1, LADDR1),
             (LDATAGRAM2, LADDR2),
             KeyboardInterrupt()
-        ]
+        )
         with mock.patch('sys.stdout', new=StringIO()) as fake_output:
             print_it(Listen())
             self.assertRegex(fake_output.getvalue(), (
@@ -178,4 +316,423 @@ class NetSocketTestCase(TestCase):
                 r'devices/1\.6\.19\+git20160116\r\n0000\.0\d\d\ds 0 M-SEARCH '
                 r'192\.168\.10\.3:57509\r\n$'))
 
+    def test1_print_it_format(self):
+        """Test the output as JSON lines."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM2, LADDR2),
+            KeyboardInterrupt()
+        )
+        with mock.patch('sys.stdout', new=StringIO()) as fake_output:
+            print_it(Listen(output='ndjson'))
+            result = [json.loads(line) for line in
+                      fake_output.getvalue().splitlines()]
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0]['uuid'],
+                         'f4f7681c-3056-11e8-86bd-87a6e4e2c42d')
+        self.assertEqual(result[0]['nts'], 'ssdp:alive')
+        self.assertEqual(result[1]['method'], 'M-SEARCH')
+        self.assertNotIn('raw', result[1])
+
+    def test2_print_it_format(self):
+        """Test the output as binary records with the datagrams."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM3, LADDR3),
+            KeyboardInterrupt()
+        )
+        fake_output = TextIOWrapper(BytesIO())
+        with mock.patch('sys.stdout', new=fake_output):
+            o_listen = Listen(verbose=True, output='binary')
+            o_listen.FIELDS = ('nt',)
+            print_it(o_listen)
+        fake_output.buffer.seek(0)
+        result = list(read_records(fake_output.buffer))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[1]['fields'], {
+            'nt': 'urn:schemas-upnp-org:service:ConnectionManager:1'})
+        self.assertEqual(result[1]['raw'], LDATAGRAM3)
+
+
+class BatchSocketTestCase(TestCase):
+    """These are tests for batched receiving with a mocked network socket."""
+
+    def setUp(self):
+        """This patches the network socket from upnplisten for all tests."""
+        patcher = mock.patch('muca.upnp.Listen.socket.socket')
+        self.addCleanup(patcher.stop)
+        self.mock_socket = patcher.start()
+        self.o_mock_socket = self.mock_socket.return_value
+        self.o_mock_socket.mock_add_spec(
+            ['setsockopt', 'bind', 'recvmsg_into'], spec_set=True)
+
+    def test1_listen_batch(self):
+        """Test draining all queued datagrams into one batch."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM2, LADDR2),
+            BlockingIOError(),
+            (LDATAGRAM3, LADDR3),
+            BlockingIOError(),
+            KeyboardInterrupt()
+        )
+        o_listen = ListenBatch()
+        o_listen.open()
+        result = o_listen.get()
+        self.assertEqual(self.o_mock_socket.recvmsg_into.call_count, 3)
+        self.assertEqual(
+            self.o_mock_socket.recvmsg_into.call_args_list[0][0][1:],
+            (ANCBUFSIZE,))
+        self.assertEqual(
+            self.o_mock_socket.recvmsg_into.call_args_list[1][0][1:],
+            (ANCBUFSIZE, socket.MSG_DONTWAIT))
+        self.assertRegex(result, (
+            r'^0000\.0\d\d\ds 0 NOTIFY 192\.168\.10\.86:57535 '
+            r'uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d Linux/4\.14\.71-v7\+, '
+            r'UPnP/1\.0, Portable SDK for UPnP devices/1\.6\.19\+git20160116'
+            r'\r\n0000\.0\d\d\ds 0 M-SEARCH 192\.168\.10\.3:57509\r\n$'))
+        result = o_listen.get()
+        self.assertEqual(self.o_mock_socket.recvmsg_into.call_count, 5)
+        self.assertRegex(result, (
+            r'^0000\.0\d\d\ds 0 NOTIFY 192\.168\.10\.75:42047 '))
+        result = o_listen.get()
+        self.assertEqual(self.o_mock_socket.recvmsg_into.call_count, 6)
+        self.assertIsNone(result)
+        result = o_listen.get()
+        self.assertEqual(self.o_mock_socket.recvmsg_into.call_count, 6)
+        self.assertIsNone(result)
+        self.assertEqual(o_listen.stats(), {
+            'batches': 2, 'datagrams': 3, 'max': 2, 'mean': 1.5,
+            'histogram': {'1-1': 1, '2-3': 1}})
+
+    def test2_listen_batch(self):
+        """Test that a batch is limited by the size of the buffer ring."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            *([(LDATAGRAM1, LADDR1)] * 5 + [KeyboardInterrupt()]))
+        o_listen = ListenBatch(verbose=True)
+        o_listen.RINGSIZE = 4
+        o_listen.open()
+        result = o_listen.get()
+        self.assertEqual(self.o_mock_socket.recvmsg_into.call_count, 4)
+        self.assertEqual(result.count(LDATAGRAM1.decode()), 4)
+        result = o_listen.get()
+        self.assertEqual(self.o_mock_socket.recvmsg_into.call_count, 6)
+        self.assertEqual(result.count(LDATAGRAM1.decode()), 1)
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(o_listen.fstats(), (
+            'batches: 2 datagrams: 5 mean: 2.50 max: 4 [1-1]: 1 [4-7]: 1'))
+
+    def test4_listen_batch(self):
+        """Test batches of binary records."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM3, LADDR3),
+            BlockingIOError())
+        o_listen = ListenBatch(output='binary')
+        o_listen.open()
+        result = list(read_records(BytesIO(o_listen.get())))
+        self.assertEqual([record['ip'] for record in result],
+                         ['192.168.10.86', '192.168.10.75'])
+
+    def test6_listen_batch(self):
+        """Test iterating over the datagram objects of the batches."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM2, LADDR2),
+            BlockingIOError(),
+            (LDATAGRAM3, LADDR3),
+            BlockingIOError(),
+            KeyboardInterrupt()
+        )
+        o_listen = ListenBatch()
+        self.assertEqual([o.ipaddr for o in o_listen],
+                         ['192.168.10.86', '192.168.10.3', '192.168.10.75'])
+        self.assertEqual(o_listen.stats()['batches'], 2)
+
+    def test5_listen_batch(self):
+        """Test the storm filter on batches."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM1, LADDR1),
+            BlockingIOError(),
+            (LDATAGRAM1, LADDR1),
+            BlockingIOError(),
+            (LDATAGRAM3, LADDR3),
+            BlockingIOError(),
+            KeyboardInterrupt())
+        o_storm = StormFilter(window=60)
+        o_listen = ListenBatch(storm=o_storm)
+        o_listen.open()
+        self.assertEqual(o_listen.get().count('NOTIFY'), 1)
+        # a suppressed batch does not end listening
+        self.assertRegex(o_listen.get(), r'^0000\.0\d\d\ds 0 NOTIFY '
+                         r'192\.168\.10\.75:42047 ')
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(o_storm.fstats(), 'passed: 2 duplicates: 2 '
+                         'limited: 0 [192.168.10.86]: 2')
+
+    def test3_listen_batch(self):
+        """Test truncated datagrams and drops within a batch."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            (LDATAGRAM3, LADDR3),
+            (LDATAGRAM1, [(socket.SOL_SOCKET, 40, struct.pack('I', 7))], 0,
+             LADDR1),
+            BlockingIOError(),
+            KeyboardInterrupt())
+        o_listen = ListenBatch()
+        o_listen.RECVBUF = 500
+        o_listen.open()
+        with self.assertLogs('muca', level='WARNING') as logs:
+            result = o_listen.get()
+        self.assertRegex(result, r'^0000\.0\d\d\ds 0 NOTIFY '
+                         r'192\.168\.10\.86:57535 ')
+        self.assertEqual(logs.output, [
+            'WARNING:muca.upnp.Common:datagram from 192.168.10.75:42047 '
+            'larger than 500 bytes skipped'])
+        self.assertEqual(o_listen.truncated, 1)
+        self.assertEqual(o_listen.dropped, 7)
+
+    def test_print_it(self):
+        """Test if the output of batches works."""
+        self.o_mock_socket.recvmsg_into.side_effect = recvmsg_into(
+            (LDATAGRAM1, LADDR1),
+            (LDATAGRAM2, LADDR2),
+            KeyboardInterrupt()
+        )
+        with mock.patch('sys.stdout', new=StringIO()) as fake_output:
+            print_it(ListenBatch())
+            self.assertRegex(fake_output.getvalue(), (
+                r'^0000.0\d\d\ds 0 NOTIFY 192\.168\.10\.86:57535 '
+                r'uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d '
+                r'Linux/4\.14\.71-v7\+, UPnP/1\.0, Portable SDK for UPnP '
+                r'devices/1\.6\.19\+git20160116\r\n0000\.0\d\d\ds 0 M-SEARCH '
+                r'192\.168\.10\.3:57509\r\n$'))
+
+
+class PipelineTestCase(TestCase):
+    """These are tests of listening with worker processes."""
+
+    def setUp(self):
+        """This patches the network socket for all tests."""
+        patcher = mock.patch('muca.upnp.Listen.socket.socket')
+        self.addCleanup(patcher.stop)
+        self.o_mock_socket = patcher.start().return_value
+        self.o_mock_socket.mock_add_spec(
+            ['setsockopt', 'bind', 'settimeout', 'recvmsg', 'close'],
+            spec_set=True)
+
+    def test1_listen_pipeline(self):
+        """Test that batches are returned in arrival order."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), socket.timeout(),
+            (LDATAGRAM3, LADDR3), (LDATAGRAM2, LADDR2), (LDATAGRAM1, LADDR1),
+            KeyboardInterrupt())
+        o_devices = DeviceTable()
+        o_listen = ListenPipeline(devices=o_devices, workers=2)
+        o_listen.BATCHSIZE = 2
+        o_listen.open()
+        self.o_mock_socket.settimeout.assert_called_with(o_listen.LATENCY)
+        result = []
+        _batch = o_listen.get()
+        while _batch is not None:
+            result.append(_batch)
+            _batch = o_listen.get()
+        self.assertEqual(len(result), 3)
+        self.assertEqual([_line.split()[2:4] for _line in
+                          ''.join(result).splitlines()], [
+            ['NOTIFY', '192.168.10.86:57535'],
+            ['M-SEARCH', '192.168.10.3:57509'],
+            ['NOTIFY', '192.168.10.75:42047'],
+            ['M-SEARCH', '192.168.10.3:57509'],
+            ['NOTIFY', '192.168.10.86:57535']])
+        self.assertEqual(len(o_devices), 2)
+        self.o_mock_socket.close.assert_called_once_with()
+        self.assertIsNone(o_listen.get())
+
+    def test2_listen_pipeline(self):
+        """Test the match function in the workers and the binary output."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), (LDATAGRAM3, LADDR3),
+            KeyboardInterrupt())
+        o_listen = ListenPipeline(output='binary', workers=1, match=lambda
+                                  _o_datagram: _o_datagram.method == 'NOTIFY')
+        o_listen.open()
+        result = o_listen.get()
+        self.assertIsNone(o_listen.get())
+        self.assertEqual([_record['ip'] for _record in
+                          read_records(BytesIO(result))],
+                         [LADDR1[0], LADDR3[0]])
+
+    def test3_listen_pipeline(self):
+        """Test iterating over the parsed datagrams from the workers."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM2, LADDR2), socket.timeout(),
+            (LDATAGRAM3, LADDR3), KeyboardInterrupt())
+        o_devices = DeviceTable()
+        o_listen = ListenPipeline(devices=o_devices, workers=2)
+        result = list(o_listen)
+        self.assertEqual([(o.method, o.ipaddr) for o in result], [
+            ('NOTIFY', '192.168.10.86'), ('M-SEARCH', '192.168.10.3'),
+            ('NOTIFY', '192.168.10.75')])
+        self.assertEqual(result[0].nts, 'ssdp:alive')
+        self.assertEqual(len(o_devices), 2)
+        self.o_mock_socket.close.assert_called_once_with()
+
+    def test4_listen_pipeline(self):
+        """Test the metrics of the workers and a failed worker."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM1, LADDR1), (LDATAGRAM3, LADDR3), socket.timeout(),
+            (LDATAGRAM2, LADDR2), KeyboardInterrupt())
+
+        def _match(o_datagram):
+            if o_datagram.method == 'M-SEARCH':
+                raise RuntimeError('worker failed')
+            return True
+        o_metrics = Metrics()
+        o_listen = ListenPipeline(workers=1, metrics=o_metrics, match=_match)
+        o_listen.open()
+        self.assertEqual(len(o_listen.get().splitlines()), 2)
+        # The parse and format times are measured in the worker.
+        self.assertEqual(o_metrics.histogram('parse').count, 2)
+        self.assertEqual(o_metrics.histogram('format').count, 2)
+        self.assertEqual(o_metrics.counter('datagrams_received'), 3)
+        with self.assertRaisesRegex(RuntimeError, 'worker failed'):
+            o_listen.get()
+        # The receiver thread and the workers have been stopped.
+        # pylint: disable=protected-access
+        self.assertFalse(o_listen._receiver.is_alive())
+        self.assertIsNone(o_listen._pool)
+        self.o_mock_socket.close.assert_called_once_with()
+        self.assertIsNone(o_listen.get())
+
+
+class DualStackTestCase(TestCase):
+    """These are tests to listen to IPv4 and IPv6 groups together.
+
+    Every socket is an own mock. The selector is also mocked and returns the
+    sockets that are ready for every call of select().
+    """
+    def setUp(self):
+        """This patches the network sockets, the selector and the
+        interfaces."""
+        patcher = mock.patch('muca.upnp.Listen.socket.socket')
+        self.addCleanup(patcher.stop)
+        self.mock_socket = patcher.start()
+        self.mock_socket.side_effect = lambda *args: mock.Mock(spec_set=[
+            'setsockopt', 'getsockopt', 'bind', 'recvmsg', 'close'])
+        patcher = mock.patch('selectors.DefaultSelector')
+        self.addCleanup(patcher.stop)
+        self.mock_selector = patcher.start()
+        self.keys = []
+        self.mock_selector.return_value.register.side_effect = \
+            lambda sock, events, data: self.keys.append(
+                mock.Mock(fileobj=sock, data=data))
+        self.ready = []
+        self.mock_selector.return_value.select.side_effect = self.select
+        patcher = mock.patch('muca.upnp.Listen.interfaces6',
+                             return_value=[('eth0', 2), ('wlan0', 3)])
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def select(self, timeout):
+        """This returns the ready keys, at the end listening is stopped."""
+        if not self.ready:
+            raise KeyboardInterrupt()
+        return [(self.keys[i], 1) for i in self.ready.pop(0)]
+
+    def test1_listen_dual_stack(self):
+        """Test both sockets serviced by one selector."""
+        o_devices = DeviceTable()
+        o_listen = Listen(devices=o_devices, scopes=('site', 'ipv4', 'link'))
+        o_listen.open()
+        self.assertEqual(len(self.keys), 2)
+        o_sock4 = self.keys[0].fileobj
+        o_sock6 = self.keys[1].fileobj
+        self.assertEqual(self.mock_socket.call_args_list[1], mock.call(
+            socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP))
+        o_sock4.bind.assert_called_with(('239.255.255.250', 1900))
+        o_sock6.bind.assert_called_with(('::', 1900))
+        o_sock6.setsockopt.assert_any_call(
+            socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        joins = [_call[0][2] for _call in o_sock6.setsockopt.call_args_list
+                 if _call[0][1] == socket.IPV6_JOIN_GROUP]
+        self.assertEqual(joins, [
+            socket.inet_pton(socket.AF_INET6, _group) +
+            struct.pack('@I', _index)
+            for _group in ('ff02::c', 'ff05::c') for _index in (2, 3)])
+
+        o_sock4.recvmsg.side_effect = recvmsg((LDATAGRAM1, LADDR1))
+        o_sock6.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM3, ('fe80::2', 42047, 0, 2)))
+        self.ready = [[0, 1]]
+        result = [o_listen.get(), o_listen.get()]
+        self.assertRegex(result[0], r' NOTIFY \[fe80::2\]:42047 uuid:')
+        self.assertRegex(result[1], r' NOTIFY 192\.168\.10\.86:57535 uuid:')
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(len(o_devices), 2)
+
+    def test2_listen_dual_stack(self):
+        """Test IPv6 only with one socket and without selector."""
+        o_listen = Listen(scopes=['link'])
+        o_listen.open()
+        self.mock_socket.assert_called_once_with(
+            socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.mock_selector.assert_not_called()
+        o_listen._sock.recvmsg.side_effect = recvmsg(
+            (LDATAGRAM3, ('fe80::2', 42047, 0, 2)), KeyboardInterrupt())
+        self.assertEqual([_o.ipaddr for _o in o_listen], ['fe80::2'])
+        with self.assertRaisesRegex(ValueError, 'unknown scope: global'):
+            Listen(scopes=['ipv4', 'global'])
+
+
+class PcapTestCase(TestCase):
+    """These are tests to listen to datagrams from a capture file."""
+
+    def test1_listen_pcap(self):
+        """Test to read SSDP datagrams with capture timestamps."""
+        o_devices = DeviceTable()
+        o_listen = ListenPcap(capture_file(self, pcap(RECORDS)),
+                              devices=o_devices)
+        o_listen.open()
+        self.assertEqual(o_listen.get(), (
+            '0000.0000s 0 NOTIFY 192.168.10.86:57535 '
+            'uuid:f4f7681c-3056-11e8-86bd-87a6e4e2c42d Linux/4.14.71-v7+, '
+            'UPnP/1.0, Portable SDK for UPnP devices/1.6.19+git20160116\r\n'))
+        self.assertEqual(o_listen.get(),
+                         '0001.5000s 0 M-SEARCH 192.168.10.3:57509\r\n')
+        self.assertRegex(o_listen.get(),
+                         r'^0002\.2500s 0 192\.168\.10\.119:1900 uuid:')
+        self.assertIsNone(o_listen.get())
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(len(o_devices), 2)
+        self.assertEqual(o_listen.stats()['datagrams'], 3)
+        self.assertRegex(o_listen.fstats(), r'^datagrams: 3 seconds: ')
+
+    def test2_listen_pcap(self):
+        """Test to read a file that is not a capture file."""
+        o_listen = ListenPcap(capture_file(self, LDATAGRAM1))
+        o_listen.open()
+        with self.assertRaises(SystemExit):
+            o_listen.get()
+
+    def test3_listen_pcap(self):
+        """Test the storm filter with capture timestamps."""
+        o_storm = StormFilter(window=2)
+        o_listen = ListenPcap(capture_file(self, pcap(
+            RECORDS[:1] * 3 + RECORDS[1:])), storm=o_storm)
+        o_listen.open()
+        self.assertRegex(o_listen.get(), r'^0000\.0000s 0 NOTIFY ')
+        self.assertRegex(o_listen.get(), r'^0001\.5000s 0 M-SEARCH ')
+        self.assertRegex(o_listen.get(), r'^0002\.2500s 0 192\.168')
+        self.assertIsNone(o_listen.get())
+        self.assertEqual(o_storm.duplicates, 2)
+
+    def test_print_it(self):
+        """Test if the output from a capture file works."""
+        with mock.patch('sys.stdout', new=StringIO()) as fake_output:
+            print_it(ListenPcap(capture_file(self, pcap(RECORDS[:2])),
+                                verbose=True))
+            self.assertEqual(fake_output.getvalue(), (
+                '0000.0000s 0 192.168.10.86:57535\r\n' + LDATAGRAM1.decode()))
+
 # vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap
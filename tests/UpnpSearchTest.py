@@ -7,13 +7,17 @@ test case within self.setUp().
 """
 from unittest import TestCase, mock
 from io import StringIO
+import json
 import socket
+import struct
+from time import time_ns
 
-from muca.upnp.Common import SSDPdatagram
-from muca.upnp.Search import Msearch, MsearchDevice, print_it, \
-                            socket as upnpsearch_sock
+from muca.upnp.Common import SSDPdatagram, DeviceTable
+from muca.upnp.Latency import LatencyReport
+from muca.upnp.Search import Msearch, MsearchDevice, MsearchInterfaces, \
+                            print_it, socket as upnpsearch_sock
 from tests.CommonTest import SDATAGRAM1, SDATAGRAM2, SDATAGRAM3, \
-                             SADDR1, SADDR2, SADDR3
+                             SADDR1, SADDR2, SADDR3, recvmsg
 
 
 REQUEST = \
@@ -40,7 +44,7 @@ class NetSocketTestCase(TestCase):
         self.mock_socket = patcher.start()
         self.o_mock_socket = self.mock_socket.return_value
         self.o_mock_socket.mock_add_spec(
-            ['settimeout', 'sendto', 'recvfrom'], spec_set=True)
+            ['settimeout', 'setsockopt', 'sendto', 'recvmsg'], spec_set=True)
 
     def test_mock_socket(self):
         """Test if general patch from self.setUp() for all tests is working."""
@@ -57,30 +61,34 @@ class NetSocketTestCase(TestCase):
         self.o_mock_socket.sendto.assert_called_with(
             REQUEST, ('239.255.255.250', 1900))
 
-        self.o_mock_socket.recvfrom.return_value = SDATAGRAM1, SADDR1
+        self.o_mock_socket.recvmsg.return_value = SDATAGRAM1, [], 0, SADDR1
         o_datagram = o_msearch.get()
         self.o_mock_socket.settimeout.assert_called_with(3)
         self.assertEqual(self.o_mock_socket.settimeout.call_count, 1)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertIsInstance(o_datagram, SSDPdatagram)
         self.assertEqual(o_datagram.uuid,
                          "3b2867a3-b55f-8e77-5ad8-a6d0c6990277")
 
-        o_msearch.RECVBUF = 128
-        with self.assertRaises(SystemExit) as sysex:
+        # A truncated datagram is skipped.
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1[:128], [], socket.MSG_TRUNC, SADDR1),
+            (SDATAGRAM2, SADDR2))
+        with self.assertLogs('muca', level='WARNING'):
             o_datagram = o_msearch.get()
-            self.assertEqual(sysex.exception, "ERROR: receive buffer overflow")
+        self.assertEqual(o_datagram.ipaddr, SADDR2[0])
+        self.assertEqual(o_msearch.truncated, 1)
 
         self.assertEqual(self.o_mock_socket.settimeout.call_count, 2)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
-        self.o_mock_socket.recvfrom.side_effect = socket.timeout()
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
+        self.o_mock_socket.recvmsg.side_effect = socket.timeout()
         o_datagram = o_msearch.get()
         self.assertEqual(self.o_mock_socket.settimeout.call_count, 3)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(o_datagram)
         o_datagram = o_msearch.get()
         self.assertEqual(self.o_mock_socket.settimeout.call_count, 3)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(o_datagram)
 
     def test2_msearch(self):
@@ -89,11 +97,11 @@ class NetSocketTestCase(TestCase):
         o_msearch.request()
         self.o_mock_socket.sendto.assert_called_with(
             REQUEST, ('239.255.255.250', 1900))
-        self.o_mock_socket.recvfrom.return_value = SDATAGRAM1, SADDR1
+        self.o_mock_socket.recvmsg.return_value = SDATAGRAM1, [], 0, SADDR1
         o_datagram = o_msearch.get()
         self.o_mock_socket.settimeout.assert_called_with(3)
         self.assertEqual(self.o_mock_socket.settimeout.call_count, 1)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertIsInstance(o_datagram, SSDPdatagram)
         self.assertEqual(o_datagram.uuid,
                          "3b2867a3-b55f-8e77-5ad8-a6d0c6990277")
@@ -103,7 +111,7 @@ class NetSocketTestCase(TestCase):
         o_datagram = o_msearch.get()
         self.o_mock_socket.settimeout.assert_called_with(3)
         self.assertEqual(self.o_mock_socket.settimeout.call_count, 2)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertIsInstance(o_datagram, SSDPdatagram)
         self.assertEqual(o_datagram.uuid,
                          "3b2867a3-b55f-8e77-5ad8-a6d0c6990277")
@@ -113,76 +121,76 @@ class NetSocketTestCase(TestCase):
         o_msearch_device = MsearchDevice()
         result = o_msearch_device.get()
         self.assertIsNone(result)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 0)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 0)
         o_msearch_device.request(retries=-1)
         result = o_msearch_device.get()
         self.assertIsNone(result)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 0)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 0)
         o_msearch_device.request(retries=0)
         result = o_msearch_device.get()
         self.assertIsNone(result)
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 0)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 0)
 
     def test2_msearch_device(self):
         """Test with one request but subsequent pending data."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (SDATAGRAM1, SADDR1),
             socket.timeout(),
             (SDATAGRAM2, SADDR2)
-        ]
+        )
         o_msearch_device = MsearchDevice()
         o_msearch_device.request(retries=1)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 1 192\.168\.10\.119:47383 "
             r"uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 "
             r"Linux/3\.10\.79, UPnP/1\.0, Portable SDK for UPnP "
             r"devices/1\.6\.18\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, r'^0000\.00..s 0\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertIsNone(result)
 
     def test3_msearch_device(self):
         """Test with two requests and data on each request."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (SDATAGRAM1, SADDR1),
             socket.timeout(),
             (SDATAGRAM2, SADDR2),
             (SDATAGRAM1, SADDR1),
             socket.timeout()
-        ]
+        )
         o_msearch_device = MsearchDevice()
         o_msearch_device.request(retries=2)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 1 192\.168\.10\.119:47383 "
             r"uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 "
             r"Linux/3\.10\.79, UPnP/1\.0, Portable SDK for UPnP "
             r"devices/1\.6\.18\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, r'^0000\.00..s 2\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 2 192\.168\.49\.1:34731 "
             r"uuid:f48c8d92-c3c0-6f29-0000-00004e74db48 "
             r"Linux/3\.10\.54 UPnP/1\.0 Cling/2\.0\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 5)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 5)
         self.assertRegex(result, r'^0000\.00..s 0\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 5)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 5)
         self.assertIsNone(result)
 
     def test4_msearch_device(self):
         """Test with three requests, data only on second request."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             socket.timeout(),
             (SDATAGRAM1, SADDR1),
             (SDATAGRAM2, SADDR2),
@@ -192,147 +200,320 @@ class NetSocketTestCase(TestCase):
             (SDATAGRAM3, SADDR3),
             socket.timeout(),
             socket.timeout()
-        ]
+        )
         o_msearch_device = MsearchDevice()
         o_msearch_device.request(retries=3)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, r'^0000\.00\d\ds 2\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 2 192\.168\.10\.119:47383 "
             r"uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 "
             r"Linux/3\.10\.79, UPnP/1\.0, Portable SDK for UPnP "
             r"devices/1\.6\.18\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 2 192\.168\.49\.1:34731 "
             r"uuid:f48c8d92-c3c0-6f29-0000-00004e74db48 "
             r"Linux/3\.10\.54 UPnP/1\.0 Cling/2\.0\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 7)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 7)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 2 192\.168\.10\.3:1900 "
             r"uuid:123402409-bccb-40e7-8e6c-3481C4FC71A9 "
             r"fritz-box UPnP/1\.0 AVM FRITZ!Box 7490 113\.07\.01\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 8)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 8)
         self.assertRegex(result, r'^0000\.00\d\ds 3\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 9)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 9)
         self.assertRegex(result, r'^0000\.00\d\ds 0\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 9)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 9)
         self.assertIsNone(result)
 
     def test5_msearch_device(self):
         """Test with four verbose requests, data only on third request."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             socket.timeout(),
             socket.timeout(),
             (SDATAGRAM1, SADDR1),
             socket.timeout(),
             socket.timeout()
-        ]
+        )
         o_msearch_device = MsearchDevice(verbose=True)
         o_msearch_device.request(retries=4)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, r'^0000\.00\d\ds 2\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, r'^0000\.00\d\ds 3\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result[:9], r'^0000\.00\d\d$$')
         self.assertEqual(result[9:], 's 3 192.168.10.119:47383\r\n'
                          + SDATAGRAM1.decode())
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertRegex(result, r'^0000\.00\d\ds 4\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 5)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 5)
         self.assertRegex(result, r'^0000\.00\d\ds 0\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 5)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 5)
         self.assertIsNone(result)
 
     def test6_msearch_device(self):
         """Test with three requests but no data."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             socket.timeout(),
             socket.timeout(),
             socket.timeout()
-        ]
+        )
         o_msearch_device = MsearchDevice()
         o_msearch_device.request(retries=3)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, r'^0000\.00\d\ds 2\r\n$')
         self.assertNotEqual(result[:9], '0000.0000')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, r'^0000\.00\d\ds 3\r\n$')
         self.assertNotEqual(result[:9], '0000.0000')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result, r'^0000\.00\d\ds 0\r\n$')
         self.assertNotEqual(result[:9], '0000.0000')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertIsNone(result)
 
     def test7_msearch_device(self):
         """Test with one request and then new one request getting same data."""
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (SDATAGRAM1, SADDR1),
             socket.timeout(),
             (SDATAGRAM1, SADDR1),
             socket.timeout()
-        ]
+        )
         o_msearch_device = MsearchDevice()
         o_msearch_device.request(retries=1)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 1)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 1 192\.168\.10\.119:47383 "
             r"uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 "
             r"Linux/3\.10\.79, UPnP/1\.0, Portable SDK for UPnP "
             r"devices/1\.6\.18\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertRegex(result, r'^0000\.00\d\ds 0\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 2)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 2)
         self.assertIsNone(result)
 
         o_msearch_device.request(retries=1)
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 3)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
         self.assertRegex(result, (
             r"^0000\.0\d\d\ds 1 192\.168\.10\.119:47383 "
             r"uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 "
             r"Linux/3\.10\.79, UPnP/1\.0, Portable SDK for UPnP "
             r"devices/1\.6\.18\r\n$"))
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertRegex(result, r'^0000\.00\d\ds 0\r\n$')
         result = o_msearch_device.get()
-        self.assertEqual(self.o_mock_socket.recvfrom.call_count, 4)
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 4)
         self.assertIsNone(result)
 
+    def test8_msearch_device(self):
+        """Test two searches sharing one table of devices."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1),
+            socket.timeout(),
+            (SDATAGRAM2, SADDR2),
+            (SDATAGRAM1, SADDR1),
+            socket.timeout()
+        )
+        o_devices = DeviceTable()
+        o_msearch_device = MsearchDevice(devices=o_devices)
+        o_msearch_device.request(retries=1)
+        self.assertRegex(o_msearch_device.get(), r' 192\.168\.10\.119:47383 ')
+        self.assertRegex(o_msearch_device.get(), r'^0000\.00\d\ds 0\r\n$')
+        self.assertEqual(len(o_devices), 1)
+        o_msearch_device = MsearchDevice(devices=o_devices)
+        o_msearch_device.request(retries=1)
+        self.assertRegex(o_msearch_device.get(), r' 192\.168\.49\.1:34731 ')
+        self.assertRegex(o_msearch_device.get(), r' 192\.168\.10\.119:47383 ')
+        self.assertRegex(o_msearch_device.get(), r'^0000\.00\d\ds 0\r\n$')
+        self.assertEqual(len(o_devices), 2)
+
+    def test9_msearch_device(self):
+        """Test iterating over new devices and the ends of the windows."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1),
+            socket.timeout(),
+            (SDATAGRAM2, SADDR2),
+            (SDATAGRAM1, SADDR1),
+            socket.timeout(),
+            socket.timeout()
+        )
+        o_msearch_device = MsearchDevice()
+        result = list(o_msearch_device)
+        self.assertEqual(self.o_mock_socket.sendto.call_count, 3)
+        self.assertTrue(all(isinstance(o, SSDPdatagram) for o in result))
+        self.assertEqual([(o.request, o.ipaddr) for o in result], [
+            (1, '192.168.10.119'), (2, ''), (2, '192.168.49.1'), (3, ''),
+            (0, '')])
+        self.assertIsNone(result[1].data)
+        self.assertIsNone(o_msearch_device.get())
+
+    def test10_msearch_device(self):
+        """Test that a device without unique identifier is reported once."""
+        data = SDATAGRAM3.replace(
+            b'USN: uuid:123402409-bccb-40e7-8e6c-3481C4FC71A9::'
+            b'upnp:rootdevice\r\n', b'')
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (data, SADDR3),
+            (data, SADDR3),
+            socket.timeout(),
+            (data, SADDR3),
+            socket.timeout(),
+            socket.timeout()
+        )
+        o_msearch_device = MsearchDevice()
+        result = list(o_msearch_device)
+        self.assertEqual([(o.request, o.ipaddr) for o in result], [
+            (1, '192.168.10.3'), (2, ''), (3, ''), (0, '')])
+
+    @mock.patch('muca.upnp.Search.interfaces6',
+                return_value=[('eth0', 2), ('wlan0', 3)])
+    def test_msearch_ipv6(self, _):
+        """Test requests to the IPv6 groups on one socket."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, ('fe80::2', 47383, 0, 2)),
+            socket.timeout()
+        )
+        o_msearch_device = MsearchDevice(scopes=['site', 'link'])
+        self.mock_socket.assert_called_once_with(
+            socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        o_msearch_device.request(retries=1)
+        request = REQUEST.replace(b'239.255.255.250', b'[FF02::C]')
+        self.assertEqual(self.o_mock_socket.sendto.call_args_list, [
+            mock.call(request, ('ff02::c', 1900, 0, 2)),
+            mock.call(request, ('ff02::c', 1900, 0, 3)),
+            mock.call(REQUEST.replace(b'239.255.255.250', b'[FF05::C]'),
+                      ('ff05::c', 1900))])
+        self.assertRegex(o_msearch_device.get(), r' \[fe80::2\]:47383 ')
+        self.assertRegex(o_msearch_device.get(), r'^0000\.00\d\ds 0\r\n$')
+
+    def test1_msearch_adaptive(self):
+        """Test search that stops when all known devices have responded."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1),
+            (SDATAGRAM1, SADDR1),
+            (SDATAGRAM3, SADDR3),
+            (SDATAGRAM2, SADDR2)
+        )
+        o_msearch_device = MsearchDevice(known=[
+            '3b2867a3-b55f-8e77-5ad8-a6d0c6990277',
+            '123402409-bccb-40e7-8e6c-3481C4FC71A9'])
+        o_msearch_device.request(retries=3)
+        self.assertRegex(o_msearch_device.get(), r' 192\.168\.10\.119:47383 ')
+        self.assertRegex(o_msearch_device.get(), r' 192\.168\.10\.3:1900 ')
+        self.assertRegex(o_msearch_device.get(), r'^0000\.00\d\ds 0\r\n$')
+        self.assertIsNone(o_msearch_device.get())
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 3)
+        self.assertEqual(self.o_mock_socket.sendto.call_count, 1)
+
+    def test2_msearch_adaptive(self):
+        """Test search with quiet interval, backoff and timeouts in ms."""
+        # pylint: disable=protected-access
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM1, SADDR1),
+            socket.timeout(),
+            socket.timeout()
+        )
+        o_msearch_device = MsearchDevice(quiet=0.25, backoff=2)
+        o_msearch_device.request(retries=2)
+        self.assertRegex(o_msearch_device.get(), r' 192\.168\.10\.119:47383 ')
+        self.assertAlmostEqual(
+            self.o_mock_socket.settimeout.call_args[0][0], 0.25, 2)
+        with mock.patch('muca.upnp.Search.monotonic_ns',
+                        return_value=o_msearch_device._last_new + 300000000):
+            # The quiet interval has passed without receiving.
+            self.assertRegex(o_msearch_device.get(), r'^0000\.00\d\ds 2\r\n$')
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 1)
+        self.assertEqual(self.o_mock_socket.sendto.call_count, 2)
+        o_msearch_device._quiet = None
+        self.assertRegex(o_msearch_device.get(), r'^0000\.0\d\d\ds 0\r\n$')
+        # second window is two times (MX + NETDELAY) long
+        self.assertAlmostEqual(
+            self.o_mock_socket.settimeout.call_args[0][0], 6, delta=0.5)
+        self.assertIsNone(o_msearch_device.get())
+
+    def test3_msearch_adaptive(self):
+        """Test search that ends by its timeout."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            socket.timeout(),
+        )
+        o_msearch_device = MsearchDevice(timeout=0.5)
+        o_msearch_device.request(retries=3)
+        # pylint: disable=protected-access
+        self.assertEqual(o_msearch_device._deadline
+                         - o_msearch_device._start, 500000000)
+        with mock.patch('muca.upnp.Search.monotonic_ns',
+                        return_value=o_msearch_device._start + 600000000):
+            self.assertRegex(o_msearch_device.get(), r'^0000\.0\d\d\ds 0\r\n$')
+        self.assertIsNone(o_msearch_device.get())
+        self.assertEqual(self.o_mock_socket.recvmsg.call_count, 0)
+        self.assertEqual(self.o_mock_socket.sendto.call_count, 1)
+
+    def test4_msearch_adaptive(self):
+        """Test the response latencies from the kernel receive time."""
+        _now = time_ns()
+
+        def _received(data, addr, latency):
+            return (data, [(socket.SOL_SOCKET, 35, struct.pack(
+                '@ll', *divmod(_now + latency, 1000000000)))], 0, addr)
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            _received(SDATAGRAM1, SADDR1, 120000000),
+            _received(SDATAGRAM1, SADDR1, 200000000),
+            _received(SDATAGRAM2, SADDR2, 1800000000),
+            socket.timeout(),
+            _received(SDATAGRAM1, SADDR1, 500000000),
+            socket.timeout())
+        o_latency = LatencyReport()
+        o_msearch_device = MsearchDevice(latency=o_latency)
+        o_msearch_device.request(retries=2)
+        self.assertEqual([o.request for o in o_msearch_device], [1, 1, 2, 0])
+        result = o_latency.stats()
+        self.assertEqual((result['requests'], result['mx']), (2, 2))
+        result = result['devices']['3b2867a3-b55f-8e77-5ad8-a6d0c6990277']
+        self.assertEqual(result['address'], '192.168.10.119:47383')
+        self.assertEqual((result['count'], result['answered']), (2, 2))
+        self.assertAlmostEqual(result['min'], 0.12, delta=0.05)
+        self.assertEqual(list(result['buckets'].values()),
+                         [1, 1, 0, 0, 0, 0, 0, 0])
+        self.assertRegex(o_latency.freport().splitlines()[1],
+                         r' 192\.168\.49\.1:34731 answered 1/2 '
+                         r'min 1\d{3}\.\dms ')
+
     def test_print_it(self):
         """Test if the output works."""
         # set three timeouts because default retries = 3
-        self.o_mock_socket.recvfrom.side_effect = [
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
             (SDATAGRAM2, SADDR2),
             socket.timeout(),
             socket.timeout(),
             (SDATAGRAM3, SADDR3),
             socket.timeout()
-        ]
+        )
         with mock.patch('sys.stdout', new=StringIO()) as fake_output:
             print_it(MsearchDevice())
             self.assertRegex(fake_output.getvalue(), (
@@ -346,4 +527,121 @@ class NetSocketTestCase(TestCase):
                 r"fritz-box UPnP/1\.0 AVM FRITZ!Box 7490 113\.07\.01\r\n"
                 r"0000\.0\d\d\ds 0\r\n$"))
 
+    def test_print_it_format(self):
+        """Test if the output as JSON lines works."""
+        self.o_mock_socket.recvmsg.side_effect = recvmsg(
+            (SDATAGRAM2, SADDR2),
+            socket.timeout(),
+            socket.timeout(),
+            socket.timeout()
+        )
+        with mock.patch('sys.stdout', new=StringIO()) as fake_output:
+            print_it(MsearchDevice(output='ndjson'))
+            result = [json.loads(line) for line in
+                      fake_output.getvalue().splitlines()]
+        self.assertEqual(len(result), 4)
+        self.assertEqual(result[0]['ip'], '192.168.49.1')
+        self.assertEqual(result[0]['st'], 'upnp:rootdevice')
+        self.assertEqual(result[0]['request'], 1)
+        self.assertEqual([record['request'] for record in result[1:]],
+                         [2, 3, 0])
+        self.assertNotIn('ip', result[3])
+
+
+class InterfacesTestCase(TestCase):
+    """These are tests for searching on more than one interface.
+
+    Every interface gets its own mocked socket. The selector is also mocked
+    and returns the sockets that are ready for every call of select().
+    """
+    def setUp(self):
+        """This patches the network socket and the selector."""
+        patcher = mock.patch('muca.upnp.Search.socket.socket')
+        self.addCleanup(patcher.stop)
+        self.mock_socket = patcher.start()
+        self.mock_socket.side_effect = lambda *args: mock.Mock(spec_set=[
+            'setsockopt', 'bind', 'sendto', 'recvmsg', 'close'])
+        patcher = mock.patch('selectors.DefaultSelector')
+        self.addCleanup(patcher.stop)
+        self.o_mock_selector = patcher.start().return_value
+        self.keys = []
+        self.o_mock_selector.register.side_effect = \
+            lambda sock, events, data: self.keys.append(
+                mock.Mock(fileobj=sock, data=data))
+        self.ready = []
+        self.o_mock_selector.select.side_effect = \
+            lambda timeout: [(self.keys[i], 1) for i in self.ready.pop(0)]
+
+    def test1_msearch_interfaces(self):
+        """Test search on two interfaces with merged unique responses."""
+        o_msearch = MsearchInterfaces(ifaddrs=[('eth0', '192.168.10.2'),
+                                               ('wlan0', '192.168.49.2')])
+        self.assertEqual(len(self.keys), 2)
+        o_eth0 = self.keys[0].fileobj
+        o_wlan0 = self.keys[1].fileobj
+        o_eth0.setsockopt.assert_any_call(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, b'\xc0\xa8\x0a\x02')
+        o_eth0.bind.assert_called_with(('192.168.10.2', 0))
+        o_wlan0.bind.assert_called_with(('192.168.49.2', 0))
+
+        o_eth0.recvmsg.side_effect = recvmsg((SDATAGRAM1, SADDR1),
+                                             (SDATAGRAM3, SADDR3))
+        o_wlan0.recvmsg.side_effect = recvmsg((SDATAGRAM2, SADDR2),
+                                              (SDATAGRAM1, SADDR1))
+        self.ready = [[0, 1], [0, 1], [], []]
+        o_msearch.request(retries=1)
+        o_eth0.sendto.assert_called_once_with(REQUEST,
+                                              ('239.255.255.250', 1900))
+        o_wlan0.sendto.assert_called_once_with(REQUEST,
+                                               ('239.255.255.250', 1900))
+        result = o_msearch.get()
+        self.assertRegex(result, (
+            r"^0000\.0\d\d\ds 1 192\.168\.49\.1:34731@wlan0 "
+            r"uuid:f48c8d92-c3c0-6f29-0000-00004e74db48 "))
+        result = o_msearch.get()
+        self.assertRegex(result, (
+            r"^0000\.0\d\d\ds 1 192\.168\.10\.119:47383@eth0 "
+            r"uuid:3b2867a3-b55f-8e77-5ad8-a6d0c6990277 "))
+        result = o_msearch.get()
+        self.assertRegex(result, (
+            r"^0000\.0\d\d\ds 1 192\.168\.10\.3:1900@eth0 "))
+        result = o_msearch.get()
+        self.assertRegex(result, r'^0000\.00\d\ds 0\r\n$')
+        self.assertIsNone(o_msearch.get())
+        self.assertEqual(o_eth0.recvmsg.call_count, 2)
+        self.assertEqual(o_wlan0.recvmsg.call_count, 2)
+        self.assertAlmostEqual(
+            self.o_mock_selector.select.call_args[0][0], 3, 1)
+        o_msearch.close()
+        o_eth0.close.assert_called_once_with()
+        o_wlan0.close.assert_called_once_with()
+        self.o_mock_selector.close.assert_called_once_with()
+
+    def test2_msearch_interfaces(self):
+        """Test search without any interface."""
+        o_msearch = MsearchInterfaces(ifaddrs=[])
+        self.ready = [[]]
+        o_msearch.request(retries=1)
+        self.assertRegex(o_msearch.get(), r'^0000\.00\d\ds 0\r\n$')
+        self.assertIsNone(o_msearch.get())
+
+    def test3_msearch_interfaces(self):
+        """Test that all sockets are closed if an interface fails."""
+        sockets = []
+        def new_socket(*args):
+            sockets.append(mock.Mock(spec_set=[
+                'setsockopt', 'bind', 'sendto', 'recvmsg', 'close']))
+            return sockets[-1]
+        self.mock_socket.side_effect = new_socket
+        # The unbound socket of Msearch and eth0 are set up.
+        with mock.patch.object(MsearchInterfaces, '_setup_socket',
+                               side_effect=[None, None, OSError()]):
+            with self.assertRaises(OSError):
+                MsearchInterfaces(ifaddrs=[('eth0', '192.168.10.2'),
+                                           ('wlan0', '192.168.49.2')])
+        self.assertEqual(len(sockets), 3)
+        for o_sock in sockets:
+            o_sock.close.assert_called_once_with()
+        self.o_mock_selector.close.assert_called_once_with()
+
 # vim: tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent nowrap